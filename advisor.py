@@ -0,0 +1,217 @@
+#!/usr/bin/python
+
+# ##################################################
+# import
+
+import re
+import sys
+import sqlite3
+import argparse
+
+import lite
+
+
+
+# ##################################################
+# settings
+
+MIN_ROWS = 1000
+SCAN_REGEXP = re.compile( '^SCAN (?:TABLE )?(\w+)', re.IGNORECASE )
+COLUMN_REGEXP = re.compile( '(?:\w+\.)?(\w+)\s*(?:=|==|<|>|<=|>=|\\bIN\\b|\\bLIKE\\b|\\bBETWEEN\\b)\s*[(?]', re.IGNORECASE )
+WHERE_REGEXP = re.compile( '\\bWHERE\\b', re.IGNORECASE )
+ORDER_REGEXP = re.compile( '\\bORDER\s+BY\s+(?:\w+\.)?(\w+)', re.IGNORECASE )
+ROWID_COLUMNS = [ 'oid', 'rowid', '_rowid_' ]
+
+
+
+# ##################################################
+# class Advice
+
+class Advice:
+
+    # ##################################################
+    # constructor
+
+    def __init__( self, section, option, sql, plan ):
+        self.section = section
+        self.option = option
+        self.sql = sql
+        self.plan = plan
+        self.scans = []
+        self.indexes = []
+        self.error = None
+
+
+
+# ##################################################
+# class Advisor
+#   runs EXPLAIN QUERY PLAN on every compiled statement of <db>.ini and
+#   proposes an index for each scan of a large table filtered or sorted
+#   on columns of that table
+
+class Advisor:
+
+    # ##################################################
+    # constructor
+
+    def __init__( self, database, min_rows=MIN_ROWS ):
+        self.database = database
+        self.min_rows = min_rows
+        self.connection = sqlite3.connect( '%s.db' % database )
+        self.sizes = {}
+        self.columns = {}
+
+    # ##################################################
+    # statements
+    #   DEFAULT entries are templates inherited by every section, so they
+    #   are only checked against each table; entries without %tb% once
+
+    def statements( self ):
+        plans = lite.catalog.load( '%s.ini' % self.database )
+        seen = set()
+        for section in sorted( plans ):
+            if section == 'DEFAULT':
+                continue
+            for option in sorted( plans[ section ] ):
+                plan = plans[ section ][ option ]
+                if isinstance( plan, Exception ):
+                    continue
+                request = lite.Request( parameters={ 'db': self.database, 'tb': section } )
+                for statement in plan.statements:
+                    if statement.kind not in lite.READS + lite.WRITES:
+                        continue
+                    try:
+                        sql = statement.substitute( request )
+                    except Exception:
+                        continue
+                    if sql in seen:
+                        continue
+                    seen.add( sql )
+                    # parameters are bound as NULL, EXPLAIN does not run the query
+                    yield ( section, option, sql, statement.extract_parameters( {} ) )
+
+    # ##################################################
+    # advise
+
+    def advise( self ):
+        advices = []
+        for section, option, sql, parameters in self.statements():
+            advice = Advice( section, option, sql, [] )
+            try:
+                advice.plan = self.explain( sql, parameters )
+            except sqlite3.Error, e:
+                advice.error = '%s' % e
+                advices.append( advice )
+                continue
+            for detail in advice.plan:
+                match = SCAN_REGEXP.match( detail )
+                if match is None or 'COVERING INDEX' in detail.upper():
+                    continue
+                table = match.group(1)
+                size = self.size( table )
+                if size < self.min_rows:
+                    continue
+                advice.scans.append( ( table, size ) )
+                columns = self.candidate_columns( sql, table )
+                if columns:
+                    advice.indexes.append( 'CREATE INDEX IF NOT EXISTS idx_%s_%s ON %s ( %s )' % ( table, '_'.join( columns ), table, ', '.join( columns ) ) )
+            advices.append( advice )
+        return advices
+
+    # ##################################################
+    # explain
+
+    def explain( self, sql, parameters ):
+        return [ row[ -1 ] for row in self.connection.execute( 'EXPLAIN QUERY PLAN %s' % sql, parameters ).fetchall() ]
+
+    # ##################################################
+    # size
+
+    def size( self, table ):
+        if table not in self.sizes:
+            try:
+                self.sizes[ table ] = self.connection.execute( 'SELECT COUNT(*) FROM %s' % table ).fetchone()[0]
+            except sqlite3.Error:
+                self.sizes[ table ] = 0
+        return self.sizes[ table ]
+
+    # ##################################################
+    # candidate_columns
+    #   columns filtered in the WHERE clause first (in query order),
+    #   then the sort column
+
+    def candidate_columns( self, sql, table ):
+        if table not in self.columns:
+            self.columns[ table ] = [ row[1].lower() for row in self.connection.execute( 'PRAGMA table_info( %s )' % table ).fetchall() ]
+        known = self.columns[ table ]
+        columns = []
+        where = WHERE_REGEXP.split( sql, 1 )
+        filters = COLUMN_REGEXP.findall( where[1] ) if len( where ) > 1 else []
+        for column in filters + ORDER_REGEXP.findall( sql ):
+            column = column.lower()
+            if column in known and column not in ROWID_COLUMNS and column not in columns:
+                columns.append( column )
+        return columns
+
+    # ##################################################
+    # apply
+
+    def apply( self, advices ):
+        indexes = sorted( set( index for advice in advices for index in advice.indexes ) )
+        for index in indexes:
+            self.connection.execute( index )
+        self.connection.commit()
+        return indexes
+
+    # ##################################################
+    # close
+
+    def close( self ):
+        self.connection.close()
+
+
+
+# ##################################################
+# display
+
+def display( advices ):
+    for advice in advices:
+        if advice.error is None and not advice.scans:
+            continue
+        print '[%s] %s' % ( advice.section, advice.option )
+        print '    %s' % advice.sql
+        if advice.error is not None:
+            print '    error: %s' % advice.error
+            continue
+        for detail in advice.plan:
+            print '    plan: %s' % detail
+        for table, size in advice.scans:
+            print '    scan of %s ( %s rows )' % ( table, size )
+        for index in advice.indexes:
+            print '    advice: %s' % index
+
+# ##################################################
+# main
+#
+#   python advisor.py test           report scans of large tables
+#   python advisor.py test --apply   also create the proposed indexes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description='index advisor for a lite catalog' )
+    parser.add_argument( 'database', help='name of <database>.ini and <database>.db' )
+    parser.add_argument( '--min-rows', type=int, default=MIN_ROWS, help='ignore scans of smaller tables' )
+    parser.add_argument( '--apply', action='store_true', help='create the proposed indexes' )
+    options = parser.parse_args()
+
+    advisor = Advisor( options.database, options.min_rows )
+    try:
+        advices = advisor.advise()
+        display( advices )
+        if options.apply:
+            for index in advisor.apply( advices ):
+                print 'applied: %s' % index
+            display( advisor.advise() )
+    finally:
+        advisor.close()
+    if any( advice.indexes for advice in advices ) and not options.apply:
+        sys.exit( 1 )
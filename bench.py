@@ -0,0 +1,288 @@
+#!/usr/bin/python
+
+# ##################################################
+# import
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import socket
+import sqlite3
+import urllib
+import urllib2
+import argparse
+import threading
+import subprocess
+
+import lite
+
+
+
+# ##################################################
+# settings
+
+DATABASE = 'bench'
+SCHEMA = 'test.ini'
+TABLE = 'test'
+URL = 'http://127.0.0.1:%s/' % 9999
+WORKLOAD = [
+    ( 'insert', 10 ),
+    ( 'select.one', 50 ),
+    ( 'select.all', 5 ),
+    ( 'update', 20 ),
+    ( 'upsert', 15 ),
+]
+
+
+
+# ##################################################
+# class Workload
+#   reproducible stream of catalog requests over a seeded table
+
+class Workload:
+
+    # ##################################################
+    # constructor
+
+    def __init__( self, size, page, seed ):
+        self.size = size
+        self.page = page
+        self.random = random.Random( seed )
+        self.total = sum( weight for qr, weight in WORKLOAD )
+
+    # ##################################################
+    # next
+
+    def next( self ):
+        pick = self.random.randint( 1, self.total )
+        for qr, weight in WORKLOAD:
+            pick = pick - weight
+            if pick <= 0:
+                break
+        key = 'key%s' % self.random.randint( 1, self.size )
+        parameters = { 'db': DATABASE, 'tb': TABLE, 'qr': qr }
+        if qr == 'select.one':
+            parameters[ 'oid' ] = self.random.randint( 1, self.size )
+        elif qr == 'select.all':
+            if self.page > 0:
+                parameters[ 'limit' ] = self.page
+        else:
+            parameters[ 'key' ] = key
+            parameters[ 'value' ] = 'value%s' % self.random.randint( 1, 1000000 )
+        return ( qr, parameters )
+
+
+
+# ##################################################
+# class Bench
+
+class Bench:
+
+    # ##################################################
+    # constructor
+
+    def __init__( self, options ):
+        self.options = options
+        self.latencies = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    # ##################################################
+    # seed
+    #   recreate the test.ini schema in bench.db with size rows
+
+    def seed( self ):
+        shutil.copyfile( SCHEMA, '%s.ini' % DATABASE )
+        if os.path.exists( '%s.db' % DATABASE ):
+            os.remove( '%s.db' % DATABASE )
+        if self.call( { 'db': DATABASE, 'qr': 'create' } ) is not None:
+            raise Exception( 'cannot create %s.db' % DATABASE )
+        connection = sqlite3.connect( '%s.db' % DATABASE )
+        connection.executemany( 'INSERT INTO test ( key, value ) VALUES ( ?, ? )', ( ( 'key%s' % index, 'value%s' % index ) for index in range( 1, self.options.size + 1 ) ) )
+        connection.commit()
+        connection.close()
+
+    # ##################################################
+    # cleanup
+
+    def cleanup( self ):
+        lite.pool.close()
+        lite.writer.close()
+        for name in [ '%s.ini' % DATABASE, '%s.db' % DATABASE ]:
+            if os.path.exists( name ):
+                os.remove( name )
+
+    # ##################################################
+    # call
+    #   in-process request through Usecase, returns the error if any
+
+    def call( self, parameters ):
+        response = lite.Response()
+        try:
+            with lite.Usecase( lite.Request( parameters=dict( parameters ) ), response ) as usecase:
+                usecase.execute()
+        except Exception:
+            pass
+        return None if response.success else response.error
+
+    # ##################################################
+    # fetch
+    #   http request against a running server
+
+    def fetch( self, parameters ):
+        try:
+            body = json.loads( urllib2.urlopen( '%s?%s' % ( self.options.url, urllib.urlencode( parameters ) ) ).read() )
+            return None if body.get( 'success' ) else body.get( 'error' )
+        except ( urllib2.URLError, ValueError, socket.error ), e:
+            return '%s' % e
+
+    # ##################################################
+    # record
+
+    def record( self, qr, duration, error ):
+        with self.lock:
+            self.latencies.setdefault( qr, [] ).append( duration )
+            if error is not None:
+                self.errors[ error ] = self.errors.get( error, 0 ) + 1
+
+    # ##################################################
+    # run
+    #   each client thread replays its own seeded workload
+
+    def run( self ):
+        send = self.call if self.options.target == 'inprocess' else self.fetch
+        count = self.options.requests // self.options.concurrency
+
+        def client( index ):
+            workload = Workload( self.options.size, self.options.page, self.options.seed + index )
+            for request in range( count ):
+                ( qr, parameters ) = workload.next()
+                started = time.time()
+                error = send( parameters )
+                self.record( qr, time.time() - started, error )
+
+        threads = [ threading.Thread( target=client, args=( index, ) ) for index in range( self.options.concurrency ) ]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report( time.time() - started )
+
+    # ##################################################
+    # report
+
+    def report( self, elapsed ):
+        everything = [ duration for durations in self.latencies.values() for duration in durations ]
+        result = {
+            'target': self.options.target,
+            'server': self.options.server if self.options.target == 'http' else None,
+            'size': self.options.size,
+            'requests': len( everything ),
+            'concurrency': self.options.concurrency,
+            'errors': self.errors,
+            'elapsed': round( elapsed, 3 ),
+            'rps': round( len( everything ) / elapsed, 1 ) if elapsed > 0 else 0,
+            'latency': dict( ( qr, summarize( durations ) ) for qr, durations in self.latencies.items() ),
+        }
+        result[ 'latency' ][ 'all' ] = summarize( everything )
+        return result
+
+
+
+# ##################################################
+# summarize
+#   latency percentiles in milliseconds
+
+def summarize( durations ):
+    values = sorted( durations )
+    if not values:
+        return {}
+    def percentile( rank ):
+        return round( values[ min( len( values ) - 1, int( rank * len( values ) ) ) ] * 1000, 3 )
+    return { 'count': len( values ), 'p50': percentile( 0.50 ), 'p95': percentile( 0.95 ), 'p99': percentile( 0.99 ), 'max': round( values[ -1 ] * 1000, 3 ) }
+
+# ##################################################
+# start_server
+
+def start_server( mode ):
+    server = subprocess.Popen( [ sys.executable, 'server.py', mode ], stdout=open( os.devnull, 'w' ), stderr=subprocess.STDOUT )
+    for attempt in range( 50 ):
+        try:
+            socket.create_connection( ( '127.0.0.1', 9999 ), 0.1 ).close()
+            return server
+        except socket.error:
+            time.sleep( 0.1 )
+    server.terminate()
+    raise Exception( 'server %s did not start' % mode )
+
+# ##################################################
+# display
+
+def display( result, baseline=None ):
+    print '%s%s: %s requests, concurrency %s, %s rows' % ( result[ 'target' ], ' (%s)' % result[ 'server' ] if result[ 'server' ] else '', result[ 'requests' ], result[ 'concurrency' ], result[ 'size' ] )
+    for error in sorted( result[ 'errors' ] ):
+        print '%8s x %s' % ( result[ 'errors' ][ error ], error )
+    print '%.1f req/s%s' % ( result[ 'rps' ], compare( result[ 'rps' ], baseline[ 'rps' ] if baseline else None ) )
+    print '%-12s %8s %10s %10s %10s %10s' % ( 'query', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms' )
+    for qr in sorted( result[ 'latency' ] ):
+        stats = result[ 'latency' ][ qr ]
+        reference = baseline[ 'latency' ].get( qr ) if baseline else None
+        print '%-12s %8s %10s %10s %10s %10s%s' % ( qr, stats[ 'count' ], stats[ 'p50' ], stats[ 'p95' ], stats[ 'p99' ], stats[ 'max' ], compare( stats[ 'p95' ], reference[ 'p95' ] if reference else None, ' p95' ) )
+
+# ##################################################
+# compare
+
+def compare( value, reference, label='' ):
+    if not reference:
+        return ''
+    return '  (%+.1f%%%s vs baseline)' % ( ( value - reference ) * 100.0 / reference, label )
+
+# ##################################################
+# main
+#
+#   python bench.py                               in-process through Usecase
+#   python bench.py --target http --server async  against a spawned server.py
+#   python bench.py --save baseline.json          keep results as a baseline
+#   python bench.py --compare baseline.json       report deltas to a baseline
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description='lite load-testing benchmark' )
+    parser.add_argument( '--target', choices=[ 'inprocess', 'http' ], default='inprocess' )
+    parser.add_argument( '--server', choices=[ 'wsgi', 'async', 'prefork' ], default='async', help='server.py mode spawned for http target' )
+    parser.add_argument( '--url', default=None, help='benchmark an already running server instead of spawning one' )
+    parser.add_argument( '--size', type=int, default=10000, help='rows seeded in the table' )
+    parser.add_argument( '--requests', type=int, default=5000 )
+    parser.add_argument( '--concurrency', type=int, default=1 )
+    parser.add_argument( '--page', type=int, default=100, help='limit for select.all, 0 for the whole table' )
+    parser.add_argument( '--seed', type=int, default=1 )
+    parser.add_argument( '--save', default=None )
+    parser.add_argument( '--compare', default=None )
+    options = parser.parse_args()
+    os.chdir( os.path.dirname( os.path.abspath( __file__ ) ) )
+
+    bench = Bench( options )
+    server = None
+    try:
+        bench.seed()
+        if options.target == 'http' and options.url is None:
+            options.url = URL
+            server = start_server( options.server )
+        result = bench.run()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        bench.cleanup()
+
+    baseline = None
+    if options.compare:
+        with open( options.compare ) as source:
+            baseline = json.load( source )
+    display( result, baseline )
+    if options.save:
+        with open( options.save, 'w' ) as target:
+            json.dump( result, target, sort_keys=True, indent=4, separators=( ',', ': ' ) )
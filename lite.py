@@ -4,12 +4,76 @@
 # import
 
 import sys
+import os
 import cgi
+import urlparse
 import sqlite3
 import json
 import ConfigParser
 import re
 import traceback
+import threading
+import time
+import base64
+import collections
+import contextlib
+import hashlib
+import zlib
+import random
+import atexit
+import glob
+import cProfile
+import pstats
+from StringIO import StringIO
+
+
+
+# ##################################################
+# settings
+
+POOL_SIZE = 5
+POOL_TIMEOUT = 10.0
+POOL_CACHED_STATEMENTS = 100
+WRITER_POOL_SIZE = 1
+BUSY_TIMEOUT = 0.1
+JOURNAL_MODE = 'WAL'
+MEMORY_PERSIST_INTERVAL = 60.0
+MEMORY_TICK = 1.0
+ADMISSION_CONCURRENCY = 16
+ADMISSION_QUEUE = 64
+ADMISSION_TIMEOUT = 5.0
+ADMISSION_RETRY_AFTER = 1
+BUSY_RETRY_DEADLINE = 2.0
+BUSY_RETRY_DELAY = 0.005
+BUSY_RETRY_MAX_DELAY = 0.2
+GROUP_COMMIT_SIZE = 0
+GROUP_COMMIT_WINDOW = 0.002
+ETAGS = True
+FETCH_CHUNK_SIZE = 500
+PAGE_KEY = 'oid'
+PAGE_ALIAS = '__key'
+SETTINGS_SECTION = 'lite'
+CACHE_SIZE = 0
+CACHE_TTL = 60.0
+FORMATS = [ 'columnar', 'columns' ]
+METRICS_SAMPLES = 1000
+SLOW_QUERY_THRESHOLD = 0.5
+SLOW_QUERY_LOG = None
+TRACE_REQUESTS = False
+PROFILE_REQUESTS = False
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_TOP = 20
+PROFILE_LOG = None
+CHANGES_TABLE = 'lite_changes'
+CHANGES_RETAIN = 10000
+CHANGES_LIMIT = 1000
+CHANGES_MAX_WAIT = 30.0
+CHANGES_POLL = 0.5
+CHANGES_WAITERS = 4
+STREAMS = { 'json': 'text/json', 'ndjson': 'application/x-ndjson' }
+ENCODINGS = [ ( 'gzip', 16 + zlib.MAX_WBITS ), ( 'deflate', zlib.MAX_WBITS ) ]
+COMPRESSION_LEVEL = 6
+COMPRESSION_MIN_SIZE = 1024
 
 
 
@@ -21,23 +85,160 @@ class Query:
     # ##################################################
     # constructor
     
-    def __init__( self, sql=None, parameters=None, fetch_one=None, fetch_all=None, fetch_oid=None, fetch_nb=None ):
+    def __init__( self, sql=None, parameters=None, fetch_one=None, fetch_all=None, fetch_oid=None, fetch_nb=None, kind=None, rows=None ):
         self.sql = sql
         self.parameters = parameters or []
+        self.kind = kind
+        self.tables = []
+        self.rows = rows
         self.fetch_one = ( fetch_one == True )
         self.fetch_all = ( fetch_all == True )
         self.fetch_oid = ( fetch_oid == True )
         self.fetch_nb = ( fetch_nb == True )
+        self.page_key = None
+        self.limit = None
+        self.window = None
+
+    # ##################################################
+    # execute_row
+    #   bulk mode: execute with the parameters of one row
+    
+    def execute_row( self, database, index ):
+        database.execute_query( self.sql, *self.rows[ index ] )
+
+    # ##################################################
+    # execute_many
+    #   bulk mode: execute with the parameters of rows[ start: ]
+    
+    def execute_many( self, database, start=0 ):
+        database.execute_many( self.sql, self.rows[ start: ] )
+
+    # ##################################################
+    # paginate
+    #   keyset pagination: rows strictly after the cursor, ordered by
+    #   page_key, so deep pages use the same index lookup as the first;
+    #   SELECT * leaves the rowid out, so the default key of a plain
+    #   single-table select is selected as PAGE_ALIAS (then stripped)
+    
+    def paginate( self, page_key, limit=None, after=None ):
+        if limit is None and after is None:
+            return
+        sql = self.sql
+        if page_key == PAGE_KEY and len( self.tables ) == 1 and ROWID_SELECT_REGEXP.match( sql ) and ROWID_EXCLUDE_REGEXP.search( sql ) is None:
+            sql = ROWID_SELECT_REGEXP.sub( 'SELECT %s AS %s, ' % ( page_key, PAGE_ALIAS ), sql, 1 )
+            page_key = PAGE_ALIAS
+        self.page_key = page_key
+        sql = 'SELECT * FROM ( %s )' % sql
+        if after is not None:
+            sql = '%s WHERE %s > ?' % ( sql, page_key )
+            self.parameters.append( decode_cursor( after ) )
+        sql = '%s ORDER BY %s' % ( sql, page_key )
+        if limit is not None:
+            try:
+                self.limit = int( limit )
+            except ValueError:
+                self.limit = 0
+            if self.limit <= 0:
+                raise Exception( 'invalid limit %s' % limit )
+            sql = '%s LIMIT ?' % sql
+            # one extra row tells whether there is a next page
+            self.parameters.append( self.limit + 1 )
+        self.sql = sql
+
+    # ##################################################
+    # fan_out
+    #   the copy run by every shard of a fan-out read: a trailing LIMIT
+    #   count OFFSET offset becomes LIMIT offset + count on each shard and
+    #   window keeps ( offset, count ) to cut the merged rows
+    
+    def fan_out( self ):
+        match = LIMIT_REGEXP.search( self.sql or '' ) if self.fetch_all and self.page_key is None else None
+        if match is None:
+            return self
+        ( first, separator, second ) = match.groups()
+        terms = [ first ] if second is None else [ first, second ]
+        start = len( self.parameters ) - terms.count( '?' )
+        values = list( self.parameters[ start: ] )
+        try:
+            terms = [ int( values.pop( 0 ) if term == '?' else term ) for term in terms ]
+        except ( TypeError, ValueError ):
+            raise Exception( 'invalid limit in %s' % self.sql )
+        if separator == ',':
+            terms.reverse()
+        # like sqlite, a negative count means no limit and a negative offset none
+        ( count, offset ) = ( terms + [ 0 ] )[ :2 ]
+        offset = max( offset, 0 )
+        sql = self.sql[ :match.start() ].rstrip()
+        if count >= 0:
+            sql = '%s LIMIT %d' % ( sql, offset + count )
+        query = Query( sql=sql, parameters=self.parameters[ :start ], fetch_one=self.fetch_one, fetch_all=self.fetch_all, fetch_oid=self.fetch_oid, fetch_nb=self.fetch_nb, kind=self.kind )
+        query.tables = self.tables
+        self.window = ( offset, count )
+        return query
+
+    # ##################################################
+    # page
+    #   NULL keys are rejected: they sort first and no cursor can follow
+    #   them; the PAGE_ALIAS column is stripped unless the rows are still
+    #   to be merged across shards
+    
+    def page( self, chunks, response, names, arrays=False ):
+        if self.page_key not in names:
+            raise Exception( 'missing column %s for pagination' % self.page_key )
+        index = names.index( self.page_key )
+        value = ( lambda row: row[ index ] ) if arrays else ( lambda row: row.get( self.page_key ) )
+        strip = ( self.page_key == PAGE_ALIAS and not response.keeps_page_key() )
+        count = 0
+        last = None
+        for chunk in chunks:
+            more = ( self.limit is not None and count + len( chunk ) > self.limit )
+            if more:
+                chunk = chunk[ : self.limit - count ]
+            if any( value( row ) is None for row in chunk ):
+                raise Exception( 'null value of page key %s for pagination' % self.page_key )
+            if chunk:
+                last = value( chunk[ -1 ] )
+            if more:
+                response[ 'next' ] = encode_cursor( last )
+            count = count + len( chunk )
+            if strip:
+                for row in chunk:
+                    if arrays:
+                        del row[ index ]
+                    else:
+                        del row[ PAGE_ALIAS ]
+            if chunk:
+                yield chunk
+            if more:
+                break
         
     # ##################################################
     # execute
     
     def execute( self, database, response ):
         
-        # print '[sql] %s %s' % ( self.sql, self.parameters )
-        
         # execute query 
-        database.execute_query( self.sql, *self.parameters )
+        started = time.time()
+        with database.trace.phase( 'execute' ):
+            database.execute_query( self.sql, *self.parameters )
+        
+        # fetch results
+        with database.trace.phase( 'fetch' ):
+            self.fetch( database, response )
+        
+        # log slow query with its plan
+        duration = time.time() - started
+        if duration > SLOW_QUERY_THRESHOLD:
+            try:
+                plan = database.explain( self.sql, *self.parameters )
+            except sqlite3.Error, e:
+                plan = [ '%s' % e ]
+            metrics.log_slow_query( database.trace, duration, self.sql, self.parameters, plan )
+
+    # ##################################################
+    # fetch
+    
+    def fetch( self, database, response ):
         
         # fetch oid
         if self.fetch_oid:
@@ -47,380 +248,2895 @@ class Query:
         if self.fetch_nb:
             response[ 'nb' ] = database.fetch_nb()
         
+        # columnar formats send column names once
+        fmt = response.get_format()
+        arrays = fmt is not None and ( self.fetch_one or self.fetch_all )
+        if arrays:
+            columns = database.fetch_columns()
+            if self.page_key == PAGE_ALIAS and not response.keeps_page_key():
+                columns = [ column for column in columns if column != PAGE_ALIAS ]
+            response[ 'columns' ] = columns
+        
         # fetch one row
         if self.fetch_one:
-            response[ 'row' ] = database.fetch_one()
+            response[ 'row' ] = database.fetch_one( arrays=arrays )
         
         # fetch all rows
-        if self.fetch_all:
-            response[ 'rows' ] = database.fetch_all()
+        elif self.fetch_all:
+            chunks = database.fetch_chunks( arrays=arrays )
+            if self.page_key is not None:
+                chunks = self.page( chunks, response, database.fetch_columns(), arrays )
+            if fmt == 'columns':
+                rows = [ row for chunk in chunks for row in chunk ]
+                response[ 'values' ] = [ list( values ) for values in zip( *rows ) ] if rows else [ [] for column in columns ]
+            else:
+                response.stream( 'rows', chunks )
 
 
 
 # ##################################################
-# class Database
+# encode_cursor
+
+def encode_cursor( value ):
+    return base64.urlsafe_b64encode( json.dumps( value ) ).rstrip( '=' )
+
+# ##################################################
+# decode_cursor
+
+def decode_cursor( cursor ):
+    try:
+        return json.loads( base64.urlsafe_b64decode( cursor + '=' * ( -len( cursor ) % 4 ) ) )
+    except ( TypeError, ValueError ):
+        raise Exception( 'invalid cursor %s' % cursor )
+
+# ##################################################
+# encode_blob
+#   blobs travel as { "blob": base64 }, both ways
+
+def encode_blob( value ):
+    if isinstance( value, buffer ):
+        return { 'blob': base64.b64encode( value ) }
+    raise TypeError( '%r is not JSON serializable' % ( value, ) )
+
+# ##################################################
+# copy_data
+#   copy of the dicts and lists of response data, values are shared
+
+def copy_data( value ):
+    if isinstance( value, dict ):
+        return dict( ( key, copy_data( item ) ) for key, item in value.items() )
+    if isinstance( value, list ):
+        return [ copy_data( item ) for item in value ]
+    return value
+
+
+
+# ##################################################
+# class Memory
+#   [lite] memory = yes keeps <db> in a shared in-memory database loaded
+#   from <db>.db on first use; committed changes reach <db>.db only when
+#   persisted, every memory.persist seconds (0: never) and at exit, as an
+#   atomic snapshot (written aside then renamed). Writes since the last
+#   snapshot are lost on a crash, and <db>.db must not be written by
+#   anyone else. Each process would hold its own copy and lose the writes
+#   of the others, so memory = yes is ignored (databases stay on disk)
+#   under cgi, prefork or any multiprocess or run once wsgi server
+
+class Memory:
 
-class Database:
-    
     # ##################################################
     # constructor
     
-    def __init__( self, name ):
-        self.name = name
-        self.connection = None
+    def __init__( self, tick=MEMORY_TICK ):
+        self.tick = tick
+        self.anchors = {}
+        self.intervals = {}
+        self.versions = {}
+        self.persisted = {}
+        self.thread = None
+        self.enabled = True
+        self.lock = threading.RLock()
 
     # ##################################################
-    # set up
+    # uri
+    #   None for databases kept on disk
     
-    def __enter__( self ):
-        self.connect()
-        return self
+    def uri( self, name ):
+        with self.lock:
+            if not self.enabled:
+                return None
+            if name not in self.anchors:
+                interval = catalog.memory( name )
+                if interval is None:
+                    return None
+                self.load( name, interval )
+            return self.filename( name )
 
     # ##################################################
-    # tear dow
-      
-    def __exit__( self, type, value, traceback ):
-        if self.connection is not None:
-            if value is not None:
-                self.rollback()
-            else:
-                self.commit()
-            self.disconnect()
+    # preload
+    #   load the in-memory databases of the current directory up front
+    
+    def preload( self ):
+        names = []
+        for config_file in sorted( glob.glob( '*.ini' ) ):
+            name = os.path.splitext( config_file )[0]
+            if catalog.memory( name ) is not None:
+                self.uri( name )
+                names.append( name )
+        return names
 
     # ##################################################
-    # connect
+    # filename
     
-    def connect( self ):
-        if self.name is None:
-            raise Exception( 'missing database name' )
-        self.connection = sqlite3.connect( '%s.db' % self.name )
+    def filename( self, name ):
+        return 'file:lite-%s?mode=memory&cache=shared' % name
 
     # ##################################################
-    # disconnect
+    # load
+    #   the anchor connection keeps the shared memory database alive
     
-    def disconnect( self ):
-        if self.connection is not None:
-            self.connection.close()
-        self.connection = None
+    def load( self, name, interval ):
+        anchor = sqlite3.connect( self.filename( name ), check_same_thread=False )
+        if anchor.execute( 'PRAGMA database_list' ).fetchone()[2]:
+            anchor.close()
+            if os.path.exists( self.filename( name ) ):
+                os.remove( self.filename( name ) )
+            raise Exception( 'memory database %s needs sqlite uri filenames' % name )
+        disk = sqlite3.connect( '%s.db' % name )
+        try:
+            anchor.executescript( '\n'.join( disk.iterdump() ) )
+        finally:
+            disk.close()
+        self.anchors[ name ] = anchor
+        self.intervals[ name ] = interval
+        self.versions[ name ] = anchor.execute( 'PRAGMA data_version' ).fetchone()[0]
+        self.persisted[ name ] = time.time()
+        if self.thread is None:
+            self.thread = threading.Thread( target=self.run )
+            self.thread.daemon = True
+            self.thread.start()
+            atexit.register( self.close )
 
     # ##################################################
-    # commit
+    # run
+    
+    def run( self ):
+        while True:
+            time.sleep( self.tick )
+            with self.lock:
+                names = [ name for name in self.anchors if 0 < self.intervals[ name ] <= time.time() - self.persisted[ name ] ]
+            for name in names:
+                try:
+                    self.persist( name )
+                except Exception:
+                    traceback.print_exc()
 
-    def commit( self ):
-        if self.connection is not None:
-            self.connection.commit()
+    # ##################################################
+    # persist
+    #   only when something was committed since the last snapshot
+    
+    def persist( self, name ):
+        with self.lock:
+            anchor = self.anchors[ name ]
+            self.persisted[ name ] = time.time()
+            version = anchor.execute( 'PRAGMA data_version' ).fetchone()[0]
+            if version == self.versions[ name ]:
+                return False
+            target = '%s.db' % name
+            temporary = '%s.tmp' % target
+            if os.path.exists( temporary ):
+                os.remove( temporary )
+            try:
+                anchor.execute( "VACUUM INTO '%s'" % temporary.replace( "'", "''" ) )
+            except sqlite3.OperationalError:
+                # sqlite older than 3.27
+                copy = sqlite3.connect( temporary )
+                try:
+                    copy.executescript( '\n'.join( anchor.iterdump() ) )
+                finally:
+                    copy.close()
+            try:
+                os.rename( temporary, target )
+            except OSError:
+                # windows does not rename onto an existing file
+                os.remove( target )
+                os.rename( temporary, target )
+            self.versions[ name ] = version
+            return True
 
     # ##################################################
-    # rollback
+    # close
     
-    def rollback( self ):
-        if self.connection is not None:
-            self.connection.rollback()
+    def close( self ):
+        with self.lock:
+            for name in self.anchors.keys():
+                try:
+                    self.persist( name )
+                except Exception:
+                    traceback.print_exc()
+                self.anchors.pop( name ).close()
 
     # ##################################################
-    # execute_query
+    # disable
+    #   for processes that are not the only long-lived one
+    
+    def disable( self ):
+        with self.lock:
+            self.enabled = False
+            self.close()
+
+memory = Memory()
 
-    def execute_query( self, query, *args ):
-        if self.connection is None:
-            raise Exception( 'database not connected' )
-        
-        self.cursor = self.connection.cursor()
-        
-        if len( args ) > 0:
-            self.cursor.execute( query, args )
-        else:
-            self.cursor.execute( query )
+
+
+# ##################################################
+# class Pool
+#   readonly pools open mode=ro uri connections (or query_only ones when
+#   this sqlite build does not parse uri filenames), the others switch
+#   the database to JOURNAL_MODE so readers do not block on the writer
+
+class Pool:
 
     # ##################################################
-    # execute_script
+    # constructor
+    
+    def __init__( self, size=POOL_SIZE, timeout=POOL_TIMEOUT, cached_statements=POOL_CACHED_STATEMENTS, readonly=False ):
+        self.size = size
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self.readonly = readonly
+        self.uri = None
+        self.idle = {}
+        self.used = {}
+        self.condition = threading.Condition()
 
-    def execute_script( self, script, *args ):
-        if self.connection is None:
-            raise Exception( 'database not connected' )
-        
-        self.cursor = self.connection.cursor()
-        
-        if len( args ) > 0:
-            self.cursor.execute( script, args )
-            # self.cursor.executescript( script )
-        else:
-            self.cursor.executescript( script )
+    # ##################################################
+    # acquire
+    #   borrow an idle connection (health checked) or open a new one,
+    #   waiting up to timeout when size connections are already in use
+    
+    def acquire( self, name ):
+        deadline = time.time() + self.timeout
+        with self.condition:
+            while self.used.get( name, 0 ) >= self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Exception( 'no connection available for database %s' % name )
+                self.condition.wait( remaining )
+            self.used[ name ] = self.used.get( name, 0 ) + 1
+            idle = self.idle.get( name )
+            connection = idle.pop() if idle else None
+        try:
+            if connection is not None and not self.check( connection ):
+                connection = None
+            if connection is None:
+                connection = self.connect( name )
+            if not self.readonly:
+                feed.install( name, connection )
+        except:
+            self.release( name, connection )
+            raise
+        return connection
 
     # ##################################################
-    # fetch_oid
+    # release
+    #   reset any open transaction before handing the connection back
+    
+    def release( self, name, connection ):
+        if connection is not None:
+            try:
+                connection.rollback()
+            except sqlite3.Error:
+                self.close_connection( connection )
+                connection = None
+        with self.condition:
+            self.used[ name ] = self.used.get( name, 1 ) - 1
+            if connection is not None:
+                self.idle.setdefault( name, [] ).append( connection )
+            self.condition.notify()
 
-    def fetch_oid( self ):
-        if self.cursor is None:
-            raise Exception( 'query not executed' )
-        
-        return self.cursor.lastrowid
+    # ##################################################
+    # connect
+    
+    def connect( self, name ):
+        uri = memory.uri( name )
+        if uri is not None:
+            connection = self.open( uri )
+            if self.readonly:
+                connection.execute( 'PRAGMA query_only = 1' )
+            return connection
+        if not self.readonly:
+            connection = self.open( '%s.db' % name )
+            if JOURNAL_MODE:
+                connection.execute( 'PRAGMA journal_mode = %s' % JOURNAL_MODE ).fetchone()
+            return connection
+        if self.uri is not False:
+            connection = self.open_uri( name )
+            if connection is not None:
+                return connection
+        connection = self.open( '%s.db' % name )
+        connection.execute( 'PRAGMA query_only = 1' )
+        return connection
 
     # ##################################################
-    # fetch_nb
+    # open
+    
+    def open( self, filename ):
+        return sqlite3.connect( filename, timeout=BUSY_TIMEOUT, cached_statements=self.cached_statements, check_same_thread=False )
 
-    def fetch_nb( self ):
-        if self.cursor is None:
-            raise Exception( 'query not executed' )
-        
-        if self.cursor.rowcount >= 0:
-            return self.cursor.rowcount
+    # ##################################################
+    # open_uri
+    #   without uri support sqlite creates a file named after the uri:
+    #   remove it and remember to fall back on query_only connections
+    
+    def open_uri( self, name ):
+        filename = 'file:%s.db?mode=ro' % name
+        connection = self.open( filename )
+        path = connection.execute( 'PRAGMA database_list' ).fetchone()[2]
+        if not path.endswith( filename ):
+            self.uri = True
+            return connection
+        self.close_connection( connection )
+        if os.path.exists( filename ):
+            os.remove( filename )
+        self.uri = False
         return None
 
     # ##################################################
-    # fetch_one
+    # check
+    
+    def check( self, connection ):
+        try:
+            connection.execute( 'SELECT 1' ).fetchone()
+            return True
+        except sqlite3.Error:
+            self.close_connection( connection )
+            return False
 
-    def fetch_one( self ):
-        if self.cursor is None:
-            raise Exception( 'query not executed' )
-        
-        if self.cursor.description is None:
-            raise Exception( 'query failed' )
-        
-        row = self.cursor.fetchone()
-        if row is None:
-            raise Exception( 'row not found' )
-            
-        item = {}
-        keys = [ column[0] for column in self.cursor.description ]
-        index = 0
-        for value in row:
-            if value is not None:
-                item[ keys[ index ] ] = value
-            index = index + 1
-        return item
+    # ##################################################
+    # close_connection
+    
+    def close_connection( self, connection ):
+        try:
+            connection.close()
+        except sqlite3.Error:
+            pass
 
     # ##################################################
-    # fetch_all
+    # close
     
-    def fetch_all( self ):
-        if self.cursor is None:
-            raise Exception( 'query not executed' )
-        
-        if self.cursor.description is None:
-            raise Exception( 'query failed' )
-        
-        items = []
-        keys = [ column[0] for column in self.cursor.description ]
-        for row in self.cursor.fetchall():
-            item = {}
-            index = 0
-            for value in row:
-                if value is not None:
-                    item[ keys[ index ] ] = value
-                index = index + 1
-            items.append( item )
-        
-        return items
+    def close( self ):
+        with self.condition:
+            idle = self.idle
+            self.idle = {}
+        for connections in idle.values():
+            for connection in connections:
+                self.close_connection( connection )
+
+pool = Pool( readonly=True )
+writer = Pool( size=WRITER_POOL_SIZE )
 
 
 
 # ##################################################
-# class Request
+# class Overloaded
 
-class Request:
+class Overloaded( Exception ):
 
     # ##################################################
     # constructor
     
-    def __init__( self ):
-        self.parameters = cgi.FieldStorage()
-        self.database = None
-        self.table = None
-        self.multi = False
-        self.queries = []
+    def __init__( self, message, retry_after=ADMISSION_RETRY_AFTER ):
+        Exception.__init__( self, message )
+        self.retry_after = retry_after
+
+
+
+# ##################################################
+# class Admission
+#   at most concurrency requests per database run at once and at most
+#   queue others wait for a slot: beyond that (or after timeout) requests
+#   are turned away at once rather than piling up behind the writer
+
+class Admission:
 
     # ##################################################
-    # get_parameter
+    # constructor
+    
+    def __init__( self, concurrency=ADMISSION_CONCURRENCY, queue=ADMISSION_QUEUE, timeout=ADMISSION_TIMEOUT ):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.timeout = timeout
+        self.active = {}
+        self.waiting = {}
+        self.rejected = {}
+        self.condition = threading.Condition()
 
-    def get_parameter( self, key, mandatory=True ):
-        if key not in self.parameters:
-            if mandatory:
-                raise Exception( 'missing parameter %s in request' % key )
-            return None
-        return self.parameters[ key ].value
+    # ##################################################
+    # admit
+    
+    @contextlib.contextmanager
+    def admit( self, name ):
+        if self.concurrency <= 0:
+            yield
+            return
+        self.acquire( name )
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active[ name ] = self.active[ name ] - 1
+                self.condition.notify()
 
     # ##################################################
-    # build_query
+    # acquire
     
-    def build_query( self ):
-        
-        # extract context
-        self.database = self.get_parameter( 'db' )
-        self.table = self.get_parameter( 'tb', False )
-        sql_query_id = self.get_parameter( 'qr' )
-        
-        # extract sql_query from config file
-        config_file = '%s.ini' % self.database
-        config = ConfigParser.ConfigParser()
-        config.read( config_file )
-        section = self.table or 'DEFAULT'
-        if section.upper() != 'DEFAULT' and not config.has_section( section ):
-            raise Exception( 'missing section %s in %s' % ( section, config_file ) )
-        option = sql_query_id
-        if not config.has_option( section, option ):
-            raise Exception( 'missing option %s in section %s in %s' % ( option, section, config_file ) )
-        sql = config.get( section, option )
-        if sql is None:
-            raise Exception( 'missing option %s in section %s in %s' % ( option, section, config_file ) )
-        
-        sql_queries = [ s.strip() for s in sql.split( ';' ) if s.strip() != '' ]
-        self.multi = ( len( sql_queries ) > 1 )
-        for sql_query in sql_queries:
-            # extract sql_parameters from request
-            sql_parameters = []
-            regexp = re.compile( '%(\w*)%' )
-            match = regexp.search( sql_query )
-            while match:
-                key = match.group(1)
-                if key in [ 'db', 'tb' ]:
-                    value = self.get_parameter( key )
-                    sql_query = regexp.sub( value, sql_query, 1 )
-                else:
-                    value = self.get_parameter( key, False )
-                    sql_parameters.append( value )
-                    sql_query = regexp.sub( '?', sql_query, 1 )
-                match = regexp.search( sql_query )
-            
-            # extract sql_fetch
-            ( sql_query, fetch_one ) = self.extract_sql_fetch( sql_query, 'one', [] )
-            ( sql_query, fetch_all ) = self.extract_sql_fetch( sql_query, 'all', [ 'SELECT' ] )
-            ( sql_query, fetch_oid ) = self.extract_sql_fetch( sql_query, 'oid', [ 'INSERT' ] )
-            ( sql_query, fetch_nb ) = self.extract_sql_fetch( sql_query, 'nb', [ 'UPDATE', 'DELETE' ] ) 
-            
-            if self.multi:
-                fetch_one = False
-                fetch_all = False
-                fetch_oid = False
-                fetch_nb = False
-                
-            fetch_all = fetch_all and not fetch_one
-            
-            # build query
-            self.queries.append( Query( sql=sql_query, parameters=sql_parameters, fetch_one=fetch_one, fetch_all=fetch_all, fetch_oid=fetch_oid, fetch_nb=fetch_nb ) )
+    def acquire( self, name ):
+        deadline = time.time() + self.timeout
+        with self.condition:
+            if self.active.get( name, 0 ) >= self.concurrency:
+                if self.waiting.get( name, 0 ) >= self.queue:
+                    self.reject( name )
+                self.waiting[ name ] = self.waiting.get( name, 0 ) + 1
+                try:
+                    while self.active.get( name, 0 ) >= self.concurrency:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self.reject( name )
+                        self.condition.wait( remaining )
+                finally:
+                    self.waiting[ name ] = self.waiting[ name ] - 1
+            self.active[ name ] = self.active.get( name, 0 ) + 1
 
     # ##################################################
-    # extract_sql_fetch
+    # reject
+    
+    def reject( self, name ):
+        self.rejected[ name ] = self.rejected.get( name, 0 ) + 1
+        raise Overloaded( 'database %s overloaded' % name )
+
+    # ##################################################
+    # stats
+    
+    def stats( self ):
+        with self.condition:
+            return dict( ( name, {
+                'active': self.active.get( name, 0 ),
+                'waiting': self.waiting.get( name, 0 ),
+                'rejected': self.rejected.get( name, 0 ),
+            } ) for name in set( self.active ) | set( self.rejected ) )
+
+admission = Admission()
 
-    def extract_sql_fetch( self, sql_query, fetch_id, sql_query_types ):
-        
-        # extract sql_fetch from fetch_id
-        regexp = re.compile( '\s*\|\s*%s\s*' % ( fetch_id ), re.IGNORECASE )
-        if regexp.search( sql_query ):
-            sql_query = regexp.sub( '', sql_query )
-            return ( sql_query, True )
-        
-        # extract sql_fetch from sql_query_types
-        if len( sql_query_types ) > 0 :
-            regexp = re.compile( '^\s*(%s)\s*' % ( '|'.join( sql_query_types ) ), re.IGNORECASE )
-            if regexp.search( sql_query ):
-                return ( sql_query, True )
-        
-        return ( sql_query, False )
 
 
-        
 # ##################################################
-# class Response
+# class Cache
 
-class Response:
+class Cache:
 
     # ##################################################
     # constructor
+    #   lru of read results keyed by database, resolved sql and parameters;
+    #   versions per ( database, table ) keep a read that raced with a
+    #   write from storing a stale result. Only writes of this process
+    #   invalidate entries, so the cache is off under cgi, prefork or any
+    #   multiprocess or run once wsgi server
     
-    def __init__( self ):
-        pass
+    def __init__( self, size=CACHE_SIZE, ttl=CACHE_TTL ):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
 
     # ##################################################
-    # set
+    # snapshot
     
-    def __setitem__( self, key, value ):
-        self.__dict__[ key ] = value
+    def snapshot( self, database, tables ):
+        with self.lock:
+            return self.get_versions( database, tables )
 
     # ##################################################
-    # dump_header
+    # get_versions
     
-    def dump_header( self ):
-        pass
+    def get_versions( self, database, tables ):
+        return tuple( self.versions.get( ( database, table ), 0 ) for table in [ None ] + sorted( tables ) )
 
     # ##################################################
-    # dump
+    # get
     
-    def dump( self ):
-        pass
-
+    def get( self, key ):
+        with self.lock:
+            entry = self.entries.pop( key, None )
+            if entry is None or entry[0] < time.time():
+                self.misses = self.misses + 1
+                return None
+            self.entries[ key ] = entry
+            self.hits = self.hits + 1
+            return copy_data( entry[3] )
 
+    # ##################################################
+    # put
+    
+    def put( self, key, value, database, tables, versions ):
+        with self.lock:
+            if self.get_versions( database, tables ) != versions:
+                return
+            self.entries.pop( key, None )
+            self.entries[ key ] = ( time.time() + self.ttl, database, set( tables ), copy_data( value ) )
+            while len( self.entries ) > self.size:
+                self.entries.popitem( last=False )
+                self.evictions = self.evictions + 1
 
-# ##################################################
-# class JsonResponse
+    # ##################################################
+    # invalidate
+    #   drop entries reading any of tables, or every entry of the
+    #   database when tables is None
+    
+    def invalidate( self, database, tables=None ):
+        with self.lock:
+            for table in ( [ None ] if tables is None else tables ):
+                self.versions[ ( database, table ) ] = self.versions.get( ( database, table ), 0 ) + 1
+            for key, entry in self.entries.items():
+                if entry[1] == database and ( tables is None or not entry[2].isdisjoint( tables ) ):
+                    del self.entries[ key ]
+                    self.invalidations = self.invalidations + 1
 
-class JsonResponse( Response ):
+    # ##################################################
+    # clear
+    
+    def clear( self ):
+        with self.lock:
+            self.entries.clear()
 
     # ##################################################
-    # header
+    # disable
+    #   for processes that are not the only long-lived one
     
-    def dump_header( self ):
-        print 'Content-Type: text/json'
-        print
+    def disable( self ):
+        with self.lock:
+            self.size = 0
+            self.entries.clear()
 
     # ##################################################
-    # dump_body
+    # stats
     
-    def dump( self ):
-        print json.dumps( self.__dict__, sort_keys=True, indent=4, separators=( ',', ': ' ) )
+    def stats( self ):
+        with self.lock:
+            return {
+                'size': self.size,
+                'ttl': self.ttl,
+                'entries': len( self.entries ),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+cache = Cache()
 
 
 
 # ##################################################
-# class Usecase
+# class Probe
+#   one idle connection per database whose data_version changes whenever
+#   another connection commits; the value is only meaningful for that
+#   connection, hence the nonce renewed with each process (and each fork)
 
-class Usecase:
+class Probe:
 
     # ##################################################
     # constructor
     
+    def __init__( self ):
+        self.pid = None
+        self.nonce = None
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    # ##################################################
+    # version
+    
+    def version( self, name ):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.nonce = '%x.%x' % ( self.pid, int( time.time() * 1000000 ) )
+                self.connections = {}
+            connection = self.connections.get( name )
+            if connection is None:
+                connection = pool.connect( name )
+                self.connections[ name ] = connection
+            return '%s.%s' % ( self.nonce, connection.execute( 'PRAGMA data_version' ).fetchone()[0] )
+
+    # ##################################################
+    # close
+    
+    def close( self ):
+        with self.lock:
+            connections = self.connections
+            self.connections = {}
+        for connection in connections.values():
+            pool.close_connection( connection )
+
+probe = Probe()
+
+
+
+# ##################################################
+# class Feed
+#   change log of the tables listed in the [lite] changes option: triggers
+#   record the oid of every inserted, updated or deleted row under an
+#   autoincrement seq (never reused, even once compacted) and a trigger
+#   on the log itself only keeps its last changes.retain rows
+
+class Feed:
+
+    # ##################################################
+    # constructor
+    
+    def __init__( self, waiters=CHANGES_WAITERS ):
+        self.installed = {}
+        self.versions = {}
+        self.listeners = set()
+        self.slots = threading.Semaphore( waiters )
+        self.condition = threading.Condition()
+
+    # ##################################################
+    # install
+    #   called on each writer connection acquired: a no-op until the
+    #   schema or the settings change; tables created later get their
+    #   triggers on the next acquire
+    
+    def install( self, name, connection ):
+        changes = catalog.changes( name )
+        if changes is None and name not in self.installed:
+            return
+        version = connection.execute( 'PRAGMA schema_version' ).fetchone()[0]
+        if self.installed.get( name ) == ( version, changes ):
+            return
+        tables = set( row[0] for row in connection.execute( "SELECT name FROM sqlite_master WHERE type = 'table'" ) )
+        wanted = self.triggers( changes, tables ) if changes is not None else {}
+        existing = set( row[0] for row in connection.execute( "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE '%s%%'" % CHANGES_TABLE ) )
+        if wanted:
+            connection.execute( 'CREATE TABLE IF NOT EXISTS %s ( seq INTEGER PRIMARY KEY AUTOINCREMENT, tb TEXT NOT NULL, op TEXT NOT NULL, oid INTEGER NOT NULL )' % CHANGES_TABLE )
+            connection.execute( 'CREATE INDEX IF NOT EXISTS %s_tb ON %s ( tb, seq )' % ( CHANGES_TABLE, CHANGES_TABLE ) )
+        for trigger in existing - set( wanted ):
+            connection.execute( 'DROP TRIGGER IF EXISTS %s' % trigger )
+        for trigger in set( wanted ) - existing:
+            connection.execute( wanted[ trigger ] )
+        connection.commit()
+        self.installed[ name ] = ( connection.execute( 'PRAGMA schema_version' ).fetchone()[0], changes )
+
+    # ##################################################
+    # triggers
+    #   sql by trigger name, the retain count is part of the name so that
+    #   a new setting replaces the compaction trigger
+    
+    def triggers( self, changes, tables ):
+        ( names, retain ) = changes
+        triggers = {}
+        record = 'INSERT INTO %s ( tb, op, oid ) SELECT \'%%s\', \'%%s\', %%s' % CHANGES_TABLE
+        for table in names:
+            if table not in tables:
+                continue
+            trigger = '%s_%s_%%s' % ( CHANGES_TABLE, table )
+            triggers[ trigger % 'insert' ] = 'CREATE TRIGGER IF NOT EXISTS %s AFTER INSERT ON %s BEGIN %s; END' % ( trigger % 'insert', table, record % ( table, 'insert', 'NEW.oid' ) )
+            triggers[ trigger % 'update' ] = 'CREATE TRIGGER IF NOT EXISTS %s AFTER UPDATE ON %s BEGIN %s WHERE OLD.oid != NEW.oid; %s; END' % ( trigger % 'update', table, record % ( table, 'delete', 'OLD.oid' ), record % ( table, 'update', 'NEW.oid' ) )
+            triggers[ trigger % 'delete' ] = 'CREATE TRIGGER IF NOT EXISTS %s AFTER DELETE ON %s BEGIN %s; END' % ( trigger % 'delete', table, record % ( table, 'delete', 'OLD.oid' ) )
+        if triggers:
+            trigger = '%s_retain_%s' % ( CHANGES_TABLE, retain )
+            triggers[ trigger ] = 'CREATE TRIGGER IF NOT EXISTS %s AFTER INSERT ON %s BEGIN DELETE FROM %s WHERE seq <= NEW.seq - %s; END' % ( trigger, CHANGES_TABLE, CHANGES_TABLE, retain )
+        return triggers
+
+    # ##################################################
+    # read
+    #   changes of table after since with the current row (None once
+    #   deleted); the high-water mark is read first so that the seq
+    #   returned never skips a change committed meanwhile, and reset asks
+    #   the client to resync when changes after since were compacted
+    
+    def read( self, database, table, since, limit ):
+        connection = database.connection
+        if connection.execute( "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", ( CHANGES_TABLE, ) ).fetchone() is None:
+            return ( [], 0, since > 0 )
+        row = connection.execute( "SELECT seq FROM sqlite_sequence WHERE name = ?", ( CHANGES_TABLE, ) ).fetchone()
+        high = row[0] if row else 0
+        cursor = connection.execute( 'SELECT c.seq, c.op, c.oid, t.* FROM %s c LEFT JOIN %s t ON t.oid = c.oid WHERE c.tb = ? AND c.seq > ? ORDER BY c.seq LIMIT ?' % ( CHANGES_TABLE, table ), ( table, since, limit ) )
+        columns = [ description[0] for description in cursor.description[ 3: ] ]
+        changes = []
+        for row in cursor.fetchall():
+            current = dict( zip( columns, row[ 3: ] ) ) if row[ 3: ] and any( value is not None for value in row[ 3: ] ) else None
+            changes.append( { 'seq': row[0], 'op': row[1], 'oid': row[2], 'row': current } )
+        oldest = connection.execute( 'SELECT MIN( seq ) FROM %s' % CHANGES_TABLE ).fetchone()[0]
+        if since > high or since < ( oldest if oldest is not None else high + 1 ) - 1:
+            return ( [], high, True )
+        if changes and len( changes ) >= limit:
+            return ( changes, changes[ -1 ][ 'seq' ], False )
+        return ( changes, max( [ high ] + [ change[ 'seq' ] for change in changes ] ), False )
+
+    # ##################################################
+    # version
+    
+    def version( self, name ):
+        with self.condition:
+            return self.versions.get( name, 0 )
+
+    # ##################################################
+    # listen
+    #   callback( name ) on each write of this process, e.g. to wake the
+    #   polls a server parked
+    
+    def listen( self, callback ):
+        with self.condition:
+            self.listeners.add( callback )
+
+    # ##################################################
+    # notify
+    #   wake long polls up as soon as a write of this process commits,
+    #   writes of other processes are seen on the next CHANGES_POLL
+    
+    def notify( self, name ):
+        with self.condition:
+            self.versions[ name ] = self.versions.get( name, 0 ) + 1
+            self.condition.notify_all()
+            listeners = list( self.listeners )
+        for listener in listeners:
+            listener( name )
+
+    # ##################################################
+    # wait
+    
+    def wait( self, name, version, deadline ):
+        with self.condition:
+            remaining = deadline - time.time()
+            if remaining > 0 and self.versions.get( name, 0 ) == version:
+                self.condition.wait( remaining )
+
+feed = Feed()
+
+
+
+# ##################################################
+# class Trace
+#   wall-clock time spent in each phase of one request, and cpu time
+#   when detailed (process wide, as os.times is: exact only while no
+#   other request runs)
+
+class Trace:
+
+    # ##################################################
+    # constructor
+    
+    def __init__( self, started=None, detailed=False ):
+        self.started = started or time.time()
+        self.detailed = detailed
+        self.key = None
+        self.phases = []
+
+    # ##################################################
+    # phase
+    
+    @contextlib.contextmanager
+    def phase( self, name ):
+        started = time.time()
+        cpu = cpu_time() if self.detailed else None
+        try:
+            yield
+        finally:
+            self.add( name, time.time() - started, cpu_time() - cpu if self.detailed else None )
+
+    # ##################################################
+    # add
+    
+    def add( self, name, duration, cpu=None ):
+        self.phases.append( ( name, duration, cpu ) )
+
+    # ##################################################
+    # report
+    #   milliseconds per phase, in order, followed by pending ones (the
+    #   dump of the body that holds this report)
+    
+    def report( self, pending=[] ):
+        phases = [ dict( [ ( 'phase', name ), ( 'wall', round( duration * 1000, 3 ) ) ] + ( [ ( 'cpu', round( cpu * 1000, 3 ) ) ] if cpu is not None else [] ) ) for name, duration, cpu in self.phases + pending ]
+        return { 'phases': phases, 'total': round( self.elapsed() * 1000, 3 ) }
+
+    # ##################################################
+    # server_timing
+    
+    def server_timing( self, pending=[] ):
+        totals = self.totals( pending )
+        return ', '.join( '%s;dur=%.3f' % ( name, duration * 1000 ) for name, duration in totals.items() )
+
+    # ##################################################
+    # elapsed
+    
+    def elapsed( self ):
+        return time.time() - self.started
+
+    # ##################################################
+    # totals
+    
+    def totals( self, pending=[] ):
+        totals = collections.OrderedDict()
+        for name, duration, cpu in self.phases + pending:
+            totals[ name ] = totals.get( name, 0.0 ) + duration
+        totals[ 'total' ] = self.elapsed()
+        return totals
+
+
+
+# ##################################################
+# class Metrics
+#   latency samples per ( db, section, qr ) and phase
+
+class Metrics:
+
+    # ##################################################
+    # constructor
+    
+    def __init__( self, samples=METRICS_SAMPLES ):
+        self.samples = samples
+        self.timings = {}
+        self.counts = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    # ##################################################
+    # record
+    
+    def record( self, trace, failed=False ):
+        if trace.key is None:
+            return
+        totals = trace.totals()
+        with self.lock:
+            timings = self.timings.setdefault( trace.key, {} )
+            for name, duration in totals.items():
+                timings.setdefault( name, collections.deque( maxlen=self.samples ) ).append( duration )
+            self.counts[ trace.key ] = self.counts.get( trace.key, 0 ) + 1
+            if failed:
+                self.errors[ trace.key ] = self.errors.get( trace.key, 0 ) + 1
+
+    # ##################################################
+    # stats
+    #   milliseconds over the last samples requests
+    
+    def stats( self ):
+        stats = {}
+        with self.lock:
+            for key, timings in self.timings.items():
+                item = { 'count': self.counts.get( key, 0 ), 'errors': self.errors.get( key, 0 ) }
+                for name, durations in timings.items():
+                    values = sorted( durations )
+                    item[ name ] = {
+                        'p50': self.percentile( values, 0.50 ),
+                        'p95': self.percentile( values, 0.95 ),
+                        'p99': self.percentile( values, 0.99 ),
+                        'max': round( values[ -1 ] * 1000, 3 ),
+                    }
+                stats[ '/'.join( '%s' % part for part in key ) ] = item
+        return stats
+
+    # ##################################################
+    # percentile
+    
+    def percentile( self, values, rank ):
+        return round( values[ min( len( values ) - 1, int( rank * len( values ) ) ) ] * 1000, 3 )
+
+    # ##################################################
+    # log_slow_query
+    
+    def log_slow_query( self, trace, duration, sql, parameters, plan ):
+        line = '[slow] %.1fms %s %s %s\n%s\n' % ( duration * 1000, '/'.join( '%s' % part for part in trace.key or [] ), sql, parameters, ''.join( '    %s\n' % detail for detail in plan ) )
+        with self.lock:
+            if SLOW_QUERY_LOG is None:
+                sys.stderr.write( line )
+            else:
+                with open( SLOW_QUERY_LOG, 'a' ) as log:
+                    log.write( line )
+
+metrics = Metrics()
+
+# ##################################################
+# cpu_time
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+
+# ##################################################
+# class Database
+
+class Database:
+    
+    # ##################################################
+    # constructor
+    
+    def __init__( self, name, trace=None, readonly=False ):
+        self.name = name
+        self.trace = trace or Trace()
+        self.pool = pool if readonly else writer
+        self.connection = None
+
+    # ##################################################
+    # set up
+    
+    def __enter__( self ):
+        self.connect()
+        return self
+
+    # ##################################################
+    # tear dow
+      
+    def __exit__( self, type, value, traceback ):
+        if self.connection is not None:
+            if value is not None:
+                self.rollback()
+            else:
+                self.commit()
+            self.disconnect()
+
+    # ##################################################
+    # connect
+    
+    def connect( self ):
+        if self.name is None:
+            raise Exception( 'missing database name' )
+        with self.trace.phase( 'connect' ):
+            self.connection = self.pool.acquire( self.name )
+
+    # ##################################################
+    # disconnect
+    
+    def disconnect( self ):
+        if self.connection is not None:
+            self.pool.release( self.name, self.connection )
+        self.connection = None
+
+    # ##################################################
+    # commit
+
+    def commit( self ):
+        if self.connection is not None:
+            self.connection.commit()
+
+    # ##################################################
+    # rollback
+    
+    def rollback( self ):
+        if self.connection is not None:
+            self.connection.rollback()
+
+    # ##################################################
+    # execute_query
+
+    def execute_query( self, query, *args ):
+        if self.connection is None:
+            raise Exception( 'database not connected' )
+        
+        self.cursor = self.connection.cursor()
+        
+        if len( args ) > 0:
+            self.cursor.execute( query, args )
+        else:
+            self.cursor.execute( query )
+
+    # ##################################################
+    # explain
+
+    def explain( self, query, *args ):
+        if self.connection is None:
+            raise Exception( 'database not connected' )
+        
+        return [ row[ -1 ] for row in self.connection.execute( 'EXPLAIN QUERY PLAN %s' % query, args ).fetchall() ]
+
+    # ##################################################
+    # execute_many
+
+    def execute_many( self, query, rows ):
+        if self.connection is None:
+            raise Exception( 'database not connected' )
+        
+        self.cursor = self.connection.cursor()
+        self.cursor.executemany( query, rows )
+
+    # ##################################################
+    # execute_script
+
+    def execute_script( self, script, *args ):
+        if self.connection is None:
+            raise Exception( 'database not connected' )
+        
+        self.cursor = self.connection.cursor()
+        
+        if len( args ) > 0:
+            self.cursor.execute( script, args )
+            # self.cursor.executescript( script )
+        else:
+            self.cursor.executescript( script )
+
+    # ##################################################
+    # fetch_oid
+
+    def fetch_oid( self ):
+        if self.cursor is None:
+            raise Exception( 'query not executed' )
+        
+        return self.cursor.lastrowid
+
+    # ##################################################
+    # fetch_last_oid
+    #   unlike fetch_oid, also valid after executemany
+
+    def fetch_last_oid( self ):
+        if self.connection is None:
+            raise Exception( 'database not connected' )
+        
+        return self.connection.execute( 'SELECT last_insert_rowid()' ).fetchone()[0]
+
+    # ##################################################
+    # fetch_nb
+
+    def fetch_nb( self ):
+        if self.cursor is None:
+            raise Exception( 'query not executed' )
+        
+        if self.cursor.rowcount >= 0:
+            return self.cursor.rowcount
+        return None
+
+    # ##################################################
+    # fetch_one
+
+    def fetch_one( self, arrays=False ):
+        if self.cursor is None:
+            raise Exception( 'query not executed' )
+        
+        if self.cursor.description is None:
+            raise Exception( 'query failed' )
+        
+        row = self.cursor.fetchone()
+        if row is None:
+            raise Exception( 'row not found' )
+        
+        if arrays:
+            return list( row )
+            
+        item = {}
+        keys = [ column[0] for column in self.cursor.description ]
+        index = 0
+        for value in row:
+            if value is not None:
+                item[ keys[ index ] ] = value
+            index = index + 1
+        return item
+
+    # ##################################################
+    # fetch_columns
+    
+    def fetch_columns( self ):
+        if self.cursor is None:
+            raise Exception( 'query not executed' )
+        
+        if self.cursor.description is None:
+            raise Exception( 'query failed' )
+        
+        return [ column[0] for column in self.cursor.description ]
+
+    # ##################################################
+    # fetch_all
+    
+    def fetch_all( self ):
+        items = []
+        for chunk in self.fetch_chunks():
+            items.extend( chunk )
+        return items
+
+    # ##################################################
+    # fetch_chunks
+    #   iterate over remaining rows, size rows at a time
+    
+    #   items are dicts without NULL values, or plain arrays (NULL as None)
+    
+    def fetch_chunks( self, size=FETCH_CHUNK_SIZE, arrays=False ):
+        keys = self.fetch_columns()
+        return self.iter_chunks( self.cursor, keys, size, arrays )
+
+    # ##################################################
+    # iter_chunks
+    
+    def iter_chunks( self, cursor, keys, size, arrays ):
+        while True:
+            rows = cursor.fetchmany( size )
+            if not rows:
+                break
+            if arrays:
+                yield [ list( row ) for row in rows ]
+                continue
+            items = []
+            for row in rows:
+                item = {}
+                index = 0
+                for value in row:
+                    if value is not None:
+                        item[ keys[ index ] ] = value
+                    index = index + 1
+                items.append( item )
+            yield items
+
+
+
+# ##################################################
+# class Job
+#   one caller's writes waiting for the next group commit
+
+class Job:
+
+    # ##################################################
+    # constructor
+    
+    def __init__( self, function, trace ):
+        self.function = function
+        self.trace = trace
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+
+# ##################################################
+# class GroupCommit
+#   the first writer to arrive leads: it waits up to window for other
+#   writers (or until size are queued) and runs every job in a single
+#   transaction, each job in its own savepoint so that a failing job
+#   only rolls back its own writes
+
+class GroupCommit:
+
+    # ##################################################
+    # constructor
+    
+    def __init__( self, size=GROUP_COMMIT_SIZE, window=GROUP_COMMIT_WINDOW ):
+        self.size = size
+        self.window = window
+        self.pending = {}
+        self.leading = set()
+        self.condition = threading.Condition()
+        self.groups = 0
+        self.jobs = 0
+
+    # ##################################################
+    # submit
+    #   function( database ) runs on the writer connection, its result or
+    #   exception is handed back to the caller once the group is committed
+    
+    def submit( self, name, trace, function ):
+        job = Job( function, trace )
+        with self.condition:
+            self.pending.setdefault( name, [] ).append( job )
+            leader = name not in self.leading
+            if leader:
+                self.leading.add( name )
+            else:
+                self.condition.notify_all()
+        if leader:
+            self.lead( name, trace )
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    # ##################################################
+    # lead
+    
+    def lead( self, name, trace ):
+        deadline = time.time() + self.window
+        with self.condition:
+            while len( self.pending[ name ] ) < self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait( remaining )
+            jobs = self.pending.pop( name )
+            self.leading.discard( name )
+            self.groups = self.groups + 1
+            self.jobs = self.jobs + len( jobs )
+        try:
+            self.commit( name, trace, jobs )
+        except Exception, e:
+            for job in jobs:
+                job.error = e
+        finally:
+            for job in jobs:
+                job.done.set()
+
+    # ##################################################
+    # commit
+    #   the connection runs in autocommit mode meanwhile: python's sqlite3
+    #   would otherwise commit its implicit transaction before a SAVEPOINT
+    
+    def commit( self, name, trace, jobs ):
+        database = Database( name, trace )
+        database.connect()
+        connection = database.connection
+        isolation_level = connection.isolation_level
+        connection.isolation_level = None
+        try:
+            connection.execute( 'BEGIN IMMEDIATE' )
+            try:
+                for job in jobs:
+                    database.trace = job.trace
+                    connection.execute( 'SAVEPOINT job' )
+                    try:
+                        job.result = job.function( database )
+                    except Exception, e:
+                        job.error = e
+                        connection.execute( 'ROLLBACK TO SAVEPOINT job' )
+                    connection.execute( 'RELEASE SAVEPOINT job' )
+                connection.execute( 'COMMIT' )
+            except:
+                connection.execute( 'ROLLBACK' )
+                raise
+        finally:
+            database.trace = trace
+            connection.isolation_level = isolation_level
+            database.disconnect()
+
+    # ##################################################
+    # stats
+    
+    def stats( self ):
+        with self.condition:
+            return {
+                'groups': self.groups,
+                'jobs': self.jobs,
+                'pending': sum( len( jobs ) for jobs in self.pending.values() ),
+            }
+
+committer = GroupCommit()
+
+
+
+# ##################################################
+# regexps
+
+PARAMETER_REGEXP = re.compile( '%(\w*)%' )
+SUBSTITUTIONS = [ 'db', 'tb' ]
+READS = [ 'SELECT' ]
+WRITES = [ 'INSERT', 'UPDATE', 'DELETE', 'REPLACE' ]
+FETCHES = [
+    ( 'one', [] ),
+    ( 'all', [ 'SELECT' ] ),
+    ( 'oid', [ 'INSERT' ] ),
+    ( 'nb', [ 'UPDATE', 'DELETE' ] ),
+]
+TABLE_REGEXP = re.compile( '\\b(?:FROM|JOIN|INTO|UPDATE)\s+([\w%]+(?:\s*,\s*[\w%]+)*)', re.IGNORECASE )
+NAME_REGEXP = re.compile( '^\w+$' )
+BUSY_REGEXP = re.compile( 'database (?:table )?is locked|database is busy' )
+PAGE_REGEXP = re.compile( '\s*\|\s*page\s+(\w+)\s*', re.IGNORECASE )
+ORDER_REGEXP = re.compile( '\\bORDER\s+BY\s+([^()]+?)(?:\s+LIMIT\\b[^()]*)?\s*$', re.IGNORECASE )
+ORDER_BY_REGEXP = re.compile( '\\bORDER\s+BY\\b', re.IGNORECASE )
+LIMIT_REGEXP = re.compile( '\\bLIMIT\s+(\?|-?\d+)(?:\s*(OFFSET|,)\s*(\?|-?\d+))?\s*$', re.IGNORECASE )
+ORDER_TERM_REGEXP = re.compile( '^\s*(?:\w+\.)?(\w+)(?:\s+(ASC|DESC))?\s*$', re.IGNORECASE )
+ROWID_SELECT_REGEXP = re.compile( '^\s*SELECT\s+(?!DISTINCT\\b|ALL\\b)', re.IGNORECASE )
+ROWID_EXCLUDE_REGEXP = re.compile( '\\b(?:JOIN|UNION|INTERSECT|EXCEPT|GROUP\s+BY)\\b', re.IGNORECASE )
+FETCH_REGEXPS = dict( ( fetch_id, (
+    re.compile( '\s*\|\s*%s\s*' % ( fetch_id ), re.IGNORECASE ),
+    re.compile( '^\s*(%s)\s*' % ( '|'.join( sql_query_types ) ), re.IGNORECASE ) if len( sql_query_types ) > 0 else None
+) ) for fetch_id, sql_query_types in FETCHES )
+
+
+
+# ##################################################
+# class Statement
+
+class Statement:
+
+    # ##################################################
+    # constructor
+    #   parts alternates sql fragments (with ? in place of parameters)
+    #   and %db% / %tb% substitution keys
+    
+    def __init__( self, parts, slots, kind=None, tables=None, fetch_one=False, fetch_all=False, fetch_oid=False, fetch_nb=False, page_key=PAGE_KEY ):
+        self.parts = parts
+        self.slots = slots
+        self.kind = kind
+        self.tables = tables or []
+        self.page_key = page_key
+        self.fetch_one = fetch_one
+        self.fetch_all = fetch_all
+        self.fetch_oid = fetch_oid
+        self.fetch_nb = fetch_nb
+
+    # ##################################################
+    # bind
+    
+    def bind( self, request ):
+        sql_query = self.substitute( request )
+        sql_parameters = self.extract_parameters( request.parameters )
+        query = Query( sql=sql_query, parameters=sql_parameters, kind=self.kind, fetch_one=self.fetch_one, fetch_all=self.fetch_all, fetch_oid=self.fetch_oid, fetch_nb=self.fetch_nb )
+        query.tables = self.resolve_tables( request )
+        if self.fetch_all:
+            query.paginate( self.page_key, request.get_parameter( 'limit', False ), request.get_parameter( 'after', False ) )
+        return query
+
+    # ##################################################
+    # bind_rows
+    #   one parameter list per row, for executemany
+    
+    def bind_rows( self, request, rows ):
+        sql_query = self.substitute( request )
+        query = Query( sql=sql_query, rows=[ self.extract_parameters( row ) for row in rows ], kind=self.kind )
+        query.tables = self.resolve_tables( request )
+        return query
+
+    # ##################################################
+    # resolve_tables
+    
+    def resolve_tables( self, request ):
+        tables = []
+        for table in self.tables:
+            match = PARAMETER_REGEXP.match( table )
+            if match:
+                table = request.get_parameter( match.group(1), False )
+            if table is not None:
+                tables.append( table.lower() )
+        return tables
+
+    # ##################################################
+    # substitute
+    
+    def substitute( self, request ):
+        values = dict( ( key, request.get_parameter( key ) ) for key in self.slots if key in SUBSTITUTIONS )
+        return ''.join( part if index % 2 == 0 else values[ part ] for index, part in enumerate( self.parts ) )
+
+    # ##################################################
+    # extract_parameters
+    
+    def extract_parameters( self, values ):
+        return [ values.get( key ) for key in self.slots if key not in SUBSTITUTIONS ]
+
+
+
+# ##################################################
+# class Plan
+
+class Plan:
+
+    # ##################################################
+    # constructor
+    
+    def __init__( self, statements ):
+        self.statements = statements
+        self.multi = ( len( statements ) > 1 )
+
+
+
+# ##################################################
+# class Sharding
+#   [lite] shards = n and shard.key = parameter split <db> over n files
+#   <db>.0.db ... <db>.<n-1>.db, picked by the crc32 of the parameter
+
+class Sharding:
+
+    # ##################################################
+    # constructor
+    
+    def __init__( self, database, shards, key ):
+        self.database = database
+        self.shards = shards
+        self.key = key
+
+    # ##################################################
+    # names
+    
+    def names( self ):
+        return [ '%s.%s' % ( self.database, index ) for index in range( self.shards ) ]
+
+    # ##################################################
+    # shard
+    
+    def shard( self, value ):
+        if value is None:
+            raise Exception( 'missing shard key %s in request' % self.key )
+        value = value.encode( 'utf-8' ) if isinstance( value, unicode ) else '%s' % value
+        return '%s.%s' % ( self.database, ( zlib.crc32( value ) & 0xffffffff ) % self.shards )
+
+
+
+# ##################################################
+# class Catalog
+
+class Catalog:
+
+    # ##################################################
+    # constructor
+    
+    def __init__( self ):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    # ##################################################
+    # plan
+    #   option names are looked up lowercased, as ConfigParser stores them
+    
+    def plan( self, database, section, option ):
+        config_file = '%s.ini' % database
+        plans = self.load( config_file )
+        if section.upper() != 'DEFAULT' and ( section not in plans or section == SETTINGS_SECTION ):
+            raise Exception( 'missing section %s in %s' % ( section, config_file ) )
+        plan = plans.get( section, {} ).get( option.lower() )
+        if plan is None:
+            raise Exception( 'missing option %s in section %s in %s' % ( option, section, config_file ) )
+        if isinstance( plan, Exception ):
+            raise plan
+        return plan
+
+    # ##################################################
+    # load
+    #   reload config file only when its mtime (or size) changes
+    
+    def load( self, config_file ):
+        return self.entry( config_file )[1]
+
+    # ##################################################
+    # sharding
+    #   None unless the database declares shards in its [lite] section
+    
+    def sharding( self, database ):
+        sharding = self.entry( '%s.ini' % database )[2]
+        if isinstance( sharding, Exception ):
+            raise sharding
+        return sharding
+
+    # ##################################################
+    # memory
+    #   persist interval of an in-memory database, None for disk ones
+    
+    def memory( self, database ):
+        interval = self.entry( '%s.ini' % database )[3]
+        if isinstance( interval, Exception ):
+            raise interval
+        return interval
+
+    # ##################################################
+    # changes
+    #   ( tables, retain ) of a database keeping a change log, else None
+    
+    def changes( self, database ):
+        changes = self.entry( '%s.ini' % database )[4]
+        if isinstance( changes, Exception ):
+            raise changes
+        return changes
+
+    # ##################################################
+    # entry
+    #   ( version, plans, sharding, memory, changes ) reparsed only when the config
+    #   file's mtime (or size) changes
+    
+    def entry( self, config_file ):
+        try:
+            stat = os.stat( config_file )
+            version = ( stat.st_mtime, stat.st_size )
+        except OSError:
+            version = None
+        with self.lock:
+            entry = self.entries.get( config_file )
+            if entry is None or entry[0] != version:
+                config = ConfigParser.ConfigParser()
+                config.read( config_file )
+                entry = ( version, self.parse( config ), self.parse_sharding( config, config_file ), self.parse_memory( config, config_file ), self.parse_changes( config, config_file ) )
+                self.entries[ config_file ] = entry
+        return entry
+
+    # ##################################################
+    # parse_sharding
+    
+    def parse_sharding( self, config, config_file ):
+        if not config.has_section( SETTINGS_SECTION ) or not config.has_option( SETTINGS_SECTION, 'shards' ):
+            return None
+        database = os.path.splitext( config_file )[0]
+        try:
+            shards = int( config.get( SETTINGS_SECTION, 'shards' ) )
+            key = config.get( SETTINGS_SECTION, 'shard.key' )
+        except ( ValueError, ConfigParser.Error ):
+            return Exception( 'invalid shards in section %s in %s' % ( SETTINGS_SECTION, config_file ) )
+        if shards <= 0:
+            return Exception( 'invalid shards in section %s in %s' % ( SETTINGS_SECTION, config_file ) )
+        return Sharding( database, shards, key )
+
+    # ##################################################
+    # parse_memory
+    
+    def parse_memory( self, config, config_file ):
+        try:
+            if not config.has_option( SETTINGS_SECTION, 'memory' ) or not config.getboolean( SETTINGS_SECTION, 'memory' ):
+                return None
+            if not config.has_option( SETTINGS_SECTION, 'memory.persist' ):
+                return MEMORY_PERSIST_INTERVAL
+            return float( config.get( SETTINGS_SECTION, 'memory.persist' ) )
+        except ( ValueError, ConfigParser.Error ):
+            return Exception( 'invalid memory in section %s in %s' % ( SETTINGS_SECTION, config_file ) )
+
+    # ##################################################
+    # parse_changes
+    
+    def parse_changes( self, config, config_file ):
+        try:
+            if not config.has_option( SETTINGS_SECTION, 'changes' ):
+                return None
+            tables = tuple( sorted( set( table.strip() for table in config.get( SETTINGS_SECTION, 'changes' ).split( ',' ) if table.strip() ) ) )
+            retain = CHANGES_RETAIN
+            if config.has_option( SETTINGS_SECTION, 'changes.retain' ):
+                retain = int( config.get( SETTINGS_SECTION, 'changes.retain' ) )
+        except ( ValueError, ConfigParser.Error ):
+            return Exception( 'invalid changes in section %s in %s' % ( SETTINGS_SECTION, config_file ) )
+        if not tables or retain <= 0 or any( NAME_REGEXP.match( table ) is None for table in tables ):
+            return Exception( 'invalid changes in section %s in %s' % ( SETTINGS_SECTION, config_file ) )
+        return ( tables, retain )
+
+    # ##################################################
+    # parse
+    
+    def parse( self, config ):
+        plans = {}
+        for section in [ 'DEFAULT' ] + config.sections():
+            if section == SETTINGS_SECTION:
+                continue
+            plans[ section ] = {}
+            options = config.defaults().keys() if section == 'DEFAULT' else config.options( section )
+            for option in options:
+                try:
+                    sql = config.get( section, option )
+                except ConfigParser.Error, e:
+                    plans[ section ][ option ] = e
+                    continue
+                if sql is not None:
+                    plans[ section ][ option ] = self.compile( sql )
+        return plans
+
+    # ##################################################
+    # compile
+    
+    def compile( self, sql ):
+        sql_queries = [ s.strip() for s in sql.split( ';' ) if s.strip() != '' ]
+        multi = ( len( sql_queries ) > 1 )
+        statements = []
+        for sql_query in sql_queries:
+            
+            # extract page key
+            page_key = PAGE_KEY
+            match = PAGE_REGEXP.search( sql_query )
+            if match:
+                page_key = match.group(1)
+                sql_query = PAGE_REGEXP.sub( '', sql_query )
+            
+            # extract sql_fetch
+            fetches = {}
+            for fetch_id, _ in FETCHES:
+                ( sql_query, fetches[ fetch_id ] ) = self.extract_sql_fetch( sql_query, fetch_id )
+            
+            if multi:
+                fetches = dict( ( fetch_id, False ) for fetch_id in fetches )
+                
+            fetches[ 'all' ] = fetches[ 'all' ] and not fetches[ 'one' ]
+            
+            # extract parameter slots
+            pieces = PARAMETER_REGEXP.split( sql_query )
+            parts = [ pieces[0] ]
+            slots = []
+            for index in range( 1, len( pieces ), 2 ):
+                key = pieces[ index ]
+                slots.append( key )
+                if key in SUBSTITUTIONS:
+                    parts.append( key )
+                    parts.append( pieces[ index + 1 ] )
+                else:
+                    parts[ -1 ] = '%s?%s' % ( parts[ -1 ], pieces[ index + 1 ] )
+            
+            # build statement
+            kind = ( sql_query.split() or [ '' ] )[0].upper()
+            tables = [ table.strip() for names in TABLE_REGEXP.findall( sql_query ) for table in names.split( ',' ) ]
+            statements.append( Statement( parts, slots, kind=kind, tables=tables, fetch_one=fetches[ 'one' ], fetch_all=fetches[ 'all' ], fetch_oid=fetches[ 'oid' ], fetch_nb=fetches[ 'nb' ], page_key=page_key ) )
+        return Plan( statements )
+
+    # ##################################################
+    # extract_sql_fetch
+
+    def extract_sql_fetch( self, sql_query, fetch_id ):
+        ( fetch_regexp, type_regexp ) = FETCH_REGEXPS[ fetch_id ]
+        
+        # extract sql_fetch from fetch_id
+        if fetch_regexp.search( sql_query ):
+            sql_query = fetch_regexp.sub( '', sql_query )
+            return ( sql_query, True )
+        
+        # extract sql_fetch from sql_query_types
+        if type_regexp is not None and type_regexp.search( sql_query ):
+            return ( sql_query, True )
+        
+        return ( sql_query, False )
+
+catalog = Catalog()
+
+
+
+# ##################################################
+# class Request
+
+class Request:
+
+    # ##################################################
+    # constructor
+    #   a json body is only read here and decoded by build_query
+    
+    def __init__( self, environ=None, parameters=None ):
+        self.started = time.time()
+        cpu = cpu_time()
+        self.content = None
+        self.etags = []
+        self.encoding = None
+        if parameters is not None:
+            self.parameters = parameters
+            environ = environ or {}
+        else:
+            environ = os.environ if environ is None else environ
+            self.etags = self.read_etags( environ.get( 'HTTP_IF_NONE_MATCH', '' ) )
+            self.encoding = self.read_encoding( environ.get( 'HTTP_ACCEPT_ENCODING', '' ) )
+            self.parameters = self.parse_query( environ.get( 'QUERY_STRING', '' ) )
+            fp = environ.get( 'wsgi.input', sys.stdin )
+            content_type = environ.get( 'CONTENT_TYPE', '' ).split( ';' )[0].strip().lower()
+            if content_type == 'application/json':
+                self.content = self.read_content( environ, fp )
+            elif content_type == 'application/x-www-form-urlencoded':
+                self.parameters.update( self.parse_query( self.read_content( environ, fp ) ) )
+            elif content_type.startswith( 'multipart/' ):
+                fields = cgi.FieldStorage( fp=fp, environ=environ )
+                self.parameters = dict( ( key, fields.getfirst( key ) ) for key in fields.keys() )
+        self.database = None
+        self.table = None
+        self.stream = None
+        self.format = None
+        self.multi = False
+        self.queries = []
+        self.items = None
+        self.rows = None
+        self.parts = None
+        self.environ = environ
+        self.parsing = ( time.time() - self.started, cpu_time() - cpu )
+
+    # ##################################################
+    # park
+    #   hand the request back to a server providing lite.park, which runs
+    #   it again once woken (lite.wake), changed() or past deadline; None
+    #   without such a server, False when it refuses (shutting down)
+    
+    def park( self, key, deadline, changed ):
+        park = self.environ.get( 'lite.park' )
+        if park is None:
+            return None
+        if self.environ.get( 'lite.wake' ) is not None:
+            feed.listen( self.environ[ 'lite.wake' ] )
+        self.environ[ 'lite.deadline' ] = deadline
+        return park( key, deadline, changed )
+
+    # ##################################################
+    # parse_query
+    #   first value of each key, blank values are ignored
+    
+    def parse_query( self, query ):
+        parameters = {}
+        for key, value in urlparse.parse_qsl( query ):
+            parameters.setdefault( key, value )
+        return parameters
+
+    # ##################################################
+    # read_content
+    
+    def read_content( self, environ, fp ):
+        try:
+            length = int( environ.get( 'CONTENT_LENGTH' ) or 0 )
+        except ValueError:
+            length = 0
+        if length <= 0:
+            return ''
+        return fp.read( length )
+
+    # ##################################################
+    # read_etags
+    #   weak validators compare equal, reads are never partial
+    
+    def read_etags( self, header ):
+        etags = []
+        for etag in header.split( ',' ):
+            etag = etag.strip()
+            if etag.startswith( 'W/' ):
+                etag = etag[ 2: ]
+            if etag:
+                etags.append( etag )
+        return etags
+
+    # ##################################################
+    # read_encoding
+    #   first of ENCODINGS accepted with a non zero quality
+    
+    def read_encoding( self, header ):
+        accepted = {}
+        for coding in header.split( ',' ):
+            parts = [ part.strip() for part in coding.split( ';' ) ]
+            quality = 1.0
+            for part in parts[ 1: ]:
+                if part.startswith( 'q=' ):
+                    try:
+                        quality = float( part[ 2: ] )
+                    except ValueError:
+                        quality = 0.0
+            if parts[0]:
+                accepted[ parts[0].lower() ] = quality
+        for encoding, wbits in ENCODINGS:
+            if accepted.get( encoding, accepted.get( '*', 0.0 ) ) > 0.0:
+                return encoding
+        return None
+
+    # ##################################################
+    # get_parameter
+
+    def get_parameter( self, key, mandatory=True ):
+        if key not in self.parameters:
+            if mandatory:
+                raise Exception( 'missing parameter %s in request' % key )
+            return None
+        return self.parameters[ key ]
+
+    # ##################################################
+    # get_body
+    
+    def get_body( self ):
+        if not self.content:
+            return None
+        try:
+            return json.loads( self.content )
+        except ValueError:
+            raise Exception( 'invalid json body' )
+
+    # ##################################################
+    # decode_parameters
+    #   json values are bound with their own type: int, float, null,
+    #   string or { "blob": base64 }
+    
+    def decode_parameters( self, values ):
+        parameters = {}
+        for key, value in values.items():
+            if isinstance( value, dict ) and value.keys() == [ 'blob' ]:
+                try:
+                    value = buffer( base64.b64decode( value[ 'blob' ] ) )
+                except ( TypeError, ValueError ):
+                    raise Exception( 'invalid blob %s' % key )
+            elif isinstance( value, ( dict, list ) ):
+                raise Exception( 'invalid parameter %s' % key )
+            elif key in SUBSTITUTIONS and not isinstance( value, basestring ):
+                raise Exception( 'invalid parameter %s' % key )
+            parameters[ key ] = value
+        return parameters
+
+    # ##################################################
+    # build_query
+    
+    def build_query( self ):
+        
+        # typed parameters of a json object body
+        body = self.get_body()
+        if isinstance( body, dict ):
+            self.parameters.update( self.decode_parameters( body ) )
+        
+        # extract context
+        self.database = self.get_parameter( 'db' )
+        if isinstance( body, list ):
+            if 'qr' not in self.parameters:
+                return self.build_batch( body )
+            if not all( isinstance( row, dict ) for row in body ):
+                raise Exception( 'invalid bulk rows' )
+            self.rows = [ self.decode_parameters( row ) for row in body ]
+        self.table = self.get_parameter( 'tb', False )
+        sql_query_id = self.get_parameter( 'qr' )
+        self.stream = self.get_parameter( 'stream', False )
+        self.format = self.get_parameter( 'fmt', False )
+        
+        # lookup compiled plan in catalog
+        plan = catalog.plan( self.database, self.table or 'DEFAULT', sql_query_id )
+        self.multi = plan.multi
+        
+        # bind sql_parameters from request (or from each bulk row)
+        for statement in plan.statements:
+            if self.rows is not None:
+                self.queries.append( statement.bind_rows( self, self.rows ) )
+            else:
+                self.queries.append( statement.bind( self ) )
+        
+        # route to shards
+        sharding = catalog.sharding( self.database )
+        if sharding is not None:
+            self.parts = self.route( sharding, plan )
+
+    # ##################################################
+    # route
+    #   bulk rows are split by shard, requests with a shard key go to one
+    #   shard and the others (but inserts) fan out to every shard
+    
+    def route( self, sharding, plan ):
+        if self.rows is not None:
+            groups = {}
+            for row in self.rows:
+                groups.setdefault( sharding.shard( row.get( sharding.key ) ), [] ).append( row )
+            return [ self.part( name, [ statement.bind_rows( self, rows ) for statement in plan.statements ], rows=rows ) for name, rows in sorted( groups.items() ) ]
+        value = self.get_parameter( sharding.key, False )
+        if value is not None:
+            return [ self.part( sharding.shard( value ), self.queries ) ]
+        if any( query.kind in [ 'INSERT', 'REPLACE' ] for query in self.queries ):
+            raise Exception( 'missing shard key %s in request' % sharding.key )
+        queries = [ query.fan_out() for query in self.queries ]
+        return [ self.part( name, queries ) for name in sharding.names() ]
+
+    # ##################################################
+    # part
+    #   the same request on one physical database
+    
+    def part( self, database, queries, rows=None, items=None ):
+        request = Request( parameters=self.parameters )
+        request.database = database
+        request.table = self.table
+        request.stream = self.stream
+        request.format = self.format
+        request.multi = self.multi
+        request.queries = queries
+        request.rows = rows
+        request.items = items
+        return request
+
+    # ##################################################
+    # databases
+    
+    def databases( self ):
+        if self.parts is None:
+            return [ self.database ]
+        return [ part.database for part in self.parts ]
+
+    # ##################################################
+    # key
+    
+    def key( self ):
+        if self.items is not None:
+            return ( self.database, None, 'batch' )
+        return ( self.database, self.table or 'DEFAULT', self.get_parameter( 'qr', False ) )
+
+    # ##################################################
+    # all_queries
+    
+    def all_queries( self ):
+        if self.items is not None:
+            return [ query for item in self.items for query in item.queries ]
+        return self.queries
+
+    # ##################################################
+    # build_batch
+    #   one request per { qr, tb, params } item, all on the same database
+    
+    def build_batch( self, body ):
+        self.items = []
+        for index, item in enumerate( body ):
+            if not isinstance( item, dict ) or not isinstance( item.get( 'params', {} ), dict ):
+                raise Exception( 'invalid batch item %s' % index )
+            try:
+                parameters = self.decode_parameters( item.get( 'params', {} ) )
+            except Exception, e:
+                raise Exception( 'item %s: %s' % ( index, e ) )
+            parameters[ 'db' ] = self.database
+            for key in [ 'qr', 'tb' ]:
+                parameters.pop( key, None )
+                if item.get( key ) is not None:
+                    parameters[ key ] = item[ key ]
+            request = Request( parameters=parameters )
+            try:
+                request.build_query()
+            except Exception, e:
+                raise Exception( 'item %s: %s' % ( index, e ) )
+            self.items.append( request )
+        
+        # a batch is one transaction, hence on one shard
+        if catalog.sharding( self.database ) is not None:
+            names = set( part.database for item in self.items for part in item.parts )
+            if len( names ) != 1 or any( len( item.parts ) != 1 for item in self.items ):
+                raise Exception( 'batch items span several shards' )
+            self.items = [ item.parts[0] for item in self.items ]
+            self.parts = [ self.part( names.pop(), [], items=self.items ) ]
+
+
+        
+# ##################################################
+# class Response
+
+class Response:
+
+    # ##################################################
+    # constructor
+    
+    def __init__( self ):
+        self._stream = None
+        self._format = None
+        self._encoding = None
+        self._trace = None
+        self._page_key = False
+        self._suspended = False
+
+    # ##################################################
+    # set
+    
+    def __setitem__( self, key, value ):
+        self.__dict__[ key ] = value
+
+    # ##################################################
+    # data
+    
+    def data( self ):
+        return dict( ( key, value ) for key, value in self.__dict__.items() if not key.startswith( '_' ) )
+
+    # ##################################################
+    # reset
+    
+    def reset( self ):
+        for key in self.data():
+            del self.__dict__[ key ]
+
+    # ##################################################
+    # set_stream
+    
+    def set_stream( self, stream ):
+        self._stream = stream
+
+    # ##################################################
+    # set_format
+    
+    def set_format( self, fmt ):
+        if fmt is not None and fmt not in FORMATS:
+            raise Exception( 'invalid fmt %s' % fmt )
+        self._format = fmt
+
+    # ##################################################
+    # get_format
+    
+    def get_format( self ):
+        return self._format
+
+    # ##################################################
+    # set_encoding
+    
+    def set_encoding( self, encoding ):
+        self._encoding = encoding
+
+    # ##################################################
+    # keep_page_key
+    #   rows of a shard keep the PAGE_ALIAS column to be merged on
+    
+    def keep_page_key( self ):
+        self._page_key = True
+
+    # ##################################################
+    # keeps_page_key
+    
+    def keeps_page_key( self ):
+        return self._page_key
+
+    # ##################################################
+    # suspend
+    #   nothing is dumped: the request is answered when run again
+    
+    def suspend( self ):
+        self._suspended = True
+
+    # ##################################################
+    # suspended
+    
+    def suspended( self ):
+        return self._suspended
+
+    # ##################################################
+    # set_trace
+    #   a detailed trace is reported in the body when dumped
+    
+    def set_trace( self, trace ):
+        self._trace = trace
+
+    # ##################################################
+    # set_status
+    
+    def set_status( self, status ):
+        pass
+
+    # ##################################################
+    # set_header
+    #   a None value removes the header
+    
+    def set_header( self, key, value ):
+        pass
+
+    # ##################################################
+    # stream
+    #   chunks is an iterator over lists of items
+    
+    def stream( self, key, chunks ):
+        self[ key ] = [ item for chunk in chunks for item in chunk ]
+
+    # ##################################################
+    # dump_header
+    
+    def dump_header( self ):
+        pass
+
+    # ##################################################
+    # dump
+    
+    def dump( self ):
+        if self._trace is not None:
+            self[ 'trace' ] = self._trace.report()
+
+
+
+# ##################################################
+# class JsonResponse
+
+class JsonResponse( Response ):
+
+    # ##################################################
+    # constructor
+    
+    def __init__( self, output=None ):
+        Response.__init__( self )
+        self._output = output or sys.stdout
+        self._status = '200 OK'
+        self._headers = [ ( 'Content-Type', 'text/json' ) ]
+        self._header_dumped = False
+        self._streamed = False
+        self._compressor = None
+
+    # ##################################################
+    # set_stream
+    
+    def set_stream( self, stream ):
+        if stream is not None and stream not in STREAMS:
+            raise Exception( 'invalid stream %s' % stream )
+        Response.set_stream( self, stream )
+        self.set_header( 'Content-Type', STREAMS.get( stream, 'text/json' ) )
+
+    # ##################################################
+    # set_status
+    
+    def set_status( self, status ):
+        self._status = status
+
+    # ##################################################
+    # set_header
+    
+    def set_header( self, key, value ):
+        self._headers = [ header for header in self._headers if header[0] != key ]
+        if value is not None:
+            self._headers.append( ( key, value ) )
+
+    # ##################################################
+    # has_body
+    
+    def has_body( self ):
+        return not self._status.startswith( '304' )
+
+    # ##################################################
+    # set_encoding
+    
+    def set_encoding( self, encoding ):
+        Response.set_encoding( self, encoding )
+        if encoding is not None:
+            self.set_header( 'Vary', 'Accept-Encoding' )
+
+    # ##################################################
+    # compress
+    #   everything written after the header goes through the compressor
+    
+    def compress( self ):
+        if self._encoding is None or self._compressor is not None:
+            return
+        self.set_header( 'Content-Encoding', self._encoding )
+        self.dump_header()
+        self._compressor = self.compressor()
+
+    # ##################################################
+    # compressor
+    
+    def compressor( self ):
+        return zlib.compressobj( COMPRESSION_LEVEL, zlib.DEFLATED, dict( ENCODINGS )[ self._encoding ] )
+
+    # ##################################################
+    # write
+    
+    def write( self, data ):
+        if self._compressor is not None:
+            data = self._compressor.compress( data )
+        if data:
+            self.send( data )
+
+    # ##################################################
+    # send
+    
+    def send( self, data ):
+        self._output.write( data )
+
+    # ##################################################
+    # flush
+    #   a sync flush hands the client whatever was compressed so far
+    
+    def flush( self ):
+        if self._compressor is not None:
+            self.send( self._compressor.flush( zlib.Z_SYNC_FLUSH ) )
+        if hasattr( self._output, 'flush' ):
+            self._output.flush()
+
+    # ##################################################
+    # finish
+    
+    def finish( self ):
+        if self._compressor is not None:
+            self.send( self._compressor.flush() )
+            self._compressor = None
+        if hasattr( self._output, 'flush' ):
+            self._output.flush()
+
+    # ##################################################
+    # header
+    
+    def dump_header( self ):
+        if self._header_dumped:
+            return
+        self._header_dumped = True
+        if self._status != '200 OK':
+            self.write( 'Status: %s\n' % self._status )
+        for key, value in self._headers:
+            self.write( '%s: %s\n' % ( key, value ) )
+        self.write( '\n' )
+
+    # ##################################################
+    # stream
+    #   write items as they are fetched: either inside a json array
+    #   whose other keys are appended by dump, or one json line per item
+    
+    def stream( self, key, chunks ):
+        if self._stream is None:
+            return Response.stream( self, key, chunks )
+        self._streamed = True
+        if self._trace is not None:
+            self.set_header( 'Server-Timing', self._trace.server_timing() )
+        self.compress()
+        self.dump_header()
+        if self._stream == 'json':
+            self.write( '{"%s": [' % key )
+        try:
+            separator = '\n'
+            for chunk in chunks:
+                lines = [ self.encode( item ) for item in chunk ]
+                if not lines:
+                    continue
+                if self._stream == 'json':
+                    self.write( separator + ',\n'.join( lines ) )
+                    separator = ',\n'
+                else:
+                    self.write( ''.join( '%s\n' % line for line in lines ) )
+                self.flush()
+        finally:
+            if self._stream == 'json':
+                self.write( '\n]' )
+
+    # ##################################################
+    # dump
+    #   buffered bodies are sent with their Content-Length (so the
+    #   connection can be kept alive) and only compressed above
+    #   COMPRESSION_MIN_SIZE; a traced body is rendered once without its
+    #   report to time the dump phase the report includes
+    
+    def dump( self ):
+        if not self.has_body():
+            self.dump_header()
+            return self.finish()
+        if self._trace is not None:
+            started = ( time.time(), cpu_time() )
+            self.render()
+            pending = [ ( 'dump', time.time() - started[0], cpu_time() - started[1] ) ]
+            self[ 'trace' ] = self._trace.report( pending )
+            if not self._streamed:
+                self.set_header( 'Server-Timing', self._trace.server_timing( pending ) )
+        body = self.render()
+        if self._streamed:
+            self.write( body )
+            return self.finish()
+        if self._encoding is not None and len( body ) >= COMPRESSION_MIN_SIZE:
+            self.set_header( 'Content-Encoding', self._encoding )
+        self.set_header( 'Content-Length', str( len( body ) ) )
+        self.dump_header()
+        self.send( body )
+        self.finish()
+
+    # ##################################################
+    # render
+    #   the body left to send, compressed when buffered and large enough
+    
+    def render( self ):
+        data = self.data()
+        if self._stream is None:
+            body = '%s\n' % self.encode( data, pretty=( self._format is None ) )
+        elif self._stream == 'json' and self._streamed:
+            body = '%s}\n' % ''.join( ', %s: %s' % ( self.encode( key ), self.encode( data[ key ] ) ) for key in sorted( data ) )
+        else:
+            body = '%s\n' % self.encode( data )
+        if not self._streamed and self._encoding is not None and len( body ) >= COMPRESSION_MIN_SIZE:
+            compressor = self.compressor()
+            body = compressor.compress( body ) + compressor.flush()
+        return body
+
+    # ##################################################
+    # encode
+    #   columnar formats use compact separators
+    
+    def encode( self, value, pretty=False ):
+        if pretty:
+            return json.dumps( value, sort_keys=True, indent=4, separators=( ',', ': ' ), default=encode_blob )
+        if self._format is not None:
+            return json.dumps( value, sort_keys=True, separators=( ',', ':' ), default=encode_blob )
+        return json.dumps( value, sort_keys=True, default=encode_blob )
+
+
+
+# ##################################################
+# class WsgiResponse
+
+class WsgiResponse( JsonResponse ):
+
+    # ##################################################
+    # constructor
+    
+    def __init__( self, start_response ):
+        JsonResponse.__init__( self, output=StringIO() )
+        self._start_response = start_response
+        self._write = None
+
+    # ##################################################
+    # header
+    #   buffered responses hand their headers to start_response in
+    #   application, streamed ones start the response right away
+    
+    def dump_header( self ):
+        if self._streamed and self._write is None:
+            self._write = self._start_response( self._status, self._headers )
+            self._write( self._output.getvalue() )
+
+    # ##################################################
+    # send
+    
+    def send( self, data ):
+        if self._write is not None:
+            self._write( data )
+        else:
+            self._output.write( data )
+
+    # ##################################################
+    # started
+    
+    def started( self ):
+        return self._write is not None
+
+    # ##################################################
+    # body
+    
+    def body( self ):
+        return self._output.getvalue()
+
+
+
+# ##################################################
+# class Usecase
+
+class Usecase:
+
+    # ##################################################
+    # constructor
+    #   with TRACE_REQUESTS, trace=1 returns the phases of the request and
+    #   the traceback of an error; with PROFILE_REQUESTS, trace=profile
+    #   adds a cProfile summary
+    
     def __init__( self, request=None, response=None ):
         self.request = request or Request()
         self.response = response or Response()
+        tracing = self.request.get_parameter( 'trace', False ) if TRACE_REQUESTS else None
+        self.trace = Trace( self.request.started, detailed=tracing not in [ None, '', '0' ] )
+        ( duration, cpu ) = self.request.parsing
+        self.trace.add( 'parse', duration, cpu if self.trace.detailed else None )
+        if self.trace.detailed:
+            self.response.set_trace( self.trace )
+        self.profiler = None
+        self.sampled = False
 
     # ##################################################
     # set up
-
+    #   only requests entered here are profiled, not the parts run on
+    #   each shard; PROFILE_SAMPLE_RATE of them are profiled into
+    #   PROFILE_LOG
+    
     def __enter__( self ):
-        self.response.dump_header()
+        profiled = PROFILE_REQUESTS and self.trace.detailed and self.request.get_parameter( 'trace', False ) == 'profile'
+        if profiled or random.random() < PROFILE_SAMPLE_RATE:
+            self.sampled = not profiled
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
         return self
 
     # ##################################################
     # tear down
         
     def __exit__( self, type, value, stack ):
+        if value is None and self.response.suspended():
+            if self.profiler is not None:
+                self.profiler.disable()
+            return False
         if value is not None:
             # print '[error] %s %s ' % ( type, value )
             # traceback.print_tb( stack, file=sys.stdout )
             self.response.success = False
             self.response.error = '%s' % value
+            self.response.set_header( 'ETag', None )
+            if isinstance( value, Overloaded ):
+                self.response.set_status( '503 Service Unavailable' )
+                self.response.set_header( 'Retry-After', str( value.retry_after ) )
         else:
             self.response.success = True
-        self.response.dump()
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profile()
+        if self.trace.detailed and value is not None:
+            self.response[ 'traceback' ] = traceback.format_exception( type, value, stack )
+        with self.trace.phase( 'dump' ):
+            self.response.dump()
+        metrics.record( self.trace, failed=( value is not None ) )
         return False
 
+    # ##################################################
+    # profile
+    #   top PROFILE_TOP functions by cumulative time
+    
+    def profile( self ):
+        output = StringIO()
+        pstats.Stats( self.profiler, stream=output ).sort_stats( 'cumulative' ).print_stats( PROFILE_TOP )
+        lines = [ line for line in output.getvalue().splitlines() if line.strip() ]
+        if not self.sampled:
+            self.response[ 'profile' ] = lines
+            return
+        report = '[profile] %s\n%s\n' % ( '/'.join( '%s' % part for part in self.trace.key or [] ), '\n'.join( lines ) )
+        if PROFILE_LOG is None:
+            sys.stderr.write( report )
+        else:
+            with open( PROFILE_LOG, 'a' ) as log:
+                log.write( report )
+
     # ##################################################
     # execute
     
     def execute( self ):
 
         # prepare sql query
-        self.request.build_query()
+        with self.trace.phase( 'config' ):
+            self.request.build_query()
+        self.trace.key = self.request.key()
+        self.response.set_stream( self.request.stream )
+        self.response.set_format( self.request.format )
+        self.response.set_encoding( self.request.encoding )
+        
+        # answer conditional reads without running them
+        if self.is_conditional():
+            etag = self.etag()
+            self.response.set_header( 'ETag', etag )
+            if etag in self.request.etags or '*' in self.request.etags:
+                self.response.set_status( '304 Not Modified' )
+                return
+        
+        # run a bounded number of requests per database, fanned out
+        # requests retry shard by shard so committed shards are not
+        # written twice
+        with admission.admit( self.request.database ):
+            if self.request.parts is not None:
+                self.execute_parts()
+            else:
+                self.retry( self.execute_database )
+        
+        # invalidate cached reads once writes are committed
+        self.invalidate()
+
+    # ##################################################
+    # execute_database
+    
+    def execute_database( self ):
+        
+        # run on each shard
+        if self.request.parts is not None:
+            return self.execute_parts()
+        
+        # serve reads from cache
+        if self.is_cacheable():
+            return self.execute_cached()
+        
+        # coalesce writes of concurrent requests into one commit
+        if self.is_groupable():
+            committer.submit( self.request.database, self.trace, self.execute_queries )
+        
+        else:
+            with Database( self.request.database, self.trace, self.is_read_only() ) as database:
+                self.execute_queries( database )
+
+    # ##################################################
+    # retry
+    #   a busy database rolls the whole transaction back, so it is run
+    #   again from scratch after a jittered exponential backoff, unless
+    #   rows were already streamed or the deadline would be exceeded;
+    #   BUSY_TIMEOUT is kept short so that waits happen here
+    
+    def retry( self, function ):
+        deadline = time.time() + BUSY_RETRY_DEADLINE
+        delay = BUSY_RETRY_DELAY
+        while True:
+            try:
+                return function()
+            except Exception, e:
+                if BUSY_REGEXP.search( '%s' % e ) is None or self.request.stream is not None:
+                    raise
+                if time.time() + delay > deadline:
+                    raise
+            self.response.reset()
+            time.sleep( random.uniform( 0, delay ) )
+            delay = min( delay * 2, BUSY_RETRY_MAX_DELAY )
+
+    # ##################################################
+    # execute_queries
+    
+    def execute_queries( self, database ):
+        
+        # execute batch items
+        if self.request.items is not None:
+            self.response[ 'results' ] = self.execute_batch( database )
         
-        with Database( self.request.database ) as database:
+        # execute bulk rows
+        elif self.request.rows is not None:
+            self.execute_bulk( database )
         
-            # execute sql queries
+        # execute sql queries
+        else:
             for query in self.request.queries:
                 query.execute( database, self.response )
+
+    # ##################################################
+    # is_cacheable
+    
+    def is_cacheable( self ):
+        if cache.size <= 0 or self.request.items is not None or self.request.rows is not None or self.request.stream is not None:
+            return False
+        return self.is_read_only()
+
+    # ##################################################
+    # is_groupable
+    #   plain dml only: ddl and scripts commit on their own, and streamed
+    #   output must be written by the request's own thread
+    
+    def is_groupable( self ):
+        if committer.size <= 0 or self.request.stream is not None or self.is_read_only():
+            return False
+        return all( query.kind in READS + WRITES for query in self.request.all_queries() )
+
+    # ##################################################
+    # is_read_only
+    #   only plain SELECT requests are routed to readonly connections
+    
+    def is_read_only( self ):
+        queries = self.request.all_queries()
+        return len( queries ) > 0 and all( query.kind in READS for query in queries )
+
+    # ##################################################
+    # is_conditional
+    
+    def is_conditional( self ):
+        return ETAGS and not self.trace.detailed and self.request.rows is None and self.is_read_only()
+
+    # ##################################################
+    # etag
+    #   the version is read before the queries run, so a write racing
+    #   with them only makes the next poll fetch again; the key is hashed
+    #   as json since repr of a blob parameter holds its memory address
+    
+    def etag( self ):
+        queries = [ ( query.sql, query.parameters ) for query in self.request.all_queries() ]
+        versions = [ probe.version( database ) for database in self.request.databases() ]
+        key = ( versions, self.request.database, self.request.stream, self.request.format, self.request.encoding, queries )
+        return '"%s"' % hashlib.sha1( json.dumps( key, default=encode_blob ) ).hexdigest()
+
+    # ##################################################
+    # execute_cached
+    
+    def execute_cached( self ):
+        queries = self.request.queries
+        key = ( self.request.database, self.request.format, tuple( ( query.sql, tuple( query.parameters ) ) for query in queries ) )
+        data = cache.get( key )
+        if data is None:
+            tables = set( table for query in queries for table in query.tables )
+            versions = cache.snapshot( self.request.database, tables )
+            result = Response()
+            result.set_format( self.request.format )
+            with Database( self.request.database, self.trace, readonly=True ) as database:
+                for query in queries:
+                    query.execute( database, result )
+            data = result.data()
+            cache.put( key, data, self.request.database, tables, versions )
+        for name, value in data.items():
+            self.response[ name ] = value
+
+    # ##################################################
+    # invalidate
+    
+    def invalidate( self ):
+        for query in self.request.all_queries():
+            for database in self.request.databases():
+                if query.kind in WRITES:
+                    cache.invalidate( database, query.tables or None )
+                elif query.kind not in READS:
+                    cache.invalidate( database )
+        if not self.is_read_only():
+            for database in self.request.databases():
+                feed.notify( database )
+
+    # ##################################################
+    # execute_parts
+    #   a single shard answers directly, otherwise every shard runs in its
+    #   own thread (and its own transaction) and the results are merged
+    
+    def execute_parts( self ):
+        parts = self.request.parts
+        if len( parts ) == 1:
+            part = self.part( parts[0], self.response )
+            return part.retry( part.execute_database )
+        results = [ None ] * len( parts )
+        def run( index ):
+            result = Response()
+            result.set_format( 'columnar' if self.request.format == 'columns' else self.request.format )
+            result.keep_page_key()
+            try:
+                part = self.part( parts[ index ], result )
+                part.retry( part.execute_database )
+                results[ index ] = ( result, None )
+            except Exception, e:
+                results[ index ] = ( result, e )
+        threads = [ threading.Thread( target=run, args=( index, ) ) for index in range( len( parts ) ) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.merge( results )
+
+    # ##################################################
+    # part
+    
+    def part( self, request, response ):
+        usecase = Usecase( request, response )
+        usecase.trace = self.trace
+        return usecase
+
+    # ##################################################
+    # merge
+    #   a missing row on some shards is expected when fanning out, but
+    #   not a row on several shards; rows are merged in page key order
+    #   and cut at the page limit
+    
+    def merge( self, results ):
+        found = [ result for result, error in results if error is None ]
+        for result, error in results:
+            if error is not None and ( '%s' % error != 'row not found' or not found ):
+                raise error
+        data = [ result.data() for result in found ]
+        for name in [ 'oid', 'columns' ]:
+            values = [ item[ name ] for item in data if item.get( name ) is not None ]
+            if values:
+                self.response[ name ] = values[0]
+        nbs = [ item[ 'nb' ] for item in data if item.get( 'nb' ) is not None ]
+        if nbs:
+            self.response[ 'nb' ] = sum( nbs )
+        rows = [ item[ 'row' ] for item in data if 'row' in item ]
+        if len( rows ) > 1:
+            raise Exception( 'row found on several shards' )
+        if rows:
+            self.response[ 'row' ] = rows[0]
+        if any( 'rows' in item for item in data ):
+            self.merge_rows( [ item.get( 'rows', [] ) for item in data ], any( 'next' in item for item in data ), data[0].get( 'columns' ) )
+
+    # ##################################################
+    # merge_rows
+    #   each shard's rows are already sorted, by the page key or else by
+    #   the query's ORDER BY on output columns, so the stable sorts below
+    #   only merge these runs; a LIMIT then applies to the merged rows,
+    #   which needs them in a known order
+    
+    def merge_rows( self, shards, more, columns ):
+        queries = [ query for query in self.request.queries if query.fetch_all ]
+        query = queries[ -1 ] if queries else Query()
+        rows = [ row for shard in shards for row in shard ]
+        if query.page_key is None:
+            ordering = self.ordering( query, columns )
+            if query.window is not None and not ordering and ORDER_BY_REGEXP.search( query.sql ):
+                raise Exception( 'LIMIT across shards needs ORDER BY output columns' )
+            for value, descending in reversed( ordering ):
+                rows.sort( key=value, reverse=descending )
+            if query.window is not None:
+                ( offset, count ) = query.window
+                rows = rows[ offset: ] if count < 0 else rows[ offset: offset + count ]
+        else:
+            key = query.page_key
+            if columns is not None:
+                index = columns.index( key ) if key in columns else len( columns )
+                value = lambda row: row[ index ] if index < len( row ) else None
+            else:
+                value = lambda row: row.get( key )
+            rows.sort( key=value )
+            if query.limit is not None and ( more or len( rows ) > query.limit ):
+                rows = rows[ : query.limit ]
+                if rows:
+                    self.response[ 'next' ] = encode_cursor( value( rows[ -1 ] ) )
+            if key == PAGE_ALIAS:
+                for row in rows:
+                    if columns is not None:
+                        del row[ index ]
+                    else:
+                        row.pop( PAGE_ALIAS, None )
+                if columns is not None:
+                    columns = [ column for column in columns if column != PAGE_ALIAS ]
+                    self.response[ 'columns' ] = columns
+        if self.request.format == 'columns':
+            self.response[ 'values' ] = [ list( values ) for values in zip( *rows ) ] if rows else [ [] for column in columns ]
+        else:
+            self.response.stream( 'rows', iter( [ rows ] ) )
+
+    # ##################################################
+    # ordering
+    #   ( value, descending ) per ORDER BY term, none when a term is not
+    #   a plain output column (rows then stay in shard order)
+    
+    def ordering( self, query, columns ):
+        match = ORDER_REGEXP.search( query.sql or '' )
+        if match is None:
+            return []
+        ordering = []
+        for term in match.group(1).split( ',' ):
+            matched = ORDER_TERM_REGEXP.match( term )
+            if matched is None:
+                return []
+            ( name, direction ) = matched.groups()
+            if columns is None:
+                value = ( lambda name: lambda row: row.get( name ) )( name )
+            elif name in columns:
+                value = ( lambda index: lambda row: row[ index ] )( columns.index( name ) )
+            else:
+                return []
+            ordering.append( ( value, ( direction or '' ).upper() == 'DESC' ) )
+        return ordering
+
+    # ##################################################
+    # execute_bulk
+    
+    def execute_bulk( self, database ):
+        with self.trace.phase( 'execute' ):
+            self.execute_rows( database )
+
+    # ##################################################
+    # execute_rows
+    #   the first row runs alone to capture the first oid, the others run
+    #   through executemany (or row by row for multi-statement queries,
+    #   to keep each row's statements in order); nb sums the rowcount of
+    #   each statement, which leaves out rows written by triggers
+    
+    def execute_rows( self, database ):
+        queries = self.request.queries
+        nb_rows = len( self.request.rows )
+        inserts = any( query.kind in [ 'INSERT', 'REPLACE' ] for query in queries )
+        nb = 0
+        if nb_rows > 0:
+            for query in queries:
+                query.execute_row( database, 0 )
+                nb = nb + ( database.fetch_nb() or 0 )
+            if inserts:
+                self.response[ 'first_oid' ] = database.fetch_last_oid()
+            if len( queries ) == 1:
+                queries[0].execute_many( database, 1 )
+                nb = nb + ( database.fetch_nb() or 0 )
+            else:
+                for index in range( 1, nb_rows ):
+                    for query in queries:
+                        query.execute_row( database, index )
+                        nb = nb + ( database.fetch_nb() or 0 )
+            if inserts:
+                self.response[ 'last_oid' ] = database.fetch_last_oid()
+        self.response[ 'nb' ] = nb
+
+    # ##################################################
+    # execute_batch
+    
+    def execute_batch( self, database ):
+        results = []
+        for index, item in enumerate( self.request.items ):
+            result = Response()
+            try:
+                for query in item.queries:
+                    query.execute( database, result )
+            except Exception, e:
+                raise Exception( 'item %s: %s' % ( index, e ) )
+            results.append( result.data() )
+        return results
+
+
+
+# ##################################################
+# class StatsUsecase
+
+class StatsUsecase( Usecase ):
+
+    # ##################################################
+    # execute
+    
+    def execute( self ):
+        self.response[ 'cache' ] = cache.stats()
+        self.response[ 'group_commit' ] = committer.stats()
+        self.response[ 'admission' ] = admission.stats()
+
+
+
+# ##################################################
+# class MetricsUsecase
+
+class MetricsUsecase( Usecase ):
+
+    # ##################################################
+    # execute
+    
+    def execute( self ):
+        self.response[ 'queries' ] = metrics.stats()
+
+
+
+# ##################################################
+# class ChangesUsecase
+#   /changes?db=&tb=&since=&wait=&limit= returns the changes of a table
+#   after seq since, waiting up to wait seconds for one to happen; the
+#   next poll passes the seq returned, and reset means changes were
+#   compacted away: resync with a full read, then poll from seq (limit=0
+#   returns the current seq, to be read before the first full read).
+#   Waiting polls are parked by the async server, without it at most
+#   CHANGES_WAITERS of them wait in their thread, the others answer
+#   right away
+
+class ChangesUsecase( Usecase ):
+
+    # ##################################################
+    # execute
+    
+    def execute( self ):
+        database = self.request.get_parameter( 'db' )
+        table = self.request.get_parameter( 'tb' )
+        since = self.get_number( 'since', int, 0 )
+        wait = min( self.get_number( 'wait', float, 0.0 ), CHANGES_MAX_WAIT )
+        limit = self.get_number( 'limit', int, CHANGES_LIMIT )
+        changes = catalog.changes( database )
+        if changes is None or table not in changes[0]:
+            raise Exception( 'missing changes of table %s in %s.ini' % ( table, database ) )
+        if catalog.sharding( database ) is not None:
+            raise Exception( 'changes of sharded database %s are not supported' % database )
+        self.trace.key = ( database, table, 'changes' )
+        deadline = self.request.environ.get( 'lite.deadline' ) or time.time() + wait
+        while True:
+            versions = ( feed.version( database ), probe.version( database ) )
+            with admission.admit( database ):
+                with Database( database, self.trace, readonly=True ) as connection:
+                    ( rows, seq, reset ) = feed.read( connection, table, since, limit )
+            if rows or reset or time.time() >= deadline:
+                break
+            changed = lambda: versions != ( feed.version( database ), probe.version( database ) )
+            parked = self.request.park( database, deadline, changed )
+            if parked:
+                return self.response.suspend()
+            if parked is False or not self.wait( database, versions, deadline ):
+                break
+        self.response[ 'changes' ] = rows
+        self.response[ 'seq' ] = seq
+        if reset:
+            self.response[ 'reset' ] = True
+
+    # ##################################################
+    # wait
+    #   in this thread, if the server runs requests in threads and one of
+    #   the CHANGES_WAITERS slots is free
+    
+    def wait( self, database, versions, deadline ):
+        if not self.request.environ.get( 'wsgi.multithread', True ) or not feed.slots.acquire( False ):
+            return False
+        try:
+            while time.time() < deadline and versions == ( feed.version( database ), probe.version( database ) ):
+                feed.wait( database, versions[0], min( deadline, time.time() + CHANGES_POLL ) )
+        finally:
+            feed.slots.release()
+        return True
+
+    # ##################################################
+    # get_number
+    
+    def get_number( self, key, kind, default ):
+        value = self.request.get_parameter( key, False )
+        if value in [ None, '' ]:
+            return default
+        try:
+            value = kind( value )
+        except ( TypeError, ValueError ):
+            raise Exception( 'invalid parameter %s' % key )
+        if value < 0:
+            raise Exception( 'invalid parameter %s' % key )
+        return value
+
+
+
+# ##################################################
+# routes
+
+ROUTES = {
+    '/stats': StatsUsecase,
+    '/metrics': MetricsUsecase,
+    '/changes': ChangesUsecase,
+}
+
+def route( path ):
+    return ROUTES.get( ( path or '' ).rstrip( '/' ), Usecase )
             
+# ##################################################
+# wsgi application
+
+def application( environ, start_response ):
+    if environ.get( 'wsgi.multiprocess' ) or environ.get( 'wsgi.run_once' ):
+        if memory.enabled:
+            memory.disable()
+        if cache.size > 0:
+            cache.disable()
+    response = WsgiResponse( start_response )
+    try:
+        with route( environ.get( 'PATH_INFO' ) )( Request( environ ), response ) as uc:
+            uc.execute()
+    except Exception:
+        traceback.print_exc( file=environ.get( 'wsgi.errors', sys.stderr ) )
+    if response.started() or response.suspended():
+        return []
+    start_response( response._status, response._headers )
+    body = response.body()
+    return [ body ] if body else []
+
 # ##################################################
 # main
     
 if __name__ == '__main__':
-    with Usecase( response=JsonResponse() ) as uc:
+    if sys.platform == 'win32':
+        # text mode would turn \n into \r\n, breaking content length and gzip
+        import msvcrt
+        msvcrt.setmode( sys.stdin.fileno(), os.O_BINARY )
+        msvcrt.setmode( sys.stdout.fileno(), os.O_BINARY )
+    memory.disable()
+    cache.disable()
+    with route( os.environ.get( 'PATH_INFO' ) )( response=JsonResponse() ) as uc:
         uc.execute()
 
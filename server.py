@@ -2,12 +2,48 @@
 # ##################################################
 # import
 
+import sys
+import os
+import time
+import errno
+import socket
+import signal
+import asyncore
+import asynchat
+import threading
+import traceback
+import collections
+import urllib
+import Queue
+import multiprocessing
+from StringIO import StringIO
 from BaseHTTPServer import HTTPServer
 from CGIHTTPServer import CGIHTTPRequestHandler
+from wsgiref.simple_server import make_server
 import cgitb; cgitb.enable()
 
 
 
+# ##################################################
+# settings
+
+URL = '0.0.0.0'
+PORT = 9999
+WORKERS = 8
+QUEUE_SIZE = 64
+RETRY_AFTER = 1
+BACKLOG = 128
+MAX_HEADER_SIZE = 65536
+MAX_BODY_SIZE = 16 * 1024 * 1024
+MAX_REQUESTS = 10000
+RESTART_DELAY = 1.0
+KEEPALIVE_TIMEOUT = 15.0
+KEEPALIVE_REQUESTS = 100
+MAX_PIPELINE = 16
+PARK_CHECK = 0.5
+
+
+
 # ##################################################
 # handler
 
@@ -26,12 +62,655 @@ class Handler(CGIHTTPRequestHandler):
 
 
 # ##################################################
-# server
+# class WorkerPool
+
+class WorkerPool:
+
+    # ##################################################
+    # constructor
+
+    def __init__( self, size=WORKERS, queue=QUEUE_SIZE ):
+        self.queue = queue
+        self.tasks = Queue.Queue()
+        self.threads = [ threading.Thread( target=self.run ) for index in range( size ) ]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    # ##################################################
+    # submit
+
+    def submit( self, task, *args ):
+        self.tasks.put( ( task, args ) )
+
+    # ##################################################
+    # offer
+    #   submit unless queue tasks already wait for a worker
+
+    def offer( self, task, *args ):
+        if self.queue > 0 and self.tasks.qsize() >= self.queue:
+            return False
+        self.submit( task, *args )
+        return True
+
+    # ##################################################
+    # run
+
+    def run( self ):
+        while True:
+            item = self.tasks.get()
+            if item is None:
+                break
+            ( task, args ) = item
+            try:
+                task( *args )
+            except Exception:
+                traceback.print_exc()
+
+    # ##################################################
+    # stop
+
+    def stop( self ):
+        for thread in self.threads:
+            self.tasks.put( None )
+        for thread in self.threads:
+            thread.join()
+
+
+
+# ##################################################
+# class Trigger
+#   wakes the event loop up to run callbacks queued by worker threads
+
+class Trigger( asyncore.dispatcher ):
+
+    # ##################################################
+    # constructor
+
+    def __init__( self ):
+        ( self.reader, self.writer ) = socket.socketpair()
+        asyncore.dispatcher.__init__( self, self.reader )
+        self.callbacks = collections.deque()
+
+    # ##################################################
+    # pull
+
+    def pull( self, callback, *args ):
+        self.callbacks.append( ( callback, args ) )
+        try:
+            self.writer.send( 'x' )
+        except socket.error:
+            pass
+
+    # ##################################################
+    # readable / writable
+
+    def readable( self ):
+        return True
+
+    def writable( self ):
+        return False
+
+    # ##################################################
+    # handle_read
+
+    def handle_read( self ):
+        try:
+            self.recv( 8192 )
+        except socket.error:
+            pass
+        while self.callbacks:
+            ( callback, args ) = self.callbacks.popleft()
+            try:
+                callback( *args )
+            except Exception:
+                traceback.print_exc()
+
+    # ##################################################
+    # handle_close
+
+    def handle_close( self ):
+        self.close()
+        self.writer.close()
+
+
+
+# ##################################################
+# class HttpChannel
+#   parses requests on the event loop and hands them to a worker one at
+#   a time, so pipelined requests are answered in order; the connection
+#   is kept alive for HTTP/1.1 (or HTTP/1.0 keep-alive) clients, up to
+#   KEEPALIVE_REQUESTS requests and KEEPALIVE_TIMEOUT seconds idle
+
+class HttpChannel( asynchat.async_chat ):
+
+    # ##################################################
+    # constructor
+
+    def __init__( self, sock, address, server ):
+        asynchat.async_chat.__init__( self, sock )
+        self.address = address
+        self.server = server
+        self.buffer = []
+        self.size = 0
+        self.environ = None
+        self.pending = collections.deque()
+        self.busy = False
+        self.closing = False
+        self.requests = 0
+        self.active = time.time()
+        self.set_terminator( '\r\n\r\n' )
+
+    # ##################################################
+    # readable
+    #   stop reading while too many pipelined requests wait
+
+    def readable( self ):
+        return not self.closing and len( self.pending ) < MAX_PIPELINE and asynchat.async_chat.readable( self )
+
+    # ##################################################
+    # collect_incoming_data
+
+    def collect_incoming_data( self, data ):
+        self.active = time.time()
+        self.buffer.append( data )
+        self.size = self.size + len( data )
+        if self.environ is None and self.size > MAX_HEADER_SIZE:
+            self.reply_error( '431 Request Header Fields Too Large' )
+
+    # ##################################################
+    # found_terminator
+
+    def found_terminator( self ):
+        if self.closing:
+            return
+        self.active = time.time()
+        data = ''.join( self.buffer )
+        self.buffer = []
+        self.size = 0
+        if self.environ is None:
+            self.environ = self.parse_header( data )
+            if self.environ is None:
+                return self.reply_error( '400 Bad Request' )
+            try:
+                length = int( self.environ.get( 'CONTENT_LENGTH' ) or 0 )
+            except ValueError:
+                return self.reply_error( '400 Bad Request' )
+            if length > MAX_BODY_SIZE:
+                return self.reply_error( '413 Request Entity Too Large' )
+            if length > 0:
+                self.set_terminator( length )
+                return
+            data = ''
+        environ = self.environ
+        environ[ 'wsgi.input' ] = StringIO( data )
+        self.environ = None
+        self.set_terminator( '\r\n\r\n' )
+        self.pending.append( environ )
+        self.next()
+
+    # ##################################################
+    # next
+    #   pending holds parsed requests, or the status of an error reply
+    #   that ends the connection
+
+    def next( self ):
+        if self.busy or not self.pending:
+            return
+        environ = self.pending.popleft()
+        if not isinstance( environ, dict ):
+            self.pending.clear()
+            self.push( 'HTTP/1.0 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n' % environ )
+            self.close_when_done()
+            return
+        self.busy = True
+        self.requests = self.requests + 1
+        self.server.dispatch( self, environ, self.keep_alive( environ ) )
+
+    # ##################################################
+    # keep_alive
+
+    def keep_alive( self, environ ):
+        if not self.server.running or self.server.recycling() or self.requests >= KEEPALIVE_REQUESTS:
+            return False
+        connection = environ.get( 'HTTP_CONNECTION', '' ).lower()
+        if environ[ 'SERVER_PROTOCOL' ] == 'HTTP/1.1':
+            return 'close' not in connection
+        return 'keep-alive' in connection
+
+    # ##################################################
+    # done
+    #   back on the event loop once the response is queued
+
+    def done( self, keep ):
+        self.busy = False
+        self.active = time.time()
+        if not keep:
+            self.closing = True
+            self.pending.clear()
+            self.close_when_done()
+            return
+        self.next()
+
+    # ##################################################
+    # idle
+
+    def idle( self, now, timeout ):
+        return not self.busy and not self.pending and not self.closing and now - self.active > timeout
+
+    # ##################################################
+    # parse_header
+
+    def parse_header( self, data ):
+        lines = data.lstrip( '\r\n' ).split( '\r\n' )
+        try:
+            ( method, target, protocol ) = lines[0].split()
+        except ValueError:
+            return None
+        ( path, _, query ) = target.partition( '?' )
+        environ = {
+            'REQUEST_METHOD': method.upper(),
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote( path ),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.server.host,
+            'SERVER_PORT': str( self.server.port ),
+            'SERVER_PROTOCOL': protocol,
+            'REMOTE_ADDR': self.address[0] if self.address else '',
+            'wsgi.version': ( 1, 0 ),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': self.server.multiprocess,
+            'wsgi.run_once': False,
+        }
+        for line in lines[ 1: ]:
+            ( key, _, value ) = line.partition( ':' )
+            key = key.strip().upper().replace( '-', '_' )
+            value = value.strip()
+            if key in [ 'CONTENT_TYPE', 'CONTENT_LENGTH' ]:
+                environ[ key ] = value
+            elif key:
+                environ[ 'HTTP_%s' % key ] = value
+        return environ
+
+    # ##################################################
+    # reply_error
+
+    def reply_error( self, status ):
+        self.set_terminator( None )
+        self.buffer = []
+        self.pending.append( status )
+        self.next()
+        self.closing = True
 
-url='0.0.0.0'
-port=9999
-server = HTTPServer( ( url, port ), Handler )
-print 'Serving HTTP on %s port %s...' % ( url, port )
-server.serve_forever()
+    # ##################################################
+    # reject
+    #   turned away before running, the client may retry later
 
+    def reject( self, retry_after ):
+        self.busy = False
+        self.closing = True
+        self.pending.clear()
+        self.push( 'HTTP/1.0 503 Service Unavailable\r\nRetry-After: %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n' % retry_after )
+        self.close_when_done()
+
+    # ##################################################
+    # handle_error
+
+    def handle_error( self ):
+        traceback.print_exc()
+        self.close()
+
+
+
+# ##################################################
+# class AsyncServer
+#   requests are parsed on the event loop and executed by a bounded
+#   pool of worker threads, so a slow query only holds one worker; once
+#   queue requests wait for a worker, the next ones get a 503 at once.
+#   RETRY_AFTER belongs to the server, which serves any wsgi application:
+#   it is independent of lite's ADMISSION_RETRY_AFTER, sent when a
+#   database (not the server) is overloaded
+
+class AsyncServer( asyncore.dispatcher ):
+
+    # ##################################################
+    # constructor
+
+    def __init__( self, application, host=URL, port=PORT, workers=WORKERS, sock=None, max_requests=0, queue=QUEUE_SIZE ):
+        asyncore.dispatcher.__init__( self )
+        self.application = application
+        self.max_requests = max_requests
+        self.served = 0
+        self.multiprocess = False
+        self.host = host
+        self.port = port
+        if sock is None:
+            self.create_socket( socket.AF_INET, socket.SOCK_STREAM )
+            self.set_reuse_addr()
+            self.bind( ( host, port ) )
+            self.listen( BACKLOG )
+        else:
+            sock.setblocking( 0 )
+            self.set_socket( sock )
+            self.accepting = True
+        self.trigger = Trigger()
+        self.pool = WorkerPool( workers, queue )
+        self.running = True
+        self.inflight = 0
+        self.parked = {}
+        self.checked = time.time()
+
+    # ##################################################
+    # handle_accept
+
+    def handle_accept( self ):
+        try:
+            pair = self.accept()
+        except socket.error:
+            return
+        if pair is not None:
+            HttpChannel( pair[0], pair[1], self )
+
+    # ##################################################
+    # dispatch
+
+    def dispatch( self, channel, environ, keep=False ):
+        if not self.pool.offer( self.execute, channel, environ, keep ):
+            return channel.reject( RETRY_AFTER )
+        self.inflight = self.inflight + 1
+
+    # ##################################################
+    # recycling
+    #   the request being dispatched is the last before max_requests
+
+    def recycling( self ):
+        return self.max_requests > 0 and self.served + self.inflight + 1 >= self.max_requests
+
+    # ##################################################
+    # execute
+    #   runs on a worker thread; output goes back through the trigger.
+    #   Responses without Content-Length are sent chunked to HTTP/1.1
+    #   clients, HTTP/1.0 ones get the end of the connection instead.
+    #   An application calling lite.park returns without answering, the
+    #   request waits on the event loop (not in a worker) to run again
+
+    def execute( self, channel, environ, keep=False ):
+        protocol = 'HTTP/1.1' if environ[ 'SERVER_PROTOCOL' ] == 'HTTP/1.1' else 'HTTP/1.0'
+        head = environ[ 'REQUEST_METHOD' ] == 'HEAD'
+        state = { 'head': None, 'sent': False, 'chunked': False, 'keep': keep, 'parked': False }
+
+        def park( key, deadline, changed ):
+            if not self.running or state[ 'sent' ]:
+                return False
+            state[ 'parked' ] = True
+            self.trigger.pull( self.park, channel, environ, keep, key, deadline, changed )
+            return True
+
+        environ[ 'lite.park' ] = park
+        environ[ 'lite.wake' ] = self.wake
+
+        def write( data ):
+            if not state[ 'sent' ]:
+                state[ 'sent' ] = True
+                self.trigger.pull( channel.push, state[ 'head' ] )
+            if data and not head:
+                if state[ 'chunked' ]:
+                    data = '%x\r\n%s\r\n' % ( len( data ), data )
+                self.trigger.pull( channel.push, data )
+
+        def start_response( status, headers, exc_info=None ):
+            headers = [ header for header in headers if header[0].lower() not in [ 'connection', 'transfer-encoding' ] ]
+            bodiless = head or status[ :3 ] in [ '204', '304' ] or status.startswith( '1' )
+            if not bodiless and not any( header[0].lower() == 'content-length' for header in headers ):
+                if protocol == 'HTTP/1.1':
+                    state[ 'chunked' ] = True
+                    headers.append( ( 'Transfer-Encoding', 'chunked' ) )
+                else:
+                    state[ 'keep' ] = False
+            headers.append( ( 'Connection', 'keep-alive' if state[ 'keep' ] else 'close' ) )
+            state[ 'head' ] = '%s %s\r\n%s\r\n' % ( protocol, status, ''.join( '%s: %s\r\n' % header for header in headers ) )
+            return write
+
+        try:
+            result = self.application( environ, start_response )
+            try:
+                if state[ 'parked' ]:
+                    return
+                for data in result:
+                    write( data )
+                write( '' )
+                if state[ 'chunked' ] and not head:
+                    self.trigger.pull( channel.push, '0\r\n\r\n' )
+            finally:
+                if hasattr( result, 'close' ):
+                    result.close()
+        except Exception:
+            traceback.print_exc()
+            if not state[ 'sent' ]:
+                state[ 'chunked' ] = False
+                start_response( '500 Internal Server Error', [ ( 'Content-Length', '0' ) ] )
+                write( '' )
+            else:
+                # the response is cut short: only closing tells the client
+                state[ 'keep' ] = False
+        self.trigger.pull( self.finish, channel, state[ 'keep' ] )
+
+    # ##################################################
+    # finish
+
+    def finish( self, channel, keep=False ):
+        self.inflight = self.inflight - 1
+        self.served = self.served + 1
+        if self.max_requests > 0 and self.served >= self.max_requests:
+            self.shutdown()
+        channel.done( keep and self.running )
+
+    # ##################################################
+    # park
+    #   on the event loop: the request stays in flight, its channel busy
+
+    def park( self, channel, environ, keep, key, deadline, changed ):
+        self.parked[ channel ] = ( environ, keep, key, deadline, changed )
+        self.check( channel )
+
+    # ##################################################
+    # wake
+    #   from any thread: run again the requests parked on key
+
+    def wake( self, key ):
+        self.trigger.pull( self.resume_key, key )
+
+    # ##################################################
+    # resume_key
+
+    def resume_key( self, key ):
+        for channel, entry in self.parked.items():
+            if entry[2] == key:
+                self.resume( channel )
+
+    # ##################################################
+    # check
+    #   resume a parked request past its deadline, or whose changed()
+    #   tells it has something new (writes of other processes)
+
+    def check( self, channel ):
+        ( environ, keep, key, deadline, changed ) = self.parked[ channel ]
+        try:
+            ready = not self.running or time.time() >= deadline or changed()
+        except Exception:
+            ready = True
+        if ready:
+            self.resume( channel )
+
+    # ##################################################
+    # resume
+    #   already admitted, so not turned away by a full queue
+
+    def resume( self, channel ):
+        ( environ, keep, key, deadline, changed ) = self.parked.pop( channel )
+        environ[ 'wsgi.input' ].seek( 0 )
+        self.pool.submit( self.execute, channel, environ, keep )
+
+    # ##################################################
+    # sweep
+    #   close connections idle for too long, or all idle ones when
+    #   shutting down; check parked requests every PARK_CHECK
+
+    def sweep( self ):
+        now = time.time()
+        timeout = KEEPALIVE_TIMEOUT if self.running else 0
+        for channel in asyncore.socket_map.values():
+            if isinstance( channel, HttpChannel ) and channel.idle( now, timeout ):
+                channel.close()
+        if self.parked and ( not self.running or now - self.checked >= PARK_CHECK ):
+            self.checked = now
+            for channel in self.parked.keys():
+                self.check( channel )
+
+    # ##################################################
+    # shutdown
+    #   stop accepting, let in-flight requests complete
+
+    def shutdown( self, *args ):
+        if self.running:
+            self.running = False
+            self.close()
+
+    # ##################################################
+    # serve_forever
+    #   signals can only be handled by the main thread
+
+    def serve_forever( self, signals=True ):
+        if signals:
+            signal.signal( signal.SIGINT, self.shutdown )
+            signal.signal( signal.SIGTERM, self.shutdown )
+        while self.running or self.inflight > 0:
+            asyncore.loop( timeout=0.5, count=1 )
+            self.sweep()
+        # flush pending output before stopping workers
+        for index in range( 20 ):
+            if not any( channel.writable() for channel in asyncore.socket_map.values() if isinstance( channel, HttpChannel ) ):
+                break
+            asyncore.loop( timeout=0.1, count=1 )
+        self.pool.stop()
+        self.trigger.handle_close()
+
+
+
+# ##################################################
+# class PreforkServer
+#   worker processes share the inherited listening socket, each one
+#   running an AsyncServer; the master restarts workers that exit,
+#   including those recycled after max_requests
+
+class PreforkServer:
+
+    # ##################################################
+    # constructor
+
+    def __init__( self, application, host=URL, port=PORT, processes=None, workers=WORKERS, max_requests=MAX_REQUESTS, queue=QUEUE_SIZE ):
+        if not hasattr( os, 'fork' ):
+            raise Exception( 'prefork mode needs os.fork' )
+        self.application = application
+        self.host = host
+        self.port = port
+        self.processes = processes or multiprocessing.cpu_count()
+        self.workers = workers
+        self.queue = queue
+        self.max_requests = max_requests
+        self.sock = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+        self.sock.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+        self.sock.bind( ( host, port ) )
+        self.sock.listen( BACKLOG )
+        self.children = {}
+        self.running = True
+
+    # ##################################################
+    # spawn
+
+    def spawn( self ):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                server = AsyncServer( self.application, self.host, self.port, self.workers, sock=self.sock, max_requests=self.max_requests, queue=self.queue )
+                server.multiprocess = True
+                server.serve_forever()
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            os._exit( status )
+        self.children[ pid ] = time.time()
+
+    # ##################################################
+    # shutdown
+
+    def shutdown( self, *args ):
+        self.running = False
+        for pid in self.children.keys():
+            try:
+                os.kill( pid, signal.SIGTERM )
+            except OSError:
+                pass
+
+    # ##################################################
+    # serve_forever
+
+    def serve_forever( self ):
+        signal.signal( signal.SIGINT, self.shutdown )
+        signal.signal( signal.SIGTERM, self.shutdown )
+        for index in range( self.processes ):
+            self.spawn()
+        while self.children:
+            try:
+                ( pid, status ) = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            started = self.children.pop( pid, None )
+            if started is None or not self.running:
+                continue
+            if status != 0:
+                print '[prefork] worker %s exited with status %s' % ( pid, status )
+                # do not spin when workers die right after starting
+                if time.time() - started < RESTART_DELAY:
+                    time.sleep( RESTART_DELAY )
+            self.spawn()
+        self.sock.close()
+
+
+
+# ##################################################
+# server
+#
+#   python server.py                 one cgi process per request
+#   python server.py wsgi            one warm process serving lite.application
+#   python server.py async [workers] event loop + worker threads
+#   python server.py prefork [processes] [workers]
+#                                    one async server per process
 
+if __name__ == '__main__':
+    url = URL
+    port = PORT
+    mode = sys.argv[1] if len( sys.argv ) > 1 else 'cgi'
+    if mode == 'wsgi':
+        import lite
+        lite.memory.preload()
+        server = make_server( url, port, lite.application )
+    elif mode == 'async':
+        import lite
+        lite.memory.preload()
+        workers = int( sys.argv[2] ) if len( sys.argv ) > 2 else WORKERS
+        server = AsyncServer( lite.application, url, port, workers )
+    elif mode == 'prefork':
+        import lite
+        processes = int( sys.argv[2] ) if len( sys.argv ) > 2 else None
+        workers = int( sys.argv[3] ) if len( sys.argv ) > 3 else WORKERS
+        server = PreforkServer( lite.application, url, port, processes, workers )
+    else:
+        server = HTTPServer( ( url, port ), Handler )
+    print 'Serving HTTP (%s) on %s port %s...' % ( mode, url, port )
+    server.serve_forever()
@@ -8,6 +8,16 @@ import unittest
 import sys
 import cgi
 import os
+import json
+import threading
+import zlib
+import time
+import socket
+import asyncore
+import signal
+import server
+import advisor
+from StringIO import StringIO
 
 # ##################################################
 # lite unittest
@@ -32,6 +42,111 @@ class LiteUnitTest( unittest.TestCase ):
             pass
         self.index = 0
 
+    # ##################################################
+    # wsgi
+
+    def wsgi( self, db='test', tb='test', body=None, path='/', etag=None, encoding=None, **kwargs ):
+        if db is not None:
+            kwargs[ 'db' ] = db
+        if tb is not None:
+            kwargs[ 'tb' ] = tb
+        environ = {
+            'PATH_INFO': path,
+            'REQUEST_METHOD': 'GET',
+            'QUERY_STRING': '&'.join( [ '%s=%s' % ( key, kwargs[key] ) for key in kwargs ] ),
+            'wsgi.input': StringIO(),
+            'wsgi.errors': StringIO(),
+        }
+        if etag is not None:
+            environ[ 'HTTP_IF_NONE_MATCH' ] = etag
+        if encoding is not None:
+            environ[ 'HTTP_ACCEPT_ENCODING' ] = encoding
+        if body is not None:
+            content = json.dumps( body )
+            environ.update( { 'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': 'application/json', 'CONTENT_LENGTH': str( len( content ) ), 'wsgi.input': StringIO( content ) } )
+        self.status = None
+        self.headers = None
+        self.written = []
+        def start_response( status, headers ):
+            self.status = status
+            self.headers = dict( headers )
+            return self.written.append
+        body = ''.join( lite.application( environ, start_response ) )
+        if self.status.startswith( '304' ):
+            return body
+        if self.written:
+            return self.decompress( ''.join( self.written ) + body )
+        self.assertEqual( self.headers[ 'Content-Length' ], str( len( body ) ) )
+        return json.loads( self.decompress( body ) )
+
+    # ##################################################
+    # decompress
+
+    def decompress( self, body ):
+        encoding = self.headers.get( 'Content-Encoding' )
+        if encoding is None:
+            return body
+        return zlib.decompress( body, dict( lite.ENCODINGS )[ encoding ] )
+
+    # ##################################################
+    # serve
+    #   async server on an ephemeral port, run by a background thread
+    
+    def serve( self, workers=1, queue=server.QUEUE_SIZE, application=lite.application ):
+        instance = server.AsyncServer( application, '127.0.0.1', 0, workers, queue=queue )
+        thread = threading.Thread( target=instance.serve_forever, kwargs={ 'signals': False } )
+        thread.daemon = True
+        thread.start()
+        return ( instance, thread, instance.socket.getsockname()[1] )
+
+    # ##################################################
+    # echo
+    #   application answering its query string, with a Content-Length
+    #   unless the query asks for chunks
+    
+    def echo( self, environ, start_response ):
+        body = environ[ 'QUERY_STRING' ]
+        if body.startswith( 'chunks=' ):
+            start_response( '200 OK', [ ( 'Content-Type', 'text/plain' ) ] )
+            return body[ 7: ].split( ',' )
+        start_response( '200 OK', [ ( 'Content-Type', 'text/plain' ), ( 'Content-Length', str( len( body ) ) ) ] )
+        return [ body ]
+
+    # ##################################################
+    # stop
+    
+    def stop( self, instance, thread ):
+        instance.trigger.pull( instance.shutdown )
+        thread.join( 5 )
+
+    # ##################################################
+    # receive
+    #   ( status, headers, body ) of the next response read from stream,
+    #   body framed by Content-Length, chunks or the end of the connection
+    
+    def receive( self, stream ):
+        status = stream.readline().rstrip( '\r\n' )
+        headers = {}
+        while True:
+            line = stream.readline().rstrip( '\r\n' )
+            if not line:
+                break
+            ( key, _, value ) = line.partition( ':' )
+            headers[ key.strip().lower() ] = value.strip()
+        if 'content-length' in headers:
+            body = stream.read( int( headers[ 'content-length' ] ) )
+        elif headers.get( 'transfer-encoding' ) == 'chunked':
+            body = ''
+            while True:
+                size = int( stream.readline().strip(), 16 )
+                chunk = stream.read( size + 2 )
+                if size == 0:
+                    break
+                body = body + chunk[ :-2 ]
+        else:
+            body = stream.read()
+        return ( status, headers, body )
+
     # ##################################################
     # assert_query
 
@@ -177,6 +292,898 @@ class LiteUnitTest( unittest.TestCase ):
         self.assert_query( 'SELECT * FROM test', fetch_all = True )
         self.assert_response( True, rows=[] )
 
+    def test_44_wsgi_insert( self ):
+        body = self.wsgi( qr='insert', key='four', value='quatre' )
+        self.assertEqual( self.status, '200 OK' )
+        self.assertEqual( self.headers[ 'Content-Type' ], 'text/json' )
+        self.assertEqual( body, { 'success': True, 'oid': 1 } )
+
+    def test_45_wsgi_select_one( self ):
+        body = self.wsgi( qr='select.one', oid='1' )
+        self.assertEqual( body, { 'success': True, 'row': { 'oid': 1, 'key': 'four', 'value': 'quatre' } } )
+
+    def test_46_wsgi_error( self ):
+        body = self.wsgi( qr='select.one', oid='99' )
+        self.assertEqual( body, { 'success': False, 'error': 'row not found' } )
+
+    def test_47_stream_json( self ):
+        self.wsgi( qr='insert', key='five', value='cinq' )
+        body = self.wsgi( qr='select.all', stream='json' )
+        self.assertEqual( self.headers[ 'Content-Type' ], 'text/json' )
+        self.assertEqual( json.loads( body ), { 'success': True, 'rows': [ { 'oid': 1, 'key': 'four', 'value': 'quatre' }, { 'oid': 2, 'key': 'five', 'value': 'cinq' } ] } )
+
+    def test_48_stream_ndjson( self ):
+        body = self.wsgi( qr='select.all', stream='ndjson' )
+        self.assertEqual( self.headers[ 'Content-Type' ], 'application/x-ndjson' )
+        self.assertEqual( [ json.loads( line ) for line in body.splitlines() ], [ { 'oid': 1, 'key': 'four', 'value': 'quatre' }, { 'oid': 2, 'key': 'five', 'value': 'cinq' }, { 'success': True } ] )
+
+    def test_49_stream_invalid( self ):
+        body = self.wsgi( qr='select.all', stream='xml' )
+        self.assertEqual( body, { 'success': False, 'error': 'invalid stream xml' } )
+
+    def test_50_catalog_reload( self ):
+        with open( 'catalog.ini', 'w' ) as config:
+            config.write( '[DEFAULT]\nversion=SELECT 1 AS version | one\n' )
+        try:
+            self.execute( db='catalog', tb=None, qr='version' )
+            self.assert_query( 'SELECT 1 AS version', fetch_one = True, table=None, database='catalog' )
+            plan = lite.catalog.plan( 'catalog', 'DEFAULT', 'version' )
+            self.assertTrue( lite.catalog.plan( 'catalog', 'DEFAULT', 'version' ) is plan )
+            self.assertTrue( lite.catalog.plan( 'catalog', 'DEFAULT', 'Version' ) is plan )
+            self.execute( db='catalog', tb=None, qr='VERSION' )
+            self.assert_query( 'SELECT 1 AS version', fetch_one = True, table=None, database='catalog' )
+            with open( 'catalog.ini', 'w' ) as config:
+                config.write( '[DEFAULT]\nversion=SELECT 2 AS version, %db% AS db | one\n' )
+            os.utime( 'catalog.ini', ( 0, 0 ) )
+            self.execute( db='catalog', tb=None, qr='version' )
+            self.assert_query( 'SELECT 2 AS version, catalog AS db', fetch_one = True, table=None, database='catalog' )
+        finally:
+            os.remove( 'catalog.ini' )
+            if os.path.exists( 'catalog.db' ):
+                os.remove( 'catalog.db' )
+
+    def test_51_pool_reuse( self ):
+        self.execute( qr='select.one', oid='1' )
+        self.assert_response( True )
+        connection = lite.pool.idle[ 'test' ][ -1 ]
+        self.execute( qr='select.one', oid='1' )
+        self.assert_response( True )
+        self.assertTrue( lite.pool.idle[ 'test' ][ -1 ] is connection )
+        self.assertEqual( lite.pool.used[ 'test' ], 0 )
+
+    def test_52_pool_exhausted( self ):
+        pool = lite.Pool( size=1, timeout=0.01 )
+        connection = pool.acquire( 'test' )
+        self.assertRaises( Exception, pool.acquire, 'test' )
+        pool.release( 'test', connection )
+        self.assertTrue( pool.acquire( 'test' ) is connection )
+        pool.close()
+
+    def test_53_page( self ):
+        self.execute( qr='insert', key='six', value='six' )
+        self.execute( qr='select.all', limit='2' )
+        self.assert_query( 'SELECT * FROM ( SELECT oid AS __key, * FROM test ) ORDER BY __key LIMIT ?', [ 3 ], fetch_all = True )
+        self.assert_response( True, rows=[ { 'oid': 1, 'key': 'four', 'value': 'quatre' }, { 'oid': 2, 'key': 'five', 'value': 'cinq' } ] )
+        after = self.usecase.response.next
+        self.execute( qr='select.all', limit='2', after=after )
+        self.assert_query( 'SELECT * FROM ( SELECT oid AS __key, * FROM test ) WHERE __key > ? ORDER BY __key LIMIT ?', [ 2, 3 ], fetch_all = True )
+        self.assert_response( True, rows=[ { 'oid': 3, 'key': 'six', 'value': 'six' } ] )
+        self.assertFalse( hasattr( self.usecase.response, 'next' ) )
+
+    def test_54_page_declared_key( self ):
+        self.execute( qr='select.by.value', limit='2' )
+        self.assert_response( True, rows=[ { 'oid': 2, 'key': 'five', 'value': 'cinq' }, { 'oid': 1, 'key': 'four', 'value': 'quatre' } ] )
+        body = self.wsgi( qr='select.by.value', limit='2', after=self.usecase.response.next, stream='json' )
+        self.assertEqual( json.loads( body ), { 'success': True, 'rows': [ { 'oid': 3, 'key': 'six', 'value': 'six' } ] } )
+
+    def test_55_page_invalid( self ):
+        self.execute( qr='select.all', limit='none' )
+        self.assert_response( False, error='invalid limit none' )
+        self.execute( qr='select.all', limit='1', after='%%%' )
+        self.assert_response( False, error='invalid cursor %%%' )
+
+    def test_56_batch( self ):
+        body = self.wsgi( tb=None, body=[
+            { 'qr': 'insert', 'tb': 'test', 'params': { 'key': 'seven', 'value': 'sept' } },
+            { 'qr': 'select.one', 'tb': 'test', 'params': { 'oid': 4 } },
+            { 'qr': 'count', 'tb': 'test', 'params': { 'key': 'seven' } },
+        ] )
+        self.assertEqual( body, { 'success': True, 'results': [
+            { 'oid': 4 },
+            { 'row': { 'oid': 4, 'key': 'seven', 'value': 'sept' } },
+            { 'oid': None, 'nb': None, 'row': { 'nb': 1 } },
+        ] } )
+
+    def test_57_batch_rollback( self ):
+        body = self.wsgi( tb=None, body=[
+            { 'qr': 'delete', 'tb': 'test', 'params': { 'oid': 4 } },
+            { 'qr': 'select.one', 'tb': 'test', 'params': { 'oid': 4 } },
+        ] )
+        self.assertEqual( body, { 'success': False, 'error': 'item 1: row not found' } )
+        self.execute( qr='select.one', oid='4' )
+        self.assert_response( True, row={ 'oid': 4, 'key': 'seven', 'value': 'sept' } )
+
+    def test_58_batch_invalid( self ):
+        body = self.wsgi( tb=None, body=[ { 'qr': 'unknown', 'tb': 'test' } ] )
+        self.assertEqual( body, { 'success': False, 'error': 'item 0: missing option unknown in section test in test.ini' } )
+
+    def test_59_bulk_insert( self ):
+        body = self.wsgi( qr='insert', body=[ { 'key': 'eight', 'value': 'huit' }, { 'key': 'nine', 'value': 'neuf' }, { 'key': 'ten', 'value': 'dix' } ] )
+        self.assertEqual( body, { 'success': True, 'nb': 3, 'first_oid': 5, 'last_oid': 7 } )
+        self.execute( qr='count', key='nine' )
+        self.assert_response( True, row={ 'nb': 1 } )
+
+    def test_60_bulk_upsert( self ):
+        body = self.wsgi( qr='upsert', body=[ { 'key': 'eight', 'value': 'ocho' }, { 'key': 'eight', 'value': 'otto' } ] )
+        self.assertEqual( body, { 'success': True, 'nb': 4, 'first_oid': 8, 'last_oid': 8 } )
+        self.execute( qr='select.one', oid='8' )
+        self.assert_response( True, row={ 'oid': 8, 'key': 'eight', 'value': 'otto' } )
+
+    def test_61_bulk_rollback( self ):
+        body = self.wsgi( qr='insert', body=[ { 'key': 'eleven', 'value': 'onze' }, { 'value': 'douze' } ] )
+        self.assertEqual( body[ 'success' ], False )
+        self.execute( qr='count', key='eleven' )
+        self.assert_response( True, row={ 'nb': 0 } )
+
+    def test_62_cache( self ):
+        lite.cache.size = 10
+        try:
+            stats = lite.cache.stats()
+            self.execute( qr='select.one', oid='1' )
+            self.execute( qr='select.one', oid='1' )
+            self.assert_response( True, row={ 'oid': 1, 'key': 'four', 'value': 'quatre' } )
+            self.assertEqual( lite.cache.stats()[ 'hits' ], stats[ 'hits' ] + 1 )
+            self.assertEqual( lite.cache.stats()[ 'misses' ], stats[ 'misses' ] + 1 )
+            self.execute( qr='update', key='four', value='vier' )
+            self.assertEqual( lite.cache.stats()[ 'invalidations' ], stats[ 'invalidations' ] + 1 )
+            self.execute( qr='select.one', oid='1' )
+            self.assert_response( True, row={ 'oid': 1, 'key': 'four', 'value': 'vier' } )
+            body = self.wsgi( db=None, tb=None, path='/stats' )
+            self.assertEqual( body[ 'cache' ][ 'hits' ], stats[ 'hits' ] + 1 )
+            original = lite.application
+            def application( environ, start_response ):
+                environ[ 'wsgi.multiprocess' ] = True
+                return original( environ, start_response )
+            lite.application = application
+            try:
+                self.wsgi( qr='select.one', oid='1' )
+            finally:
+                lite.application = original
+                lite.memory.enabled = True
+            self.assertEqual( lite.cache.size, 0 )
+            self.assertEqual( lite.cache.stats()[ 'hits' ], stats[ 'hits' ] + 1 )
+        finally:
+            lite.cache.size = 0
+            lite.cache.clear()
+
+    def test_63_cache_eviction( self ):
+        cache = lite.Cache( size=2, ttl=60.0 )
+        for key in [ 'a', 'b', 'c' ]:
+            cache.put( key, key, 'test', [ 'test' ], cache.snapshot( 'test', [ 'test' ] ) )
+        self.assertEqual( cache.get( 'a' ), None )
+        self.assertEqual( cache.get( 'c' ), 'c' )
+        self.assertEqual( cache.stats()[ 'evictions' ], 1 )
+        versions = cache.snapshot( 'test', [ 'test' ] )
+        cache.invalidate( 'test', [ 'test' ] )
+        cache.put( 'd', 'd', 'test', [ 'test' ], versions )
+        self.assertEqual( cache.get( 'd' ), None )
+        data = { 'rows': [ { 'key': 'e' } ] }
+        cache.put( 'e', data, 'test', [ 'test' ], cache.snapshot( 'test', [ 'test' ] ) )
+        data[ 'rows' ][0][ 'key' ] = 'changed'
+        cache.get( 'e' )[ 'rows' ].append( { 'key': 'added' } )
+        self.assertEqual( cache.get( 'e' ), { 'rows': [ { 'key': 'e' } ] } )
+
+    def test_64_format_columnar( self ):
+        body = self.wsgi( qr='insert', key='void' )
+        oid = body[ 'oid' ]
+        body = self.wsgi( qr='select.one', oid=oid, fmt='columnar' )
+        self.assertEqual( body, { 'success': True, 'columns': [ 'oid', 'key', 'value' ], 'row': [ oid, 'void', None ] } )
+        self.execute( qr='select.all', limit='2', fmt='columnar' )
+        self.assert_response( True, rows=[ [ 1, 'four', 'vier' ], [ 2, 'five', 'cinq' ] ] )
+        self.assertEqual( self.usecase.response.columns, [ 'oid', 'key', 'value' ] )
+        self.assertTrue( self.usecase.response.next is not None )
+
+    def test_65_format_columns( self ):
+        self.execute( qr='select.all', limit='2', fmt='columns' )
+        self.assert_response( True )
+        self.assertEqual( self.usecase.response.values, [ [ 1, 2 ], [ 'four', 'five' ], [ 'vier', 'cinq' ] ] )
+        response = lite.JsonResponse( output=StringIO() )
+        response.set_format( 'columns' )
+        response[ 'values' ] = [ [ 1, None ] ]
+        response.dump()
+        self.assertEqual( response._output.getvalue(), 'Content-Type: text/json\nContent-Length: 22\n\n{"values":[[1,null]]}\n' )
+        self.execute( qr='select.all', fmt='xml' )
+        self.assert_response( False, error='invalid fmt xml' )
+
+    def test_66_metrics( self ):
+        self.execute( qr='select.one', oid='2' )
+        self.execute( qr='select.one', oid='99' )
+        body = self.wsgi( db=None, tb=None, path='/metrics' )
+        stats = body[ 'queries' ][ 'test/test/select.one' ]
+        self.assertTrue( stats[ 'count' ] >= 2 )
+        self.assertTrue( stats[ 'errors' ] >= 1 )
+        for phase in [ 'config', 'connect', 'execute', 'fetch', 'dump', 'total' ]:
+            self.assertTrue( stats[ phase ][ 'p50' ] <= stats[ phase ][ 'p99' ] <= stats[ phase ][ 'max' ] )
+
+    def test_67_slow_query_log( self ):
+        threshold = lite.SLOW_QUERY_THRESHOLD
+        lite.SLOW_QUERY_THRESHOLD = 0.0
+        lite.SLOW_QUERY_LOG = 'slow.log'
+        try:
+            self.execute( qr='update', key='two', value='deux' )
+            self.assert_response( True )
+            with open( 'slow.log' ) as log:
+                content = log.read()
+            self.assertTrue( 'test/test/update UPDATE test SET value = ? WHERE key = ?' in content )
+            self.assertTrue( 'SCAN test' in content )
+        finally:
+            lite.SLOW_QUERY_THRESHOLD = threshold
+            lite.SLOW_QUERY_LOG = None
+            os.remove( 'slow.log' )
+
+    def test_68_read_write_routing( self ):
+        self.execute( qr='select.one', oid='1' )
+        self.assert_response( True )
+        reader = lite.pool.idle[ 'test' ][ -1 ]
+        self.assertRaises( lite.sqlite3.OperationalError, reader.execute, 'DELETE FROM test' )
+        self.execute( qr='update', key='two', value='two' )
+        self.assert_response( True )
+        self.assertFalse( reader in lite.writer.idle[ 'test' ] )
+        self.assertEqual( lite.writer.idle[ 'test' ][ -1 ].execute( 'PRAGMA journal_mode' ).fetchone()[0], 'wal' )
+
+    def test_69_group_commit( self ):
+        size = lite.committer.size
+        window = lite.committer.window
+        lite.committer.size = 3
+        lite.committer.window = 1.0
+        stats = lite.committer.stats()
+        responses = [ lite.Response() for index in range( 3 ) ]
+        def insert( response, parameters ):
+            try:
+                with lite.Usecase( lite.Request( parameters=parameters ), response ) as usecase:
+                    usecase.execute()
+            except Exception:
+                pass
+        threads = [ threading.Thread( target=insert, args=( responses[ index ], parameters ) ) for index, parameters in enumerate( [
+            { 'db': 'test', 'tb': 'test', 'qr': 'insert', 'key': 'g1', 'value': 'g1' },
+            { 'db': 'test', 'tb': 'test', 'qr': 'insert', 'value': 'g2' },
+            { 'db': 'test', 'tb': 'test', 'qr': 'insert', 'key': 'g3', 'value': 'g3' },
+        ] ) ]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            lite.committer.size = size
+            lite.committer.window = window
+        self.assertEqual( lite.committer.stats()[ 'groups' ], stats[ 'groups' ] + 1 )
+        self.assertEqual( lite.committer.stats()[ 'jobs' ], stats[ 'jobs' ] + 3 )
+        self.assertEqual( [ response.success for response in responses ], [ True, False, True ] )
+        self.assertEqual( abs( responses[2].oid - responses[0].oid ), 1 )
+        for response in [ responses[0], responses[2] ]:
+            self.execute( qr='delete', oid=response.oid )
+            self.assert_response( True, nb=1 )
+
+    def test_70_etag( self ):
+        body = self.wsgi( qr='select.all' )
+        etag = self.headers[ 'ETag' ]
+        self.assertEqual( self.wsgi( qr='select.all', etag=etag ), '' )
+        self.assertEqual( self.status, '304 Not Modified' )
+        self.assertFalse( 'Content-Length' in self.headers )
+        self.assertEqual( self.wsgi( qr='select.all', etag='W/%s, "other"' % etag ), '' )
+        self.assertEqual( self.wsgi( qr='select.all', fmt='columnar', etag=etag )[ 'success' ], True )
+        self.assertNotEqual( self.headers[ 'ETag' ], etag )
+        self.execute( qr='insert', key='eight', value='huit' )
+        self.assertEqual( len( self.wsgi( qr='select.all', etag=etag )[ 'rows' ] ), len( body[ 'rows' ] ) + 1 )
+        self.assertEqual( self.status, '200 OK' )
+        self.assertNotEqual( self.headers[ 'ETag' ], etag )
+        self.execute( qr='delete', oid=self.usecase.response.oid )
+        body = self.wsgi( qr='insert', key='nine', value='neuf' )
+        self.assertFalse( 'ETag' in self.headers )
+        self.execute( qr='delete', oid=body[ 'oid' ] )
+        self.wsgi( qr='count', body={ 'key': { 'blob': 'AAEC/w==' } } )
+        etag = self.headers[ 'ETag' ]
+        self.assertEqual( self.wsgi( qr='count', body={ 'key': { 'blob': 'AAEC/w==' } }, etag=etag ), '' )
+        output = StringIO()
+        response = lite.JsonResponse( output )
+        response.set_status( '304 Not Modified' )
+        response.dump()
+        self.assertEqual( output.getvalue(), 'Status: 304 Not Modified\nContent-Type: text/json\n\n' )
+
+    def test_71_compression( self ):
+        plain = self.wsgi( qr='select.all', encoding='gzip' )
+        self.assertFalse( 'Content-Encoding' in self.headers )
+        self.assertEqual( self.headers[ 'Vary' ], 'Accept-Encoding' )
+        size = lite.COMPRESSION_MIN_SIZE
+        lite.COMPRESSION_MIN_SIZE = 0
+        try:
+            for encoding, header in [ ( 'gzip', 'gzip' ), ( 'deflate;q=1, gzip;q=0', 'deflate' ), ( 'br, *;q=0.5', 'gzip' ) ]:
+                self.assertEqual( self.wsgi( qr='select.all', encoding=encoding ), plain )
+                self.assertEqual( self.headers[ 'Content-Encoding' ], header )
+            self.assertEqual( self.wsgi( qr='select.all', encoding='identity' ), plain )
+            self.assertFalse( 'Content-Encoding' in self.headers )
+        finally:
+            lite.COMPRESSION_MIN_SIZE = size
+        body = self.wsgi( qr='select.all', stream='ndjson', encoding='gzip' )
+        self.assertEqual( self.headers[ 'Content-Encoding' ], 'gzip' )
+        self.assertTrue( len( self.written ) > 2 )
+        self.assertEqual( [ json.loads( line ) for line in body.splitlines() ][ :-1 ], plain[ 'rows' ] )
+
+    def test_72_admission( self ):
+        admission = lite.admission
+        lite.admission = lite.Admission( concurrency=1, queue=1, timeout=0.01 )
+        try:
+            with lite.admission.admit( 'test' ):
+                body = self.wsgi( qr='select.one', oid='1' )
+            self.assertEqual( self.status, '503 Service Unavailable' )
+            self.assertEqual( self.headers[ 'Retry-After' ], '1' )
+            self.assertEqual( body, { 'success': False, 'error': 'database test overloaded' } )
+            self.assertEqual( lite.admission.stats(), { 'test': { 'active': 0, 'waiting': 0, 'rejected': 1 } } )
+            self.assertEqual( self.wsgi( qr='select.one', oid='1' )[ 'success' ], True )
+        finally:
+            lite.admission = admission
+
+    def test_73_busy_retry( self ):
+        self.execute( qr='select.one', oid='1' )
+        attempts = []
+        def busy():
+            attempts.append( True )
+            if len( attempts ) < 3:
+                raise lite.sqlite3.OperationalError( 'database is locked' )
+            return 'done'
+        self.assertEqual( self.usecase.retry( busy ), 'done' )
+        self.assertEqual( len( attempts ), 3 )
+        self.assertFalse( hasattr( self.usecase.response, 'row' ) )
+        deadline = lite.BUSY_RETRY_DEADLINE
+        lite.BUSY_RETRY_DEADLINE = 0.0
+        try:
+            del attempts[ : ]
+            self.assertRaises( lite.sqlite3.OperationalError, self.usecase.retry, busy )
+        finally:
+            lite.BUSY_RETRY_DEADLINE = deadline
+        self.assertEqual( len( attempts ), 1 )
+
+    def test_74_shards( self ):
+        with open( 'test.ini' ) as source:
+            config = source.read()
+        with open( 'shard.ini', 'w' ) as target:
+            target.write( config.replace( '[test]\n', '[test]\nselect.ordered=SELECT * FROM %tb% ORDER BY value DESC\nselect.top=SELECT * FROM %tb% ORDER BY value DESC LIMIT 3\nselect.window=SELECT * FROM %tb% ORDER BY value LIMIT %n% OFFSET %skip%\nselect.skip=SELECT * FROM %tb% ORDER BY value LIMIT 2, -1\nselect.lower=SELECT * FROM %tb% ORDER BY lower( value ) LIMIT 2\n' ) + '\n[lite]\nshards=3\nshard.key=key\n' )
+        try:
+            self.execute( db='shard', qr='create' )
+            self.assert_response( True )
+            self.assertEqual( sorted( name for name in os.listdir( '.' ) if name.endswith( '.db' ) and name.startswith( 'shard.' ) ), [ 'shard.0.db', 'shard.1.db', 'shard.2.db' ] )
+            for key in [ 'a', 'b', 'c', 'd', 'e', 'f' ]:
+                self.execute( db='shard', qr='insert', key=key, value='v%s' % key )
+                self.assert_response( True )
+            self.execute( db='shard', qr='insert', value='none' )
+            self.assert_response( False, error='missing shard key key in request' )
+            self.assertEqual( len( set( lite.catalog.sharding( 'shard' ).shard( key ) for key in 'abcdef' ) ), 2 )
+            self.execute( db='shard', qr='count', key='c' )
+            self.assert_response( True, row={ 'nb': 1 } )
+            self.execute( db='shard', qr='select.all' )
+            self.assertEqual( sorted( row[ 'key' ] for row in self.usecase.response.rows ), [ 'a', 'b', 'c', 'd', 'e', 'f' ] )
+            self.execute( db='shard', qr='select.by.value', limit='4' )
+            self.assertEqual( [ row[ 'value' ] for row in self.usecase.response.rows ], [ 'va', 'vb', 'vc', 'vd' ] )
+            self.execute( db='shard', qr='select.by.value', limit='4', after=self.usecase.response.next, fmt='columns' )
+            columns = self.usecase.response.columns
+            self.assertEqual( self.usecase.response.values[ columns.index( 'value' ) ], [ 've', 'vf' ] )
+            self.assertFalse( hasattr( self.usecase.response, 'next' ) )
+            body = self.wsgi( db='shard', tb=None, body=[ { 'qr': 'update', 'tb': 'test', 'params': { 'key': 'a', 'value': 'x' } }, { 'qr': 'update', 'tb': 'test', 'params': { 'key': 'b', 'value': 'x' } } ] )
+            self.assertEqual( body[ 'error' ], 'batch items span several shards' )
+            body = self.wsgi( db='shard', qr='insert', body=[ { 'key': 'g', 'value': 'vg' }, { 'key': 'h', 'value': 'vh' } ] )
+            self.assertEqual( body[ 'nb' ], 2 )
+            self.execute( db='shard', qr='select.ordered' )
+            self.assertEqual( [ row[ 'value' ] for row in self.usecase.response.rows ], [ 'vh', 'vg', 'vf', 've', 'vd', 'vc', 'vb', 'va' ] )
+            self.execute( db='shard', qr='select.ordered', fmt='columnar' )
+            self.assertEqual( [ row[ 2 ] for row in self.usecase.response.rows ], [ 'vh', 'vg', 'vf', 've', 'vd', 'vc', 'vb', 'va' ] )
+            self.execute( db='shard', qr='select.top' )
+            self.assertEqual( [ row[ 'value' ] for row in self.usecase.response.rows ], [ 'vh', 'vg', 'vf' ] )
+            self.execute( db='shard', qr='select.window', n='3', skip='2' )
+            self.assertEqual( [ row[ 'value' ] for row in self.usecase.response.rows ], [ 'vc', 'vd', 've' ] )
+            self.execute( db='shard', qr='select.skip', fmt='columnar' )
+            self.assertEqual( [ row[ 2 ] for row in self.usecase.response.rows ], [ 'vc', 'vd', 've', 'vf', 'vg', 'vh' ] )
+            self.execute( db='shard', qr='select.lower' )
+            self.assert_response( False, error='LIMIT across shards needs ORDER BY output columns' )
+            self.execute( db='shard', qr='select.one', oid='1' )
+            self.assert_response( False, error='row found on several shards' )
+            calls = []
+            execute_queries = lite.Usecase.execute_queries
+            def busy( usecase, database ):
+                calls.append( usecase.request.database )
+                if calls.count( 'shard.1' ) == 1 and usecase.request.database == 'shard.1':
+                    raise Exception( 'database is locked' )
+                return execute_queries( usecase, database )
+            lite.Usecase.execute_queries = busy
+            try:
+                self.execute( db='shard', qr='delete.all' )
+            finally:
+                lite.Usecase.execute_queries = execute_queries
+            self.assert_response( True, nb=8 )
+            self.assertEqual( sorted( calls ), [ 'shard.0', 'shard.1', 'shard.1', 'shard.2' ] )
+        finally:
+            lite.pool.close()
+            lite.writer.close()
+            lite.probe.close()
+            for name in os.listdir( '.' ):
+                if name.startswith( 'shard.' ):
+                    os.remove( name )
+
+    def test_75_memory( self ):
+        with open( 'test.ini' ) as source:
+            config = source.read()
+        with open( 'hot.ini', 'w' ) as target:
+            target.write( config + '\n[lite]\nmemory=yes\nmemory.persist=0\n' )
+        disk = lite.sqlite3.connect( 'hot.db' )
+        disk.execute( 'CREATE TABLE test ( oid INTEGER PRIMARY KEY, key TEXT NOT NULL, value TEXT )' )
+        disk.execute( "INSERT INTO test ( key, value ) VALUES ( 'one', 'un' )" )
+        disk.commit()
+        try:
+            self.assertEqual( lite.memory.preload(), [ 'hot' ] )
+            self.execute( db='hot', qr='select.one', oid='1' )
+            self.assert_response( True, row={ 'oid': 1, 'key': 'one', 'value': 'un' } )
+            self.execute( db='hot', qr='insert', key='two', value='deux' )
+            self.assert_response( True, oid=2 )
+            self.assertEqual( disk.execute( 'SELECT COUNT(*) FROM test' ).fetchone()[0], 1 )
+            disk.close()
+            self.assertTrue( lite.memory.persist( 'hot' ) )
+            self.assertFalse( lite.memory.persist( 'hot' ) )
+            disk = lite.sqlite3.connect( 'hot.db' )
+            self.assertEqual( disk.execute( 'SELECT key FROM test ORDER BY oid' ).fetchall(), [ ( 'one', ), ( 'two', ) ] )
+        finally:
+            disk.close()
+            lite.memory.close()
+            lite.pool.close()
+            lite.writer.close()
+            lite.probe.close()
+            for name in os.listdir( '.' ):
+                if name.startswith( 'hot.' ):
+                    os.remove( name )
+
+    def test_76_typed_parameters( self ):
+        body = self.wsgi( qr='select.one', body={ 'oid': 1 } )
+        self.assertEqual( body[ 'row' ][ 'oid' ], 1 )
+        request = lite.Request( parameters={} )
+        request.content = json.dumps( { 'db': 'test', 'tb': 'test', 'qr': 'select.one', 'oid': 1 } )
+        request.build_query()
+        self.assertEqual( request.queries[0].parameters, [ 1 ] )
+        body = self.wsgi( qr='insert', body={ 'key': 'blob', 'value': { 'blob': 'AAEC/w==' } } )
+        self.assertEqual( self.wsgi( qr='select.one', oid=body[ 'oid' ] )[ 'row' ][ 'value' ], { 'blob': 'AAEC/w==' } )
+        self.execute( qr='delete', oid=body[ 'oid' ] )
+        self.assertEqual( self.wsgi( qr='select.one', body={ 'oid': [ 1 ] } )[ 'error' ], 'invalid parameter oid' )
+        self.assertEqual( self.wsgi( qr='select.one', body={ 'oid': { 'blob': 'A' } } )[ 'error' ], 'invalid blob oid' )
+        request = lite.Request( { 'QUERY_STRING': 'db=test&qr=a&qr=b&oid=&tb=t%20b', 'CONTENT_TYPE': 'application/x-www-form-urlencoded', 'CONTENT_LENGTH': '9', 'wsgi.input': StringIO( 'oid=2&x=1' ) } )
+        self.assertEqual( request.parameters, { 'db': 'test', 'qr': 'a', 'tb': 't b', 'oid': '2', 'x': '1' } )
+
+    def test_77_trace( self ):
+        body = self.wsgi( qr='select.one', oid='x', trace='profile' )
+        self.assertFalse( 'trace' in body or 'traceback' in body or 'profile' in body )
+        lite.TRACE_REQUESTS = True
+        try:
+            body = self.wsgi( qr='select.one', oid=1, trace=1 )
+            phases = [ phase[ 'phase' ] for phase in body[ 'trace' ][ 'phases' ] ]
+            for phase in [ 'parse', 'config', 'connect', 'execute', 'fetch', 'dump' ]:
+                self.assertTrue( phase in phases )
+            self.assertTrue( 'cpu' in body[ 'trace' ][ 'phases' ][0] )
+            self.assertTrue( 'execute;dur=' in self.headers[ 'Server-Timing' ] )
+            self.assertTrue( 'dump;dur=' in self.headers[ 'Server-Timing' ] )
+            self.assertFalse( 'trace' in self.wsgi( qr='select.one', oid=1 ) )
+            self.assertFalse( 'Server-Timing' in self.headers )
+            body = json.loads( self.wsgi( qr='select.all', stream='json', trace=1 ) )
+            self.assertTrue( 'dump' in [ phase[ 'phase' ] for phase in body[ 'trace' ][ 'phases' ] ] )
+            self.assertTrue( 'execute;dur=' in self.headers[ 'Server-Timing' ] )
+            self.assertFalse( 'profile' in self.wsgi( qr='select.one', oid=1, trace='profile' ) )
+            lite.PROFILE_REQUESTS = True
+            body = self.wsgi( qr='select.one', oid=1, trace='profile' )
+            self.assertTrue( 'trace' in body )
+            self.assertTrue( any( 'cumulative' in line or 'cumtime' in line for line in body[ 'profile' ] ) )
+            body = self.wsgi( qr='select.one', oid='x', trace=1 )
+            self.assertTrue( 'traceback' in body )
+        finally:
+            lite.TRACE_REQUESTS = False
+            lite.PROFILE_REQUESTS = False
+
+    def test_78_changes( self ):
+        with open( 'test.ini' ) as source:
+            config = source.read()
+        with open( 'feed.ini', 'w' ) as target:
+            target.write( config + '\n[lite]\nchanges=test\nchanges.retain=3\n' )
+        try:
+            self.execute( db='feed', qr='create' )
+            self.assert_response( True )
+            body = self.wsgi( db='feed', path='/changes', limit=0 )
+            self.assertEqual( ( body[ 'changes' ], body[ 'seq' ] ), ( [], 0 ) )
+            self.execute( db='feed', qr='insert', key='one', value='un' )
+            self.execute( db='feed', qr='insert', key='two', value='deux' )
+            self.execute( db='feed', qr='update', key='one', value='uno' )
+            body = self.wsgi( db='feed', path='/changes', since=0 )
+            self.assertEqual( [ ( change[ 'op' ], change[ 'oid' ] ) for change in body[ 'changes' ] ], [ ( 'insert', 1 ), ( 'insert', 2 ), ( 'update', 1 ) ] )
+            self.assertEqual( body[ 'changes' ][0][ 'row' ], { 'oid': 1, 'key': 'one', 'value': 'uno' } )
+            seq = body[ 'seq' ]
+            def write():
+                lite.time.sleep( 0.1 )
+                self.execute( db='feed', qr='delete', oid=2 )
+            thread = threading.Thread( target=write )
+            thread.start()
+            body = self.wsgi( db='feed', path='/changes', since=seq, wait=5 )
+            thread.join()
+            self.assertEqual( body[ 'changes' ], [ { 'seq': seq + 1, 'op': 'delete', 'oid': 2, 'row': None } ] )
+            self.assertFalse( 'reset' in body )
+            body = self.wsgi( db='feed', path='/changes', since=0 )
+            self.assertEqual( ( body[ 'changes' ], body[ 'seq' ], body[ 'reset' ] ), ( [], seq + 1, True ) )
+            self.execute( db='feed', tb='tmp', qr='insert', key='one', value='un' )
+            self.assertEqual( self.wsgi( db='feed', path='/changes', since=seq + 1 )[ 'seq' ], seq + 1 )
+            self.assertEqual( self.wsgi( db='feed', tb='tmp', path='/changes' )[ 'error' ], 'missing changes of table tmp in feed.ini' )
+            self.assertEqual( self.wsgi( db='feed', path='/changes', since='x' )[ 'error' ], 'invalid parameter since' )
+            self.assertEqual( self.wsgi( db='feed', qr='insert', body=[ { 'key': 'a', 'value': '1' }, { 'key': 'b', 'value': '2' }, { 'key': 'c', 'value': '3' } ] )[ 'nb' ], 3 )
+            self.assertEqual( self.wsgi( db='feed', qr='upsert', body=[ { 'key': 'a', 'value': '4' } ] )[ 'nb' ], 2 )
+        finally:
+            lite.pool.close()
+            lite.writer.close()
+            lite.probe.close()
+            for name in os.listdir( '.' ):
+                if name.startswith( 'feed.' ):
+                    os.remove( name )
+
+    def test_79_page_without_oid_column( self ):
+        with open( 'rowid.ini', 'w' ) as target:
+            target.write( '[items]\nselect.all=SELECT * FROM %tb%\nselect.by.label=SELECT * FROM %tb% | page label\n' )
+        disk = lite.sqlite3.connect( 'rowid.db' )
+        disk.execute( 'CREATE TABLE items ( label TEXT )' )
+        disk.executemany( 'INSERT INTO items ( label ) VALUES ( ? )', [ ( 'c', ), ( 'a', ), ( None, ) ] )
+        disk.commit()
+        disk.close()
+        try:
+            self.execute( db='rowid', tb='items', qr='select.all', limit='2' )
+            self.assert_response( True, rows=[ { 'label': 'c' }, { 'label': 'a' } ] )
+            self.execute( db='rowid', tb='items', qr='select.all', limit='2', after=self.usecase.response.next, fmt='columnar' )
+            self.assert_response( True, rows=[ [ None ] ] )
+            self.assertEqual( self.usecase.response.columns, [ 'label' ] )
+            self.execute( db='rowid', tb='items', qr='select.by.label', limit='2' )
+            self.assert_response( False, error='null value of page key label for pagination' )
+        finally:
+            lite.pool.close()
+            lite.writer.close()
+            for name in [ 'rowid.ini', 'rowid.db' ]:
+                if os.path.exists( name ):
+                    os.remove( name )
+
+    def test_80_changes_parked( self ):
+        with open( 'test.ini' ) as source:
+            config = source.read()
+        with open( 'feed.ini', 'w' ) as target:
+            target.write( config + '\n[lite]\nchanges=test\n' )
+        self.execute( db='feed', qr='create' )
+        ( instance, thread, port ) = self.serve( workers=1 )
+        try:
+            polls = [ socket.create_connection( ( '127.0.0.1', port ) ) for index in range( 2 ) ]
+            for poll in polls:
+                poll.sendall( 'GET /changes?db=feed&tb=test&since=0&wait=10 HTTP/1.1\r\n\r\n' )
+            time.sleep( 0.3 )
+            started = time.time()
+            client = socket.create_connection( ( '127.0.0.1', port ) )
+            stream = client.makefile( 'rb' )
+            client.sendall( 'GET /?db=feed&tb=test&qr=select.all HTTP/1.1\r\n\r\n' )
+            ( status, headers, body ) = self.receive( stream )
+            self.assertEqual( json.loads( body )[ 'rows' ], [] )
+            self.assertTrue( time.time() - started < 1.0 )
+            self.assertEqual( len( instance.parked ), 2 )
+            client.sendall( 'GET /?db=feed&tb=test&qr=insert&key=k&value=v HTTP/1.1\r\n\r\n' )
+            self.assertEqual( json.loads( self.receive( stream )[2] )[ 'oid' ], 1 )
+            for poll in polls:
+                ( status, headers, body ) = self.receive( poll.makefile( 'rb' ) )
+                self.assertEqual( [ change[ 'op' ] for change in json.loads( body )[ 'changes' ] ], [ 'insert' ] )
+            self.assertTrue( time.time() - started < 2.0 )
+            for connection in polls + [ client ]:
+                connection.close()
+        finally:
+            self.stop( instance, thread )
+            lite.pool.close()
+            lite.writer.close()
+            lite.probe.close()
+            for name in os.listdir( '.' ):
+                if name.startswith( 'feed.' ):
+                    os.remove( name )
+
+    def test_81_server_overloaded( self ):
+        gate = threading.Event()
+        def application( environ, start_response ):
+            gate.wait( 5 )
+            return lite.application( environ, start_response )
+        ( instance, thread, port ) = self.serve( workers=1, queue=1, application=application )
+        try:
+            clients = []
+            for index in range( 3 ):
+                client = socket.create_connection( ( '127.0.0.1', port ) )
+                client.sendall( 'GET /?db=test&tb=test&qr=select.all HTTP/1.1\r\n\r\n' )
+                clients.append( client )
+                time.sleep( 0.2 )
+            ( status, headers, body ) = self.receive( clients[2].makefile( 'rb' ) )
+            self.assertEqual( status, 'HTTP/1.0 503 Service Unavailable' )
+            self.assertEqual( headers[ 'retry-after' ], str( server.RETRY_AFTER ) )
+            self.assertEqual( headers[ 'connection' ], 'close' )
+            gate.set()
+            for client in clients[ :2 ]:
+                ( status, headers, body ) = self.receive( client.makefile( 'rb' ) )
+                self.assertEqual( status, 'HTTP/1.1 200 OK' )
+            for client in clients:
+                client.close()
+        finally:
+            gate.set()
+            self.stop( instance, thread )
+            lite.pool.close()
+
+    def test_82_memory_multiprocess( self ):
+        with open( 'test.ini' ) as source:
+            config = source.read()
+        with open( 'hot.ini', 'w' ) as target:
+            target.write( config + '\n[lite]\nmemory=yes\nmemory.persist=0\n' )
+        disk = lite.sqlite3.connect( 'hot.db' )
+        disk.execute( 'CREATE TABLE test ( oid INTEGER PRIMARY KEY, key TEXT NOT NULL, value TEXT )' )
+        disk.commit()
+        original = lite.application
+        def application( environ, start_response ):
+            environ[ 'wsgi.multiprocess' ] = True
+            return original( environ, start_response )
+        try:
+            lite.application = application
+            self.assertEqual( self.wsgi( db='hot', qr='insert', key='one', value='un' )[ 'oid' ], 1 )
+            self.assertFalse( lite.memory.enabled )
+            self.assertEqual( lite.memory.uri( 'hot' ), None )
+            self.assertEqual( disk.execute( 'SELECT key FROM test' ).fetchall(), [ ( 'one', ) ] )
+        finally:
+            lite.application = original
+            lite.memory.enabled = True
+            disk.close()
+            lite.pool.close()
+            lite.writer.close()
+            lite.probe.close()
+            for name in os.listdir( '.' ):
+                if name.startswith( 'hot.' ):
+                    os.remove( name )
+
+    def test_83_server_keep_alive( self ):
+        ( instance, thread, port ) = self.serve( application=self.echo )
+        try:
+            client = socket.create_connection( ( '127.0.0.1', port ) )
+            stream = client.makefile( 'rb' )
+            for query in [ 'one', 'two' ]:
+                client.sendall( 'GET /?%s HTTP/1.1\r\n\r\n' % query )
+                ( status, headers, body ) = self.receive( stream )
+                self.assertEqual( ( status, headers[ 'connection' ], body ), ( 'HTTP/1.1 200 OK', 'keep-alive', query ) )
+            client.sendall( 'GET /?three HTTP/1.1\r\nConnection: close\r\n\r\n' )
+            ( status, headers, body ) = self.receive( stream )
+            self.assertEqual( ( headers[ 'connection' ], body ), ( 'close', 'three' ) )
+            self.assertEqual( stream.read(), '' )
+            client.close()
+            client = socket.create_connection( ( '127.0.0.1', port ) )
+            stream = client.makefile( 'rb' )
+            client.sendall( 'GET /?four HTTP/1.0\r\n\r\n' )
+            ( status, headers, body ) = self.receive( stream )
+            self.assertEqual( ( status, headers[ 'connection' ], body ), ( 'HTTP/1.0 200 OK', 'close', 'four' ) )
+            self.assertEqual( stream.read(), '' )
+            client.close()
+        finally:
+            self.stop( instance, thread )
+
+    def test_84_server_pipelining( self ):
+        gate = threading.Event()
+        def application( environ, start_response ):
+            gate.wait( 5 )
+            return self.echo( environ, start_response )
+        pipeline = server.MAX_PIPELINE
+        ( instance, thread, port ) = self.serve( application=application )
+        try:
+            server.MAX_PIPELINE = 2
+            client = socket.create_connection( ( '127.0.0.1', port ) )
+            stream = client.makefile( 'rb' )
+            client.sendall( 'GET /?one HTTP/1.1\r\n\r\nGET /?two HTTP/1.1\r\n\r\n' )
+            time.sleep( 0.1 )
+            for query in [ 'three', 'four', 'five' ]:
+                client.sendall( 'GET /?%s HTTP/1.1\r\n\r\n' % query )
+                time.sleep( 0.1 )
+            channels = [ channel for channel in asyncore.socket_map.values() if isinstance( channel, server.HttpChannel ) and channel.busy ]
+            self.assertEqual( len( channels ), 1 )
+            self.assertEqual( [ environ[ 'QUERY_STRING' ] for environ in channels[0].pending ], [ 'two', 'three' ] )
+            gate.set()
+            for query in [ 'one', 'two', 'three', 'four', 'five' ]:
+                self.assertEqual( self.receive( stream )[2], query )
+            client.close()
+        finally:
+            server.MAX_PIPELINE = pipeline
+            gate.set()
+            self.stop( instance, thread )
+
+    def test_85_server_chunked( self ):
+        ( instance, thread, port ) = self.serve( application=self.echo )
+        try:
+            client = socket.create_connection( ( '127.0.0.1', port ) )
+            stream = client.makefile( 'rb' )
+            client.sendall( 'GET /?chunks=a,,bc HTTP/1.1\r\n\r\n' )
+            ( status, headers, body ) = self.receive( stream )
+            self.assertEqual( ( headers[ 'transfer-encoding' ], headers[ 'connection' ], body ), ( 'chunked', 'keep-alive', 'abc' ) )
+            client.sendall( 'GET /?chunks=de HTTP/1.1\r\n\r\n' )
+            self.assertEqual( self.receive( stream )[2], 'de' )
+            client.sendall( 'GET /?after HTTP/1.1\r\n\r\n' )
+            self.assertEqual( self.receive( stream )[2], 'after' )
+            client.close()
+            client = socket.create_connection( ( '127.0.0.1', port ) )
+            stream = client.makefile( 'rb' )
+            client.sendall( 'GET /?chunks=a,bc HTTP/1.0\r\nConnection: keep-alive\r\n\r\n' )
+            ( status, headers, body ) = self.receive( stream )
+            self.assertFalse( 'transfer-encoding' in headers )
+            self.assertEqual( ( headers[ 'connection' ], body ), ( 'close', 'abc' ) )
+            client.close()
+        finally:
+            self.stop( instance, thread )
+
+    def test_86_server_idle_timeout( self ):
+        timeout = server.KEEPALIVE_TIMEOUT
+        ( instance, thread, port ) = self.serve( application=self.echo )
+        try:
+            server.KEEPALIVE_TIMEOUT = 0.2
+            client = socket.create_connection( ( '127.0.0.1', port ) )
+            stream = client.makefile( 'rb' )
+            client.sendall( 'GET /?one HTTP/1.1\r\n\r\n' )
+            self.assertEqual( self.receive( stream )[2], 'one' )
+            started = time.time()
+            client.settimeout( 5 )
+            self.assertEqual( client.recv( 1 ), '' )
+            self.assertTrue( 0.2 <= time.time() - started < 2.0 )
+            client.close()
+        finally:
+            server.KEEPALIVE_TIMEOUT = timeout
+            self.stop( instance, thread )
+
+    def test_87_advisor( self ):
+        with open( 'advice.ini', 'w' ) as target:
+            target.write( '\n'.join( [
+                '[DEFAULT]',
+                'select.template=SELECT * FROM %tb% WHERE key = %key%',
+                'count.items=SELECT COUNT(*) AS nb FROM items WHERE key = %key%',
+                '[items]',
+                'select.filtered=SELECT * FROM items WHERE key = %key% AND value > %value% ORDER BY rank',
+                'select.one=SELECT * FROM items WHERE oid = %oid%',
+                'select.small=SELECT * FROM small WHERE key = %key%',
+                '' ] ) )
+        disk = lite.sqlite3.connect( 'advice.db' )
+        disk.execute( 'CREATE TABLE items ( oid INTEGER PRIMARY KEY, key TEXT, value INTEGER, rank INTEGER )' )
+        disk.execute( 'CREATE TABLE small ( oid INTEGER PRIMARY KEY, key TEXT )' )
+        disk.executemany( 'INSERT INTO items ( key, value, rank ) VALUES ( ?, ?, ? )', [ ( 'k%s' % index, index, -index ) for index in range( 20 ) ] )
+        disk.execute( "INSERT INTO small ( key ) VALUES ( 'one' )" )
+        disk.commit()
+        disk.close()
+        instance = advisor.Advisor( 'advice', min_rows=10 )
+        try:
+            self.assertEqual( advisor.SCAN_REGEXP.match( 'SCAN items' ).group(1), 'items' )
+            self.assertEqual( advisor.SCAN_REGEXP.match( 'SCAN TABLE items USING INDEX idx' ).group(1), 'items' )
+            self.assertEqual( advisor.SCAN_REGEXP.match( 'SEARCH items USING INTEGER PRIMARY KEY (rowid=?)' ), None )
+            self.assertEqual( advisor.COLUMN_REGEXP.findall( 'a = ? AND t.b LIKE ? AND c BETWEEN ? AND ? OR d IN ( ? ) AND e < 1' ), [ 'a', 'b', 'c', 'd' ] )
+            self.assertEqual( instance.candidate_columns( 'SELECT * FROM items WHERE items.rank IN ( ? ) AND other = ? AND oid = ? ORDER BY items.key', 'items' ), [ 'rank', 'key' ] )
+            self.assertEqual( instance.candidate_columns( 'SELECT key FROM items ORDER BY oid', 'items' ), [] )
+            advices = dict( ( ( advice.section, advice.option ), advice ) for advice in instance.advise() )
+            self.assertEqual( sorted( advices ), [ ( 'items', 'count.items' ), ( 'items', 'select.filtered' ), ( 'items', 'select.one' ), ( 'items', 'select.small' ), ( 'items', 'select.template' ) ] )
+            self.assertEqual( advices[ ( 'items', 'select.filtered' ) ].scans, [ ( 'items', 20 ) ] )
+            self.assertEqual( advices[ ( 'items', 'select.filtered' ) ].indexes, [ 'CREATE INDEX IF NOT EXISTS idx_items_key_value_rank ON items ( key, value, rank )' ] )
+            self.assertEqual( advices[ ( 'items', 'select.template' ) ].indexes, [ 'CREATE INDEX IF NOT EXISTS idx_items_key ON items ( key )' ] )
+            self.assertEqual( advices[ ( 'items', 'count.items' ) ].indexes, [ 'CREATE INDEX IF NOT EXISTS idx_items_key ON items ( key )' ] )
+            self.assertEqual( ( advices[ ( 'items', 'select.one' ) ].scans, advices[ ( 'items', 'select.one' ) ].indexes ), ( [], [] ) )
+            self.assertEqual( ( advices[ ( 'items', 'select.small' ) ].scans, advices[ ( 'items', 'select.small' ) ].indexes ), ( [], [] ) )
+            self.assertEqual( instance.apply( advices.values() ), [ 'CREATE INDEX IF NOT EXISTS idx_items_key ON items ( key )', 'CREATE INDEX IF NOT EXISTS idx_items_key_value_rank ON items ( key, value, rank )' ] )
+            self.assertEqual( [ advice.indexes for advice in instance.advise() ], [ [] ] * 5 )
+        finally:
+            instance.close()
+            for name in os.listdir( '.' ):
+                if name.startswith( 'advice.' ):
+                    os.remove( name )
+
+    def test_88_page_distinct_grouped( self ):
+        with open( 'rowid.ini', 'w' ) as target:
+            target.write( '\n'.join( [
+                '[items]',
+                'select.distinct=SELECT DISTINCT label FROM %tb%',
+                'select.distinct.label=SELECT DISTINCT label FROM %tb% | page label',
+                'select.grouped=SELECT label, COUNT(*) AS nb FROM %tb% GROUP BY label',
+                'select.grouped.label=SELECT label, COUNT(*) AS nb FROM %tb% GROUP BY label | page label',
+                '' ] ) )
+        disk = lite.sqlite3.connect( 'rowid.db' )
+        disk.execute( 'CREATE TABLE items ( label TEXT )' )
+        disk.executemany( 'INSERT INTO items ( label ) VALUES ( ? )', [ ( 'c', ), ( 'a', ), ( 'c', ), ( 'b', ) ] )
+        disk.commit()
+        disk.close()
+        try:
+            self.assertEqual( lite.ROWID_SELECT_REGEXP.match( 'SELECT DISTINCT label FROM items' ), None )
+            self.assertTrue( lite.ROWID_EXCLUDE_REGEXP.search( 'SELECT label FROM items GROUP BY label' ) is not None )
+            self.assertEqual( lite.ROWID_EXCLUDE_REGEXP.search( 'SELECT * FROM grouped_items' ), None )
+            for qr in [ 'select.distinct', 'select.grouped' ]:
+                self.execute( db='rowid', tb='items', qr=qr, limit='2' )
+                self.assert_response( False, error='missing column oid for pagination' )
+            self.execute( db='rowid', tb='items', qr='select.distinct.label', limit='2' )
+            self.assert_response( True, rows=[ { 'label': 'a' }, { 'label': 'b' } ] )
+            self.execute( db='rowid', tb='items', qr='select.distinct.label', limit='2', after=self.usecase.response.next )
+            self.assert_response( True, rows=[ { 'label': 'c' } ] )
+            self.execute( db='rowid', tb='items', qr='select.grouped.label', limit='2' )
+            self.assert_response( True, rows=[ { 'label': 'a', 'nb': 1 }, { 'label': 'b', 'nb': 1 } ] )
+            self.execute( db='rowid', tb='items', qr='select.grouped.label', limit='2', after=self.usecase.response.next )
+            self.assert_response( True, rows=[ { 'label': 'c', 'nb': 2 } ] )
+        finally:
+            lite.pool.close()
+            lite.writer.close()
+            for name in [ 'rowid.ini', 'rowid.db' ]:
+                if os.path.exists( name ):
+                    os.remove( name )
+
+    def test_89_prefork_recycle( self ):
+        if not hasattr( os, 'fork' ) or not os.path.isdir( '/proc' ):
+            return
+        def application( environ, start_response ):
+            body = str( os.getpid() )
+            start_response( '200 OK', [ ( 'Content-Type', 'text/plain' ), ( 'Content-Length', str( len( body ) ) ) ] )
+            return [ body ]
+        def children( parent ):
+            pids = []
+            for name in os.listdir( '/proc' ):
+                try:
+                    with open( '/proc/%s/stat' % name ) as stat:
+                        if name.isdigit() and int( stat.read().rsplit( ')', 1 )[1].split()[1] ) == parent:
+                            pids.append( int( name ) )
+                except IOError:
+                    pass
+            return sorted( pids )
+        instance = server.PreforkServer( application, '127.0.0.1', 0, processes=2, workers=1, max_requests=1 )
+        port = instance.sock.getsockname()[1]
+        master = os.fork()
+        if master == 0:
+            asyncore.socket_map.clear()
+            try:
+                instance.serve_forever()
+            finally:
+                os._exit( 0 )
+        instance.sock.close()
+        try:
+            served = []
+            for index in range( 5 ):
+                client = socket.create_connection( ( '127.0.0.1', port ) )
+                client.settimeout( 5 )
+                stream = client.makefile( 'rb' )
+                client.sendall( 'GET / HTTP/1.1\r\n\r\n' )
+                ( status, headers, body ) = self.receive( stream )
+                self.assertEqual( ( status, headers[ 'connection' ] ), ( 'HTTP/1.1 200 OK', 'close' ) )
+                self.assertEqual( stream.read(), '' )
+                served.append( int( body ) )
+                client.close()
+            # each worker answered once, then was replaced
+            self.assertEqual( len( set( served ) ), 5 )
+            for attempt in range( 50 ):
+                workers = children( master )
+                if len( workers ) == 2 and not set( workers ) & set( served ):
+                    break
+                time.sleep( 0.1 )
+            self.assertEqual( len( workers ), 2 )
+            self.assertFalse( set( workers ) & set( served ) )
+            os.kill( master, signal.SIGTERM )
+            for attempt in range( 50 ):
+                ( pid, status ) = os.waitpid( master, os.WNOHANG )
+                if pid:
+                    break
+                time.sleep( 0.1 )
+            self.assertEqual( ( pid, status ), ( master, 0 ) )
+            for worker in workers + served:
+                self.assertRaises( OSError, os.kill, worker, 0 )
+        finally:
+            # workers left behind would hold the test output open
+            try:
+                os.kill( master, signal.SIGTERM )
+                for attempt in range( 50 ):
+                    if os.waitpid( master, os.WNOHANG )[0]:
+                        break
+                    time.sleep( 0.1 )
+                else:
+                    os.kill( master, signal.SIGKILL )
+                    os.waitpid( master, 0 )
+            except OSError:
+                pass
+
     def test_90_missing_db( self ):
         self.execute( db=None, qr='count' )
         self.assert_response( False, error='missing parameter db in request' )
@@ -193,6 +1200,49 @@ class LiteUnitTest( unittest.TestCase ):
         self.execute()
         self.assert_response( False, error='missing parameter qr in request' )
 
+    def test_94_async_request( self ):
+        ( instance, thread, port ) = self.serve( workers=2 )
+        try:
+            client = socket.create_connection( ( '127.0.0.1', port ) )
+            stream = client.makefile( 'rb' )
+            expected = self.wsgi( qr='select.one', oid='1' )
+            client.sendall( 'GET /?db=test&tb=test&qr=select.one&oid=1 HTTP/1.1\r\nHost: localhost\r\n\r\n' )
+            ( status, headers, body ) = self.receive( stream )
+            self.assertEqual( status, 'HTTP/1.1 200 OK' )
+            self.assertEqual( headers[ 'content-type' ], 'text/json' )
+            self.assertEqual( int( headers[ 'content-length' ] ), len( body ) )
+            self.assertEqual( json.loads( body ), expected )
+            content = json.dumps( { 'oid': 1 } )
+            client.sendall( 'POST /?db=test&tb=test&qr=select.one HTTP/1.1\r\nContent-Type: application/json\r\nContent-Length: %s\r\n\r\n%s' % ( len( content ), content ) )
+            ( status, headers, body ) = self.receive( stream )
+            self.assertEqual( json.loads( body ), expected )
+            client.sendall( 'GET /?db=test&tb=test HTTP/1.1\r\n\r\n' )
+            ( status, headers, body ) = self.receive( stream )
+            self.assertEqual( json.loads( body ), { 'success': False, 'error': 'missing parameter qr in request' } )
+            client.close()
+        finally:
+            self.stop( instance, thread )
+            lite.pool.close()
+
+    def test_95_async_stream( self ):
+        ( instance, thread, port ) = self.serve( workers=2 )
+        try:
+            expected = [ json.loads( line ) for line in self.wsgi( qr='select.all', stream='ndjson' ).splitlines() ]
+            client = socket.create_connection( ( '127.0.0.1', port ) )
+            stream = client.makefile( 'rb' )
+            for protocol in [ 'HTTP/1.1', 'HTTP/1.0' ]:
+                client.sendall( 'GET /?db=test&tb=test&qr=select.all&stream=ndjson %s\r\n\r\n' % protocol )
+                ( status, headers, body ) = self.receive( stream )
+                self.assertEqual( headers[ 'content-type' ], 'application/x-ndjson' )
+                self.assertFalse( 'content-length' in headers )
+                self.assertEqual( [ json.loads( line ) for line in body.splitlines() ], expected )
+                # chunked for HTTP/1.1, up to the end of the connection for HTTP/1.0
+                self.assertEqual( ( headers.get( 'transfer-encoding' ), headers[ 'connection' ] ), ( 'chunked', 'keep-alive' ) if protocol == 'HTTP/1.1' else ( None, 'close' ) )
+            client.close()
+        finally:
+            self.stop( instance, thread )
+            lite.pool.close()
+
 
 
 